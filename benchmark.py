@@ -0,0 +1,336 @@
+
+import argparse, asyncio, json, logging, resource, sys, time
+import numpy as np
+from surface import Surface
+from metrics import Histogram
+from defaults import PROJECT_VARS
+
+BENCH_SIZES = [1000, 10000, 100000]
+BENCH_SIDE = 1000.
+
+
+def populateSurface(count: int, rng: np.random.Generator, mobileShare: float=0.8) -> Surface:
+    surface = Surface(capacity=count)
+    positions = rng.uniform(0., BENCH_SIDE, (count, 2)).astype(np.float32)
+    for id, position in enumerate(positions):
+        if(rng.random() < mobileShare):
+            surface.addMobileAgent(agent=None, id=id, startPos=position)
+        else:
+            surface.addStaticAgent(agent=None, id=id, position=position)
+    return surface
+
+def linearNearest(surface: Surface, position: np.ndarray, k: int) -> np.ndarray:
+    """
+        kNN the way it is done without the tree: distance to every agent, then partial sort.
+    """
+    snapshot = surface.snapshot
+    dist = np.linalg.norm(snapshot.positions - position, axis=1)
+    k = min(k, dist.shape[0])
+    best = np.argpartition(dist, k - 1)[:k]
+    return snapshot.ids[best[np.argsort(dist[best])]]
+
+def benchNearest(sizes: list[int], queries: int, k: int, seed: int) -> None:
+    rng = np.random.default_rng(seed)
+    print(f"{'agents':>8} {'build ms':>10} {'kd-tree us':>12} {'linear us':>12} {'speedup':>8}")
+    for count in sizes:
+        surface = populateSurface(count, rng)
+        surface.publish(step=0)
+        points = rng.uniform(0., BENCH_SIDE, (queries, 2))
+
+        start = time.perf_counter()
+        surface.snapshot.tree('all')
+        build = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for point in points:
+            surface.findNearest(point, k)
+        tree = (time.perf_counter() - start) / queries
+
+        start = time.perf_counter()
+        for point in points:
+            linearNearest(surface, point, k)
+        linear = (time.perf_counter() - start) / queries
+
+        print(f"{count:>8} {build * 1e+3:>10.2f} {tree * 1e+6:>12.1f} {linear * 1e+6:>12.1f} {linear / tree:>8.1f}")
+
+def surfaceFootprint(surface: Surface) -> int:
+    """
+        Bytes held by the Surface containers, without the agent records themselves.
+    """
+    containers = [surface.agents, surface.mobileAgentArray, surface.staticAgentArray, surface.idToRow]
+    if(surface.grid is not None):
+        containers += [surface.grid.cells, surface.grid.idToCell]
+    arrays = [surface.positions, surface.mobileMask, surface.rowIds, surface.rowRecords]
+    return sum(sys.getsizeof(container) for container in containers) + sum(array.nbytes for array in arrays)
+
+def benchChurn(cycles: int, population: int, checkpoints: int, queries: int, seed: int) -> None:
+    """
+        Keeps population agents on the surface while every cycle removes a random
+        one and adds an agent with a new id, then reports memory and query time.
+    """
+    rng = np.random.default_rng(seed)
+    surface = Surface(cellSize=50.)
+    alive = list(range(population))
+    for id in alive:
+        surface.addMobileAgent(agent=None, id=id, startPos=rng.uniform(0., BENCH_SIDE, 2))
+    nextId = population
+    points = rng.uniform(0., BENCH_SIDE, (queries, 2))
+
+    print(f"{'cycles':>10} {'footprint KB':>13} {'capacity':>9} {'query us':>9}")
+    every = max(cycles // checkpoints, 1)
+    for cycle in range(cycles + 1):
+        if(cycle % every == 0):
+            start = time.perf_counter()
+            for point in points:
+                surface.findAgents(point, 50.)
+            query = (time.perf_counter() - start) / queries
+            print(f"{cycle:>10} {surfaceFootprint(surface) / 1024:>13.1f} {surface.positions.shape[0]:>9} {query * 1e+6:>9.1f}")
+        slot = int(rng.integers(population))
+        surface.removeAgent(alive[slot])
+        surface.addMobileAgent(agent=None, id=nextId, startPos=rng.uniform(0., BENCH_SIDE, 2))
+        alive[slot] = nextId
+        nextId += 1
+
+class HeadlessAgent():
+    """
+        Knowledge store standing in for the SPADE agent a behaviour normally belongs to.
+    """
+    def __init__(self) -> None:
+        self.knowledge = {}
+
+    def set(self, name: str, value) -> None:
+        self.knowledge[name] = value
+
+    def get(self, name: str):
+        return self.knowledge.get(name)
+
+async def runHeadless(count: int, ticks: int, queries: int, movers: float, radius: float, seed: int) -> dict:
+    # imported here so the other benchmarks do not need spade
+    from environment import GlobalEnvTimeBehaviour, makeSurface
+
+    surface = makeSurface()
+    behaviour = GlobalEnvTimeBehaviour(
+        logger=logging.getLogger('Benchmark'),
+        loggerPrefix="Benchmark",
+        sleepType=PROJECT_VARS['ENV_SLEEP_TYPE'],
+        envTicks=PROJECT_VARS['ENV_TICKS'],
+        envSimSpeed=PROJECT_VARS['ENV_SIM_SPEED'],
+        timeMode='FIXED',
+        seed=seed,
+        surface=surface,
+    )
+    behaviour.agent = HeadlessAgent()
+    rng = behaviour.rng
+    try:
+        mobile = rng.random(count) < 0.8
+        positions = rng.uniform(0., BENCH_SIDE, (count, 2)).astype(np.float32)
+        for id in range(count):
+            if(mobile[id]):
+                surface.addMobileAgent(agent=None, id=id, startPos=positions[id])
+            else:
+                surface.addStaticAgent(agent=None, id=id, position=positions[id])
+        mobileIds = np.flatnonzero(mobile)
+        await behaviour.on_start()
+
+        latency = Histogram('query_latency_seconds', "findAgents latency")
+        moved = max(int(mobileIds.shape[0] * movers), 1)
+        start = time.perf_counter()
+        for _ in range(ticks):
+            for id, step in zip(rng.choice(mobileIds, moved, replace=False), rng.normal(0., 1., (moved, 2)).astype(np.float32)):
+                surface.queueMove(id=int(id), vector=step)
+            for point in rng.uniform(0., BENCH_SIDE, (queries, 2)):
+                queryStart = time.perf_counter_ns()
+                surface.findAgents(point, radius)
+                latency.record((time.perf_counter_ns() - queryStart) * 1e-9)
+            await behaviour.run()
+        elapsed = time.perf_counter() - start
+        await behaviour.on_end()
+    finally:
+        if(hasattr(surface, 'close')):
+            surface.close()
+
+    return {
+        'agents': count,
+        'ticks': ticks,
+        'ticksPerSec': ticks / elapsed,
+        'tickP50Ms': behaviour.tickDuration.percentile(50) * 1e+3,
+        'tickP99Ms': behaviour.tickDuration.percentile(99) * 1e+3,
+        'queryP50Us': latency.percentile(50) * 1e+6,
+        'queryP99Us': latency.percentile(99) * 1e+6,
+        'stageMeanMs': {name: mean for name, (_, mean) in behaviour.pipeline.timings().items()},
+        'surfaceBytes': surfaceFootprint(surface) if isinstance(surface, Surface) else None,
+        'maxRssBytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+def benchHeadless(sizes: list[int], ticks: int, queries: int, movers: float, radius: float, seed: int, out: str) -> None:
+    """
+        The global environment tick without SPADE or XMPP: agents random-walk
+        through queued moves, queries go through Surface.findAgents and every
+        tick runs the GlobalEnvTimeBehaviour pipeline in FIXED time mode.
+        Results are printed and written to out as JSON. maxRssBytes is the
+        peak of the whole process so far, not of the single size.
+    """
+    results = []
+    print(f"{'agents':>8} {'ticks/s':>9} {'tick p99 ms':>12} {'query p50 us':>13} {'query p99 us':>13} {'max rss MB':>11}")
+    for count in sizes:
+        result = asyncio.run(runHeadless(count, ticks, queries, movers, radius, seed))
+        results.append(result)
+        print(f"{count:>8} {result['ticksPerSec']:>9.1f} {result['tickP99Ms']:>12.3f} {result['queryP50Us']:>13.1f} {result['queryP99Us']:>13.1f} {result['maxRssBytes'] / 2**20:>11.1f}")
+
+    report = {
+        'benchmark': 'headless',
+        'timestamp': time.time(),
+        'seed': seed,
+        'parameters': {'ticks': ticks, 'queries': queries, 'movers': movers, 'radius': radius, 'timeMode': 'FIXED'},
+        'config': {name: PROJECT_VARS[name] for name in sorted(PROJECT_VARS) if name.startswith('ENV_') and name not in ('ENV_PASSW', 'ENV_AGENT_NAME')},
+        'results': results,
+    }
+    with open(out, 'w') as file:
+        json.dump(report, file, indent=2)
+
+async def runReplay(path: str, speed: float) -> dict:
+    from environment import GlobalEnvTimeBehaviour, makeSurface
+    from recorder import Replayer
+
+    surface = makeSurface()
+    behaviour = GlobalEnvTimeBehaviour(
+        logger=logging.getLogger('Benchmark'),
+        loggerPrefix="Benchmark",
+        sleepType=PROJECT_VARS['ENV_SLEEP_TYPE'],
+        envTicks=PROJECT_VARS['ENV_TICKS'],
+        envSimSpeed=PROJECT_VARS['ENV_SIM_SPEED'],
+        timeMode='FIXED',
+        surface=surface,
+    )
+    behaviour.agent = HeadlessAgent()
+    messages = 0
+    def countMessages(tick) -> None:
+        nonlocal messages
+        messages += len(tick.messages)
+    try:
+        await behaviour.on_start()
+        start = time.perf_counter()
+        ticks = await Replayer(path).replay(behaviour, speed=speed, onTick=countMessages)
+        elapsed = time.perf_counter() - start
+        await behaviour.on_end()
+    finally:
+        if(hasattr(surface, 'close')):
+            surface.close()
+    return {
+        'ticks': ticks,
+        'agents': surface.count if isinstance(surface, Surface) else None,
+        'messages': messages,
+        'ticksPerSec': ticks / elapsed if elapsed > 0. else 0.,
+        'tickP50Ms': behaviour.tickDuration.percentile(50) * 1e+3,
+        'tickP99Ms': behaviour.tickDuration.percentile(99) * 1e+3,
+        'stageMeanMs': {name: mean for name, (_, mean) in behaviour.pipeline.timings().items()},
+    }
+
+def benchReplay(path: str, speed: float) -> None:
+    """
+        Feeds a tick log written by recorder.Recorder through a fresh surface
+        and the tick pipeline, no agents or XMPP server needed.
+    """
+    result = asyncio.run(runReplay(path, speed))
+    print(json.dumps(result, indent=2))
+
+
+async def runEvents(count: int, duration: float, interval: float, seed: int) -> dict:
+    from environment import GlobalEnvTimeBehaviour, makeSurface
+
+    surface = makeSurface()
+    behaviour = GlobalEnvTimeBehaviour(
+        logger=logging.getLogger('Benchmark'),
+        loggerPrefix="Benchmark",
+        sleepType=PROJECT_VARS['ENV_SLEEP_TYPE'],
+        envTicks=None,
+        envSimSpeed=PROJECT_VARS['ENV_SIM_SPEED'],
+        timeMode='EVENT',
+        seed=seed,
+        surface=surface,
+    )
+    behaviour.agent = HeadlessAgent()
+    rng = behaviour.rng
+    def hop(simTime: float, id: int) -> None:
+        surface.queueMove(id=id, vector=rng.normal(0., 1., 2).astype(np.float32))
+        if(simTime < duration):
+            behaviour.scheduleEvent(simTime + rng.exponential(interval), hop, id)
+    try:
+        for id, position in enumerate(rng.uniform(0., BENCH_SIDE, (count, 2)).astype(np.float32)):
+            surface.addMobileAgent(agent=None, id=id, startPos=position)
+        await behaviour.on_start()
+        for id in range(count):
+            behaviour.scheduleEvent(rng.exponential(interval), hop, id)
+        start = time.perf_counter()
+        while(behaviour.lastSimTime < duration and len(behaviour.events)):
+            await behaviour.run()
+        elapsed = time.perf_counter() - start
+        await behaviour.on_end()
+    finally:
+        if(hasattr(surface, 'close')):
+            surface.close()
+    steps = behaviour.stepCounter
+    return {
+        'agents': count,
+        'simSeconds': behaviour.lastSimTime,
+        'steps': steps,
+        'events': behaviour.events.fired,
+        'fixedSteps': int(behaviour.lastSimTime * PROJECT_VARS['ENV_TICKS'] / PROJECT_VARS['ENV_SIM_SPEED']),
+        'simSecondsPerSec': behaviour.lastSimTime / elapsed if elapsed > 0. else 0.,
+        'stepsPerSec': steps / elapsed if elapsed > 0. else 0.,
+    }
+
+def benchEvents(count: int, duration: float, interval: float, seed: int) -> None:
+    """
+        A sparse scenario in EVENT time mode: every agent moves once per
+        interval simulated seconds on average, for duration simulated seconds.
+        fixedSteps is what FIXED mode would step through at ENV_TICKS.
+    """
+    result = asyncio.run(runEvents(count, duration, interval, seed))
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Surface benchmarks")
+    parser.add_argument('--seed', type=int, default=0)
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    nearest = sub.add_parser('nearest', help="findNearest KD-tree against a linear scan")
+    nearest.add_argument('--sizes', type=int, nargs='+', default=BENCH_SIZES)
+    nearest.add_argument('--queries', type=int, default=1000)
+    nearest.add_argument('-k', type=int, default=5)
+
+    churn = sub.add_parser('churn', help="memory and query time under constant add/remove churn")
+    churn.add_argument('--cycles', type=int, default=1000000)
+    churn.add_argument('--population', type=int, default=1000)
+    churn.add_argument('--checkpoints', type=int, default=10)
+    churn.add_argument('--queries', type=int, default=200)
+
+    headless = sub.add_parser('headless', help="global environment ticks with synthetic agents, no XMPP server needed")
+    headless.add_argument('--sizes', type=int, nargs='+', default=BENCH_SIZES)
+    headless.add_argument('--ticks', type=int, default=100)
+    headless.add_argument('--queries', type=int, default=100, help="findAgents queries per tick")
+    headless.add_argument('--movers', type=float, default=0.1, help="share of mobile agents moving every tick")
+    headless.add_argument('--radius', type=float, default=20.)
+    headless.add_argument('--out', default='benchmark_headless.json')
+
+    replay = sub.add_parser('replay', help="replay a recorded tick log through the tick pipeline")
+    replay.add_argument('log', help="tick log written with ENV_RECORD_PATH")
+    replay.add_argument('--speed', type=float, default=None, help="multiple of the recorded simulated clock, default as fast as possible")
+
+    events = sub.add_parser('events', help="sparse scenario in EVENT time mode")
+    events.add_argument('--agents', type=int, default=100)
+    events.add_argument('--duration', type=float, default=86400., help="simulated seconds")
+    events.add_argument('--interval', type=float, default=3600., help="mean simulated seconds between the moves of an agent")
+
+    args = parser.parse_args()
+    if(args.bench == 'nearest'):
+        benchNearest(sizes=args.sizes, queries=args.queries, k=args.k, seed=args.seed)
+    elif(args.bench == 'churn'):
+        benchChurn(cycles=args.cycles, population=args.population, checkpoints=args.checkpoints, queries=args.queries, seed=args.seed)
+    elif(args.bench == 'headless'):
+        benchHeadless(sizes=args.sizes, ticks=args.ticks, queries=args.queries, movers=args.movers, radius=args.radius, seed=args.seed, out=args.out)
+    elif(args.bench == 'replay'):
+        benchReplay(path=args.log, speed=args.speed)
+    elif(args.bench == 'events'):
+        benchEvents(count=args.agents, duration=args.duration, interval=args.interval, seed=args.seed)
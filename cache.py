@@ -0,0 +1,68 @@
+import math
+import threading as th
+from collections import OrderedDict
+
+
+class QueryCache():
+    """
+        Bounded LRU of query results that are valid for one epoch of the data
+        they were computed from. A lookup with a newer epoch than the cached
+        results drops all of them, so writers only have to bump their epoch.
+        Positions are rounded to multiples of quantum before keying, queries
+        closer than that share one result, with quantum 0 only queries at the
+        very same position do.
+    """
+    def __init__(self, size: int=1024, quantum: float=0.) -> None:
+        if(size < 1):
+            raise Exception(f"Query cache needs room for at least one result, got size: {size}")
+        if(quantum < 0.):
+            raise Exception(f"Query cache quantum can not be negative, got: {quantum}")
+        self.size = int(size)
+        self.quantum = float(quantum)
+        self.lock = th.Lock()
+        self.entries = OrderedDict()
+        self.epoch = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def key(self, position, radius: float, kind: str, lineOfSight: bool=False) -> tuple:
+        x, y = float(position[0]), float(position[1])
+        if(self.quantum > 0.):
+            x, y = math.floor(x / self.quantum + 0.5), math.floor(y / self.quantum + 0.5)
+        return (x, y, float(radius), kind, lineOfSight)
+
+    def get(self, key: tuple, epoch):
+        """
+            Cached result of key at epoch, None on a miss.
+        """
+        self.lock.acquire()
+        if(epoch != self.epoch):
+            if(self.entries):
+                self.entries.clear()
+                self.invalidations += 1
+            self.epoch = epoch
+        value = self.entries.get(key)
+        if(value is None):
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        self.lock.release()
+        return value
+
+    def put(self, key: tuple, epoch, value) -> None:
+        self.lock.acquire()
+        # a result computed before a newer epoch was seen is already stale
+        if(epoch == self.epoch):
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if(len(self.entries) > self.size):
+                self.entries.popitem(last=False)
+        self.lock.release()
+
+    def clear(self) -> None:
+        self.lock.acquire()
+        self.entries.clear()
+        self.epoch = None
+        self.lock.release()
@@ -0,0 +1,158 @@
+import os
+import logging
+import threading as th
+import numpy as np
+
+CHECKPOINT_MAGIC = b'AASDCKPT'
+CHECKPOINT_VERSION = 2
+CHECKPOINT_ALIGN = 64
+IDS_INT = 0
+IDS_STR = 1
+# magic, version, agent count, step counter, simulated time, snapshot epoch, how ids are stored and where
+CHECKPOINT_HEADER = np.dtype([('magic', 'S8'), ('version', '<i8'), ('count', '<i8'), ('step', '<i8'), ('simTime', '<f8'), ('epoch', '<i8'), ('idsKind', '<i8'), ('idsOffset', '<i8'), ('idsBytes', '<i8')])
+# arrays following the header, in file order
+CHECKPOINT_ARRAYS = (('positions', np.float32, 2), ('velocities', np.float32, 2), ('accelerations', np.float32, 2), ('mobileMask', np.bool_, 0))
+
+def _aligned(offset: int) -> int:
+    return -(-offset // CHECKPOINT_ALIGN) * CHECKPOINT_ALIGN
+
+def _layout(count: int) -> tuple[dict[str, int], int]:
+    """
+        Offset of every array and the end of the last one.
+    """
+    offsets = {}
+    offset = CHECKPOINT_HEADER.itemsize
+    for name, dtype, width in CHECKPOINT_ARRAYS:
+        offset = _aligned(offset)
+        offsets[name] = offset
+        offset += count * max(width, 1) * np.dtype(dtype).itemsize
+    return offsets, _aligned(offset)
+
+def idArray(ids) -> np.ndarray:
+    """
+        Ids as an int64 or a fixed width UTF-32 array, both are read back
+        without running any code from the file. Also used by the tick log.
+    """
+    values = ids.tolist() if isinstance(ids, np.ndarray) else list(ids)
+    if(all(isinstance(id, (int, np.integer)) for id in values)):
+        try:
+            return np.asarray(values, dtype='<i8')
+        except OverflowError:
+            raise Exception("Ids have to fit in int64")
+    if(all(isinstance(id, str) for id in values)):
+        # at least one character, numpy has no zero width strings
+        width = max(max(map(len, values), default=1), 1)
+        return np.asarray(values, dtype=f'<U{width}')
+    raise Exception("Ids have to be all ints or all strs")
+
+def _encodeIds(ids: np.ndarray) -> tuple[int, bytes]:
+    array = idArray(ids)
+    return IDS_INT if array.dtype.kind == 'i' else IDS_STR, array.tobytes()
+
+class Checkpoint():
+    """
+        Content of a checkpoint file. The arrays are read-only memory maps of
+        the file, the pages are only read when the arrays are used.
+    """
+    def __init__(self, step: int, simTime: float, epoch: int, ids: list, positions, velocities, accelerations, mobileMask) -> None:
+        self.step = step
+        self.simTime = simTime
+        self.epoch = epoch
+        self.ids = ids
+        self.positions = positions
+        self.velocities = velocities
+        self.accelerations = accelerations
+        self.mobileMask = mobileMask
+
+def writeCheckpoint(path: str, snapshot, simTime: float) -> None:
+    """
+        Writes a SurfaceSnapshot and the clock to path: a CHECKPOINT_HEADER, the
+        CHECKPOINT_ARRAYS as raw little-endian arrays aligned to CHECKPOINT_ALIGN
+        bytes and the ids, int64 when all ids are ints and fixed width strings
+        when all are strs, other ids can not be checkpointed.
+        The file is written next to path and renamed over it, so a crash while
+        writing leaves the previous checkpoint intact.
+    """
+    count = snapshot.positions.shape[0]
+    offsets, idsOffset = _layout(count)
+    idsKind, idsData = _encodeIds(snapshot.ids)
+    header = np.array([(CHECKPOINT_MAGIC, CHECKPOINT_VERSION, count, snapshot.step or 0, simTime, snapshot.epoch, idsKind, idsOffset, len(idsData))], dtype=CHECKPOINT_HEADER)
+    temporary = f"{path}.tmp"
+    with open(temporary, 'wb') as file:
+        file.write(header.tobytes())
+        for name, dtype, _ in CHECKPOINT_ARRAYS:
+            file.seek(offsets[name])
+            file.write(np.ascontiguousarray(getattr(snapshot, name), dtype=np.dtype(dtype).newbyteorder('<')).tobytes())
+        file.seek(idsOffset)
+        file.write(idsData)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+
+def readCheckpoint(path: str) -> Checkpoint:
+    header = np.fromfile(path, dtype=CHECKPOINT_HEADER, count=1)
+    if(header.shape[0] == 0 or header[0]['magic'] != CHECKPOINT_MAGIC):
+        raise Exception(f"Not a checkpoint: {path}")
+    header = header[0]
+    if(header['version'] != CHECKPOINT_VERSION):
+        raise Exception(f"Unsupported checkpoint version {header['version']}: {path}")
+    count = int(header['count'])
+    offsets, _ = _layout(count)
+    arrays = {}
+    for name, dtype, width in CHECKPOINT_ARRAYS:
+        shape = (count, width) if width else (count,)
+        # memmap cannot map zero bytes
+        arrays[name] = np.memmap(path, dtype=np.dtype(dtype).newbyteorder('<'), mode='r', offset=offsets[name], shape=shape) if count else np.empty(shape, dtype=dtype)
+    with open(path, 'rb') as file:
+        file.seek(int(header['idsOffset']))
+        idsData = file.read(int(header['idsBytes']))
+    if(header['idsKind'] == IDS_INT):
+        ids = np.frombuffer(idsData, dtype='<i8', count=count).tolist()
+    elif(header['idsKind'] == IDS_STR):
+        ids = np.frombuffer(idsData, dtype=f'<U{len(idsData) // (4 * count)}', count=count).tolist() if count else []
+    else:
+        raise Exception(f"Unknown id encoding {header['idsKind']}: {path}")
+    return Checkpoint(step=int(header['step']), simTime=float(header['simTime']), epoch=int(header['epoch']), ids=ids, **arrays)
+
+class Checkpointer():
+    """
+        Writes checkpoints on a background thread. Published snapshots are never
+        modified, so save() only hands over the current one and the tick does not
+        wait for the disk. A save requested while the previous one is still being
+        written is skipped and counted in skipped.
+    """
+    def __init__(self, path: str, logger: logging.Logger=None) -> None:
+        self.path = path
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.written = 0
+        self.skipped = 0
+        self.lastStep = None
+        self._thread = None
+
+    def save(self, snapshot, simTime: float) -> bool:
+        """
+            Whether a write of the snapshot was started.
+        """
+        if(snapshot is None):
+            return False
+        if(self._thread is not None and self._thread.is_alive()):
+            self.skipped += 1
+            return False
+        self._thread = th.Thread(target=self._write, args=(snapshot, simTime), name='checkpoint', daemon=True)
+        self._thread.start()
+        return True
+
+    def _write(self, snapshot, simTime: float) -> None:
+        try:
+            writeCheckpoint(self.path, snapshot, simTime)
+            self.written += 1
+            self.lastStep = snapshot.step
+        except Exception as e:
+            self.logger.error(f"Checkpoint to {self.path} failed: {e}")
+
+    def wait(self) -> None:
+        """
+            Blocks until the checkpoint being written, if any, is on disk.
+        """
+        if(self._thread is not None):
+            self._thread.join()
@@ -8,10 +8,36 @@ PROJECT_VARS = {
     'ENV_AGENT_NAME': 'environment',
     'GLOB_ENV_LOGGER_NAME': 'Global Environment',
     'LOCAL_ENV_LOGGER_NAME': 'Local Environment',
+    'LOOPBACK_LOGGER_NAME': 'Loopback',
     'LOG_LEVEL': logging.INFO,
-    'ENV_TICKS': 1.,  # per seconds, env ticks in one update, the more the faster simulation is
+    'ENV_TICKS': 1.,  # per seconds, env ticks in one update, the more the faster simulation is. In 'EVENT' mode the most steps per envSimSpeed simulated seconds, None for no bound
     'ENV_SIM_SPEED': 1., # per second, the speed at which simulated clock is ticking
-    'ENV_SLEEP_TYPE': 'LOOP', # 'SLEEP' or 'LOOP'
+    'ENV_SLEEP_TYPE': 'HYBRID', # 'HYBRID', 'SLEEP' or 'LOOP', see environment.TimeBehaviour
+    'ENV_SPIN_TAIL': 0.002, # seconds before a tick deadline the HYBRID sleep stops awaiting and spins
+    'ENV_TIME_MODE': 'REALTIME', # 'REALTIME' follows the wall clock, 'FIXED' runs fixed simulated steps back to back, 'EVENT' jumps from one scheduled event to the next
+    'ENV_EVENT_IDLE_SLEEP': 0.01, # wall seconds an 'EVENT' mode behaviour waits while no event is scheduled
+    'ENV_SEED': None, # seed of the environment random generators, None seeds from the OS
+    'ENV_GRID_CELL_SIZE': None, # size of the surface spatial hash cell, None disables the grid
+    'ENV_SNAPSHOT_READS': False, # surface queries read the snapshot published every tick instead of locking
+    'ENV_WATCH_CELL_SIZE': 10., # size of the grid cell proximity watches are registered in
+    'ENV_SHARDS': 0, # number of worker processes holding the surface, 0 or 1 keeps it in process. Move functions, proximity watches, line of sight, ENV_TILE_MAP and ENV_QUERY_CACHE_SIZE are not supported with shards
+    'ENV_SHARD_BOUNDS': (0., 1000.), # x range split evenly between the shards
+    'ENV_SHARD_CAPACITY': 100000, # agents one shard holds before its shared memory is doubled
+    'ENV_TILE_MAP': None, # path of the binary tile map, see tiles.TileMap
+    'ENV_TILE_MOVE_MODE': 'clip', # 'clip' or 'reject' moves crossing blocked tiles
+    'ENV_HISTORY_LENGTH': None, # published positions kept per mobile agent, None disables the history
+    'ENV_MAX_SPEED': None, # speed limit of mobile agents per simulated second, None disables it
+    'ENV_DAMPING': 0., # rate per simulated second at which velocities decay, 0 keeps them
+    'ENV_QUERY_CACHE_SIZE': 0, # radius query results kept until positions or agents change, 0 disables the cache. Pays off with ENV_SNAPSHOT_READS or mostly static worlds, with live reads every move drops the cached results
+    'ENV_QUERY_CACHE_QUANTUM': 0., # positions of cached queries are rounded to multiples of it, 0 caches exact positions only. Non-zero values make results approximate
+    'ENV_PIPELINE_WORKERS': 0, # threads running the parallel stages of the tick pipeline, 0 runs them in order
+    'ENV_CHECKPOINT_PATH': None, # file the environment state is checkpointed to, None disables checkpoints
+    'ENV_CHECKPOINT_EVERY': 600, # ticks between two checkpoints
+    'ENV_RESTORE': True, # restore the environment from ENV_CHECKPOINT_PATH at startup when the file exists
+    'ENV_RECORD_PATH': None, # file the tick log of the run is written to, an existing log is overwritten, see recorder.Recorder, None disables recording
+    'ENV_RECORD_CHUNK_TICKS': 100, # ticks compressed and written together as one chunk of the tick log
+    'ENV_RECORD_SENSORS': True, # include the sensor readings of all wearers in the tick log
+    'LOOPBACK': False, # run the agents of this process without an XMPP server, see loopback.LoopbackServer
     'LOG_DIR': os.path.join('logs', ''), 
 }
 
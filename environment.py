@@ -1,5 +1,5 @@
 
-import logging, time, math
+import logging, time, math, zlib, asyncio, os
 from logging import Logger
 from spade import quit_spade
 from spade.template import Template
@@ -7,12 +7,24 @@ from spade.agent import Agent
 from spade_fix.behaviour import CyclicBehaviour
 from defaults import PROJECT_VARS
 from surface import Surface
+from shard import ShardedSurface
+from tiles import TileMap
+from pipeline import TickPipeline
+from sensors import SensorModel
+from metrics import MetricsRegistry
+from checkpoint import Checkpointer, readCheckpoint
+from recorder import Recorder
+from query import QueryBatcher, QUERY_METADATA
+from events import EventQueue, Event
+from aiohttp import web
+from loopback import LoopbackServer, startAgent, stopAgent
 import numpy as np
 from abc import abstractmethod
 from utils import prepareDefaultLogger
 
 ENV_TIME_SIM_SECONDS = 'simulated_runtime'
 ENV_TIME_RUNTIME_SECONDS = 'runtime'
+ENV_TIME_SIM_PER_WALL = 'simulated_per_wall_second'
 ENV_TEST_END_SECONDS = 5
 
 class FPS():
@@ -35,6 +47,36 @@ class FPS():
             self.frameCounter = 0
             self.lastT = current
 
+class Jitter():
+    """
+        Lateness of tick wake-ups against their deadlines, in microseconds,
+        mean and max over the last oneSecond window.
+    """
+    def __init__(self, oneSecond=1.) -> None:
+        self.oneSecond = oneSecond
+
+        self.windowStart = time.monotonic_ns()
+        self.total = 0.
+        self.count = 0
+        self.max = 0.
+        self.lastMean = 0.
+        self.lastMax = 0.
+
+    def get(self) -> tuple[float, float]:
+        return self.lastMean, self.lastMax
+
+    def __call__(self, lateness: float) -> None:
+        lateness *= 1e-3
+        self.total += lateness
+        self.count += 1
+        self.max = max(self.max, lateness)
+        current = time.monotonic_ns()
+        if(self.windowStart + self.oneSecond * 1e+9 < current):
+            self.lastMean = self.total / self.count
+            self.lastMax = self.max
+            self.total, self.count, self.max = 0., 0, 0.
+            self.windowStart = current
+
 class CyclicLogger():
     def __init__(self, logger: Logger, loggerPrefix: str, timeout: int=1e+9) -> None:
         self.logger = logger
@@ -56,81 +98,181 @@ class CyclicLogger():
             self.storedData = {}
 
 class TimeBehaviour(CyclicBehaviour):
-    def __init__(self, logger, loggerPrefix: str, sleepType: str, envTicks: float, envSimSpeed: float):
+    """
+        timeMode 'REALTIME' paces the steps with the wall clock. With 'FIXED'
+        every step advances the simulated clock by exactly envSimSpeed / envTicks
+        and the next step starts right away, so a scenario runs as fast as the
+        machine allows and does not depend on timing. rng is seeded with seed,
+        draw all randomness of the simulation from it to make runs repeatable.
+
+        With 'EVENT' the simulated clock jumps from one event of self.events to
+        the next and a step only happens when an event is due, so long quiet
+        stretches cost nothing. envTicks is then an optional bound: with it
+        steps are at least envSimSpeed / envTicks simulated seconds apart and
+        events closer than that share a step, None gives every event time its
+        own step. Work that is waiting outside the queue, see hasPendingWork,
+        gets a step at the current simulated time, or one interval later with
+        envTicks. With nothing to do the behaviour waits idleSleep wall seconds
+        at a time. In the other modes due events run at the first step at or
+        after their time.
+
+        In 'REALTIME' step n is due at start + n / envTicks, a late step does not
+        move the later deadlines and steps missed by more than a whole interval
+        are skipped. sleepType 'HYBRID' awaits asyncio.sleep until spinTail
+        seconds before the deadline and spins for the rest, 'SLEEP' only awaits
+        and 'LOOP' spins the whole interval, blocking the agent's event loop.
+    """
+    def __init__(self, logger, loggerPrefix: str, sleepType: str, envTicks: float, envSimSpeed: float, timeMode: str='REALTIME', seed=None, spinTail: float=0.002, idleSleep: float=0.01):
         super().__init__()
+        if(timeMode.upper() not in ('REALTIME', 'FIXED', 'EVENT')):
+            raise Exception(f"Unknown time mode: {timeMode}")
+        if(envTicks is None and timeMode.upper() != 'EVENT'):
+            raise Exception(f"Time mode {timeMode} needs envTicks")
         self._firstRun = False
         self.cyclicLogger = CyclicLogger(logger=logger, loggerPrefix=loggerPrefix, timeout=1e+9 - 1e+8)
         self.logger = logger
         self.loggerPrefix = loggerPrefix
         self.sleepType = sleepType
+        self.spinTail = spinTail
         self.envTicks = envTicks
         self.envSimSpeed = envSimSpeed
+        self.timeMode = timeMode.upper()
+        self.idleSleep = idleSleep
+        self.rng = np.random.default_rng(seed)
+        self.events = EventQueue()
+
+        self.metrics = MetricsRegistry(prefix='env_')
+        self.tickDuration = self.metrics.histogram('tick_duration_seconds', "Time spent in the work of a tick")
+        self.tickLateness = self.metrics.histogram('tick_lateness_seconds', "Delay of tick wake-ups after their deadline")
+        self.tickOverruns = self.metrics.counter('tick_overruns_total', "Ticks whose work ended after the next deadline")
+        self.metrics.counterFunc('ticks_skipped_total', "Ticks dropped after overrunning a whole interval", lambda: self.skippedTicks)
+        self.metrics.counterFunc('events_fired_total', "Scheduled events that were run", lambda: self.events.fired)
+        self.skippedTicks = 0
+        self.outbox = []
+        self.stepOffset = 0
+        self.simTimeOffset = 0.
 
     async def on_start(self) -> None:
         self.logger.info(f"Starting cyclic behaviour {self.loggerPrefix}. . .")
 
-        if(self.sleepType.upper() == 'SLEEP'):
-            self.sleepTypeF = TimeBehaviour.sleep_f
+        if(self.sleepType.upper() == 'HYBRID'):
+            self.sleepTypeF = self.hybrid_f
+        elif(self.sleepType.upper() == 'SLEEP'):
+            self.sleepTypeF = self.sleep_f
         elif(self.sleepType.upper() == 'LOOP'):
-            self.sleepTypeF = TimeBehaviour.loop_f
+            self.sleepTypeF = self.loop_f
         else:
             raise Exception(f"Unknown sleep type: {self.sleepType}")
 
-        self.stepCounter = 0
+        self.stepCounter = self.stepOffset
         self.fps = FPS()
+        self.jitter = Jitter()
+        self.nextDeadline = time.monotonic_ns()
         self.startTimeRuntime = time.time_ns()
         self.currentTime = None
+        self.lastSimTime = self.simTimeOffset
+        self.eventTime = self.simTimeOffset
+        self.simDt = 0.
 
         self._initKnowledgeItems()
+        if(self.timeMode == 'EVENT'):
+            # the first step waits for the first event, which may never come
+            self._firstRun = True
 
-    def sleep_f(next_update_time):
-        diff = next_update_time - time.time_ns()
-        if(diff <= 0.): # better than max(diff, 0.)
-            time.sleep(diff)
+    def restoreClock(self, stepCounter: int, simTime: float) -> None:
+        """
+            Continues the step counter and the simulated clock from a checkpoint,
+            call before the behaviour starts. The runtime still starts at zero.
+        """
+        self.stepOffset = int(stepCounter)
+        self.simTimeOffset = float(simTime)
 
-    def loop_f(next_update_time):
+    async def sleep_f(self, next_update_time):
+        diff = next_update_time - time.monotonic_ns()
+        if(diff > 0.):
+            await asyncio.sleep(diff * 1e-9)
+
+    async def loop_f(self, next_update_time):
         while True:
-            if time.time_ns() >= next_update_time:
+            if time.monotonic_ns() >= next_update_time:
                 break
+
+    async def hybrid_f(self, next_update_time):
+        # asyncio.sleep may wake up late, the spun tail absorbs that
+        await self.sleep_f(next_update_time - self.spinTail * 1e+9)
+        await self.loop_f(next_update_time)
     
-    def _customAwait(self): 
+    async def _customAwait(self): 
+        if(self.timeMode == 'FIXED'):
+            return
+        if(self.timeMode == 'EVENT'):
+            # lets the agent's other coroutines schedule events between steps
+            await asyncio.sleep(0)
+            return
         nanosecInSec = 1e+9
         # scale based on one second
-        scale = 1. / self.envTicks
-        next_update_time = self.currentTime + nanosecInSec * scale
-        #next_second = float(math.ceil(t / nanosecInSec))
-        #next_update_time = next_second - nanosecInSec * scale
-        self.sleepTypeF(next_update_time)
+        interval = nanosecInSec / self.envTicks
+        self.nextDeadline += interval
+        late = time.monotonic_ns() - self.nextDeadline
+        if(late > 0):
+            self.tickOverruns.inc()
+        if(late >= interval):
+            skipped = int(late // interval)
+            self.nextDeadline += skipped * interval
+            self.skippedTicks += skipped
+        await self.sleepTypeF(self.nextDeadline)
+        lateness = max(time.monotonic_ns() - self.nextDeadline, 0.)
+        self.jitter(lateness)
+        self.tickLateness.record(lateness * 1e-9)
 
     def _setKnowledgeItems(self):
         runtime = self._calcRuntime()
         simtime = self._calcSimulatedTime()
+        simPerWall = simtime / runtime if runtime > 0. else 0.
         fps = self.fps.get()
+        jitterMean, jitterMax = self.jitter.get()
         self.set('fps', fps)
+        self.set('jitterMean', jitterMean)
+        self.set('jitterMax', jitterMax)
+        self.set('skippedTicks', self.skippedTicks)
         self.set('stepCounter', self.stepCounter)
         self.set(ENV_TIME_RUNTIME_SECONDS, runtime)
         self.set(ENV_TIME_SIM_SECONDS, simtime)
+        self.set(ENV_TIME_SIM_PER_WALL, simPerWall)
 
         self.cyclicLogger.add(
             runtime=runtime, 
             simulatedSec=simtime, 
+            simPerWallSec=simPerWall,
             step=self.stepCounter,
             fps=self.fps.get(),
+            jitterMeanUs=jitterMean,
+            jitterMaxUs=jitterMax,
+            skippedTicks=self.skippedTicks,
         )
         self.cyclicLogger.tryFlush()
 
     def _initKnowledgeItems(self):
         self.set('fps', 0.)
+        self.set('jitterMean', 0.)
+        self.set('jitterMax', 0.)
+        self.set('skippedTicks', 0)
         self.set('stepCounter', self.stepCounter)
         self.set(ENV_TIME_RUNTIME_SECONDS, 0.)
         self.set(ENV_TIME_SIM_SECONDS, 0.)
+        self.set(ENV_TIME_SIM_PER_WALL, 0.)
 
     def _calcRuntime(self) -> float:
         return (time.time_ns() - self.startTimeRuntime) * 1e-9
 
     def _calcSimulatedTime(self) -> float:
+        if(self.timeMode == 'EVENT'):
+            return self.eventTime
         scale = self.envSimSpeed / self.envTicks
-        return (time.time_ns() - self.startTimeRuntime) * 1e-9 * scale
+        if(self.timeMode == 'FIXED'):
+            # multiplied, not accumulated, so the clock does not drift with the step count
+            return self.simTimeOffset + (self.stepCounter - self.stepOffset) * scale
+        return self.simTimeOffset + (time.time_ns() - self.startTimeRuntime) * 1e-9 * scale
 
     def isSetup(self) -> bool:
         return self._firstRun
@@ -139,6 +281,43 @@ class TimeBehaviour(CyclicBehaviour):
         self.currentTime = time.time_ns()
         self.stepCounter += 1
         self.fps()
+        simTime = self._calcSimulatedTime()
+        self.simDt = simTime - self.lastSimTime
+        self.lastSimTime = simTime
+        self.events.runDue(simTime)
+
+    def _advanceEventClock(self) -> bool:
+        """
+            Moves the 'EVENT' clock to the time of the next step, False when no event is scheduled.
+        """
+        due = self.events.peek()
+        if(self.hasPendingWork()):
+            due = self.eventTime if due is None else min(due, self.eventTime)
+        if(due is None):
+            return False
+        if(self.envTicks is not None and self.stepCounter > self.stepOffset):
+            due = max(due, self.eventTime + self.envSimSpeed / self.envTicks)
+        # events scheduled in the past run now, the clock never goes back
+        self.eventTime = max(due, self.eventTime)
+        return True
+
+    def hasPendingWork(self) -> bool:
+        """
+            True when something besides the events needs a step, checked in 'EVENT' mode.
+        """
+        return False
+
+    def scheduleEvent(self, simTime: float, fn, *args) -> Event:
+        """
+            Calls fn(simTime, *args) at the step of the given simulated time.
+        """
+        return self.events.schedule(simTime, fn, *args)
+
+    def scheduleEventIn(self, delay: float, fn, *args) -> Event:
+        """
+            Same as scheduleEvent, delay simulated seconds after the current step.
+        """
+        return self.events.schedule(self.lastSimTime + delay, fn, *args)
 
     @abstractmethod
     def middleRun(self) -> None:
@@ -147,34 +326,212 @@ class TimeBehaviour(CyclicBehaviour):
     def endRun(self) -> None:
         self._setKnowledgeItems()
         self._firstRun = True
-        self._customAwait()    
 
     async def run(self):
+        if(self.timeMode == 'EVENT' and not self._advanceEventClock()):
+            await asyncio.sleep(self.idleSleep)
+            return
+        start = time.perf_counter_ns()
         self.startRun()
 
         self.middleRun()
         
         self.endRun()
+        self.tickDuration.record((time.perf_counter_ns() - start) * 1e-9)
+
+        await self._sendOutbox()
+        await self._customAwait()
+
+    async def _sendOutbox(self) -> None:
+        """
+            Sends the messages the stages of the tick put in self.outbox.
+        """
+        if(self.outbox):
+            outbox, self.outbox = self.outbox, []
+            for msg in outbox:
+                await self.send(msg)
 
 class GlobalEnvTimeBehaviour(TimeBehaviour):
+    """
+        The work of a tick is the stage list of self.pipeline, add stages with
+        self.pipeline.add. With a surface it starts with the stages
+        moves, kinematics, watches, publish and history.
+    """
+    def __init__(self, logger, loggerPrefix: str, sleepType: str, envTicks: float, envSimSpeed: float, timeMode: str='REALTIME', seed=None, spinTail: float=0.002, idleSleep: float=0.01, surface: Surface=None, pipelineWorkers: int=0):
+        super().__init__(logger=logger, loggerPrefix=loggerPrefix, sleepType=sleepType, envTicks=envTicks, envSimSpeed=envSimSpeed, timeMode=timeMode, seed=seed, spinTail=spinTail, idleSleep=idleSleep)
+        self.surface = surface
+        # set by owners that drain self.queue in a pipeline stage, only then received messages are work
+        self.consumesQueue = False
+        self.pipeline = TickPipeline(workers=pipelineWorkers)
+        if(surface is not None):
+            self.pipeline.add('moves', surface.flushMoves)
+            self.pipeline.add('kinematics', lambda: surface.integrate(self.simDt))
+            self.pipeline.add('watches', lambda: surface.updateWatches(step=self.stepCounter))
+            self.pipeline.add('publish', lambda: surface.publish(step=self.stepCounter))
+            self.pipeline.add('history', lambda: surface.recordHistory(simTime=self._calcSimulatedTime()))
+
     def middleRun(self) -> None:
-        pass
+        self.pipeline.run(self.stepCounter)
+
+    def hasPendingWork(self) -> bool:
+        # queued moves are applied and received queries answered by the next tick
+        if(self.surface is not None and self.surface.pendingMoves):
+            return True
+        return self.consumesQueue and self.queue is not None and not self.queue.empty()
+
+    def endRun(self) -> None:
+        timings = self.pipeline.timings()
+        self.set('stageTimings', timings)
+        self.cyclicLogger.add(**{f"{name}Ms": round(mean, 3) for name, (_, mean) in timings.items()})
+        super().endRun()
+
+    async def on_end(self) -> None:
+        self.pipeline.close()
+
+def makeSurface() -> Surface:
+    """
+        The surface of the global environment as configured in PROJECT_VARS.
+    """
+    if(PROJECT_VARS['ENV_SHARDS'] > 1):
+        unsupported = [name for name in ('ENV_TILE_MAP', 'ENV_QUERY_CACHE_SIZE') if PROJECT_VARS[name]]
+        if(unsupported):
+            raise Exception(f"ENV_SHARDS does not support {', '.join(unsupported)}, see ShardedSurface")
+        return ShardedSurface(
+            shards=PROJECT_VARS['ENV_SHARDS'],
+            bounds=PROJECT_VARS['ENV_SHARD_BOUNDS'],
+            capacity=PROJECT_VARS['ENV_SHARD_CAPACITY'],
+            snapshotReads=PROJECT_VARS['ENV_SNAPSHOT_READS'],
+            historyLength=PROJECT_VARS['ENV_HISTORY_LENGTH'],
+            maxSpeed=PROJECT_VARS['ENV_MAX_SPEED'],
+            damping=PROJECT_VARS['ENV_DAMPING'],
+        )
+    tileMap = PROJECT_VARS['ENV_TILE_MAP']
+    return Surface(
+        cellSize=PROJECT_VARS['ENV_GRID_CELL_SIZE'],
+        snapshotReads=PROJECT_VARS['ENV_SNAPSHOT_READS'],
+        watchCellSize=PROJECT_VARS['ENV_WATCH_CELL_SIZE'],
+        tiles=TileMap.load(tileMap) if tileMap is not None else None,
+        tileMoveMode=PROJECT_VARS['ENV_TILE_MOVE_MODE'],
+        historyLength=PROJECT_VARS['ENV_HISTORY_LENGTH'],
+        maxSpeed=PROJECT_VARS['ENV_MAX_SPEED'],
+        damping=PROJECT_VARS['ENV_DAMPING'],
+        queryCacheSize=PROJECT_VARS['ENV_QUERY_CACHE_SIZE'],
+        queryCacheQuantum=PROJECT_VARS['ENV_QUERY_CACHE_QUANTUM'],
+    )
 
 class GlobalEnvironmentAgent(Agent):
     async def setup(self):
         self.logger = prepareDefaultLogger(loggerName=PROJECT_VARS['GLOB_ENV_LOGGER_NAME'], fileName='globalEnv.log')
 
         self.logger.info("Agent starting . . .")
+        self.surface = makeSurface()
+
         self.timebehav = GlobalEnvTimeBehaviour(
             logger=self.logger,
             loggerPrefix="Global Environment",
             envSimSpeed=PROJECT_VARS['ENV_SIM_SPEED'],
             envTicks=PROJECT_VARS['ENV_TICKS'],
             sleepType=PROJECT_VARS['ENV_SLEEP_TYPE'],
+            spinTail=PROJECT_VARS['ENV_SPIN_TAIL'],
+            timeMode=PROJECT_VARS['ENV_TIME_MODE'],
+            idleSleep=PROJECT_VARS['ENV_EVENT_IDLE_SLEEP'],
+            seed=PROJECT_VARS['ENV_SEED'],
+            surface=self.surface,
+            pipelineWorkers=PROJECT_VARS['ENV_PIPELINE_WORKERS'],
         )
-        self.add_behaviour(self.timebehav)
+        self.rng = self.timebehav.rng
+        # queries wait in the behaviour's queue until the queries stage of the next tick
+        self.add_behaviour(self.timebehav, Template(metadata=QUERY_METADATA))
+
+        self.sensors = SensorModel(rng=self.rng)
+        self.timebehav.pipeline.add('sensors', self.updateSensors, before='history')
+
+        self.queries = QueryBatcher(self.jid, logger=self.logger)
+        self.timebehav.pipeline.add('queries', self.answerQueries, before='history')
+        self.timebehav.consumesQueue = True
+
+        metrics = self.timebehav.metrics
+        metrics.counterFunc('surface_queries_total', "Surface radius, nearest and pair queries", lambda: self.surface.queryCount)
+        metrics.counterFunc('surface_moves_total', "Agent moves and position updates applied to the surface", lambda: self.surface.moveCount)
+        if(self.surface.queryCache is not None):
+            metrics.counterFunc('surface_query_cache_hits_total', "Radius queries answered from the query cache", lambda: self.surface.queryCache.hits)
+            metrics.counterFunc('surface_query_cache_misses_total', "Radius queries that had to scan the surface", lambda: self.surface.queryCache.misses)
+        metrics.counterFunc('queries_received_total', "Query messages received", lambda: self.queries.received)
+        metrics.counterFunc('queries_rejected_total', "Query messages that could not be read or were answered with an error", lambda: self.queries.rejected)
+        metrics.counterFunc('query_replies_total', "Reply messages sent, one per agent and tick", lambda: self.queries.replies)
+
+        self.checkpointer = None
+        checkpointPath = PROJECT_VARS['ENV_CHECKPOINT_PATH']
+        if(checkpointPath is not None):
+            if(PROJECT_VARS['ENV_RESTORE'] and os.path.exists(checkpointPath)):
+                self.restoreCheckpoint(checkpointPath)
+            self.checkpointer = Checkpointer(checkpointPath, logger=self.logger)
+            # the snapshot published earlier in the same tick, so only a reference changes hands
+            self.timebehav.pipeline.add('checkpoint', lambda: self.checkpointer.save(self.surface.snapshot, self.timebehav.lastSimTime), every=PROJECT_VARS['ENV_CHECKPOINT_EVERY'])
+            metrics.counterFunc('checkpoints_written_total', "Checkpoints written to disk", lambda: self.checkpointer.written)
+            metrics.counterFunc('checkpoints_skipped_total', "Checkpoints skipped while the previous one was being written", lambda: self.checkpointer.skipped)
+
+        self.recorder = None
+        if(PROJECT_VARS['ENV_RECORD_PATH'] is not None):
+            self.recorder = Recorder(PROJECT_VARS['ENV_RECORD_PATH'], chunkTicks=PROJECT_VARS['ENV_RECORD_CHUNK_TICKS'], logger=self.logger).install()
+            recordSensors = PROJECT_VARS['ENV_RECORD_SENSORS']
+            self.timebehav.pipeline.add('record', lambda: self.recorder.record(self.surface.snapshot, self.timebehav.lastSimTime, self.sensors if recordSensors else None))
+            metrics.counterFunc('record_bytes_total', "Compressed bytes appended to the tick log", lambda: self.recorder.bytesWritten)
+        self.web.add_get('/metrics', self.metricsController, None, raw=True)
+
+    def answerQueries(self) -> None:
+        """
+            Answers the queries received since the last tick from the snapshot
+            just published, the replies go out at the end of the tick.
+        """
+        self.queries.collect(self.timebehav.queue)
+        # ticks without queries do not make the surface copy its snapshot, see Surface.publish
+        if(self.queries.pending):
+            self.timebehav.outbox += self.queries.answer(self.surface.snapshot)
+
+    def updateSensors(self) -> None:
+        if(self.sensors.idToSlot):
+            self.sensors.update(self.surface.snapshot, self.timebehav.lastSimTime, self.timebehav.simDt)
+
+    async def metricsController(self, request) -> web.Response:
+        """
+            Metrics in the Prometheus text format, served once the agent's web server is started.
+        """
+        return web.Response(body=self.timebehav.metrics.exposition().encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    def restoreCheckpoint(self, path: str) -> None:
+        """
+            Loads the surface and the clocks from a checkpoint, call from setup
+            before agents are added. Agents coming back with addAgent get their
+            restored record and position, the startPos they pass is ignored.
+        """
+        start = time.perf_counter()
+        checkpoint = readCheckpoint(path)
+        self.surface.restore(checkpoint.ids, checkpoint.positions, checkpoint.mobileMask, checkpoint.velocities, checkpoint.accelerations)
+        self.timebehav.restoreClock(checkpoint.step, checkpoint.simTime)
+        self.logger.info(f"Restored {len(checkpoint.ids)} agents at step {checkpoint.step} from {path} in {(time.perf_counter() - start) * 1e+3:.1f} ms")
+
+    async def saveCheckpoint(self) -> bool:
+        """
+            Starts writing a checkpoint of the last published snapshot, False while one is still being written.
+        """
+        if(self.checkpointer is None):
+            raise Exception("Checkpoints are disabled, set ENV_CHECKPOINT_PATH")
+        return self.checkpointer.save(self.surface.snapshot, self.timebehav.lastSimTime)
 
-        self.surface = Surface()
+    def closeRecorder(self) -> None:
+        """
+            Writes the last chunk of the tick log, call after stopping the agent.
+        """
+        if(self.recorder is not None):
+            self.recorder.close()
+
+    def closeSurface(self) -> None:
+        """
+            Stops the worker processes of a sharded surface, call after stopping the agent.
+        """
+        if(isinstance(self.surface, ShardedSurface)):
+            self.surface.close()
 
     def isSetup(self):
         """
@@ -186,34 +543,144 @@ class GlobalEnvironmentAgent(Agent):
         """
         return not self.timebehav.isSetup()
 
-    async def addAgent(self, agent, typee:str, id, startPos=None) -> bool:
+    async def addAgent(self, agent, typee:str, id, startPos=None, moveF=None) -> bool:
+        if(self.surface.attachAgent(id, agent)):
+            return True
         if(typee == 'mobile'):
-            return self.surface.addMobileAgent(agent=agent, id=id, startPos=startPos)
+            return self.surface.addMobileAgent(agent=agent, id=id, startPos=startPos, moveF=moveF)
         elif(typee == 'static'):
-            return self.surface.addStaticAgent(agent=agent, id=id)
+            return self.surface.addStaticAgent(agent=agent, id=id, position=startPos)
         else:
             raise Exception(f"Unknown type: {typee}")
 
+    async def removeAgent(self, id) -> None:
+        self.surface.removeAgent(id)
+        self.sensors.removeWearer(id)
+
+    async def scheduleEvent(self, simTime: float, callback, *args) -> Event:
+        """
+            Calls callback(simTime, *args) in the environment's step at simTime,
+            see TimeBehaviour.scheduleEvent. The callback runs in the environment's
+            tick, hand work for other agents over to their own loops.
+        """
+        return self.timebehav.scheduleEvent(simTime, callback, *args)
+
+    async def scheduleEventIn(self, delay: float, callback, *args) -> Event:
+        return self.timebehav.scheduleEventIn(delay, callback, *args)
+
+    async def cancelEvent(self, event: Event) -> None:
+        self.timebehav.events.cancel(event)
+
+    async def injectAnomaly(self, id, kind: str, until: float, strength: float=1.) -> None:
+        """
+            Sensor anomaly episode of a wearer, see sensors.SensorModel.injectAnomaly.
+        """
+        self.sensors.injectAnomaly(id=id, kind=kind, until=until, strength=strength)
+
     async def getAgentPosition(self, id):
         return self.surface.getPosition(id)
 
-    async def setAgentVector(self, id, vector: np.ndarray[np.float32]) -> np.ndarray[np.float32]:
-        return self.surface.move(id=id, vector=vector)
+    async def getAgentPositionStamped(self, id) -> tuple[np.ndarray[np.float32], int, int]:
+        return self.surface.getPositionStamped(id)
+
+    async def setAgentVector(self, id, vector: np.ndarray[np.float32]) -> None:
+        """
+            The move is queued and applied together with all others at the next tick.
+        """
+        self.surface.queueMove(id=id, vector=vector)
+
+    async def setAgentVectors(self, ids, vectors: np.ndarray[np.float32]) -> None:
+        self.surface.moveMany(ids=ids, vectors=vectors)
 
     async def setAgentPosition(self, id, position: np.ndarray[np.float32]):
         return self.surface.setPosition(id=id, position=position)
 
-    async def findMobileAgents(self, position: np.ndarray[np.float32], radius: float) -> list[(id, Agent)]:
-        return self.surface.findMobileAgents(position=position, radius=radius)
+    async def setAgentPositions(self, ids, positions: np.ndarray[np.float32]) -> None:
+        self.surface.setPositions(ids=ids, positions=positions)
 
-    async def findStaticAgents(self, position: np.ndarray[np.float32], radius: float) -> list[(id, Agent)]:
-        return self.surface.findStaticAgents(position=position, radius=radius)
+    async def setAgentVelocity(self, id, velocity: np.ndarray[np.float32]) -> None:
+        self.surface.setVelocity(id=id, velocity=velocity)
 
-    async def findAgents(self, position: np.ndarray[np.float32], radius: float) -> list[(id, Agent)]:
-        return self.surface.findAgents(position=position, radius=radius)
+    async def setAgentAcceleration(self, id, acceleration: np.ndarray[np.float32]) -> None:
+        """
+            The agent keeps accelerating until this is called again, the environment
+            integrates velocities and positions of all agents every tick.
+        """
+        self.surface.setAcceleration(id=id, acceleration=acceleration)
+
+    async def setAgentAccelerations(self, ids, accelerations: np.ndarray[np.float32]) -> None:
+        self.surface.setAccelerations(ids=ids, accelerations=accelerations)
+
+    async def getAgentVelocity(self, id) -> np.ndarray[np.float32]:
+        return self.surface.getVelocity(id)
+
+    async def getAgentAcceleration(self, id) -> np.ndarray[np.float32]:
+        return self.surface.getAcceleration(id)
+
+    async def findMobileAgents(self, position: np.ndarray[np.float32], radius: float, lineOfSight: bool=False) -> list[(id, Agent)]:
+        return self.surface.findMobileAgents(position=position, radius=radius, lineOfSight=lineOfSight)
+
+    async def findStaticAgents(self, position: np.ndarray[np.float32], radius: float, lineOfSight: bool=False) -> list[(id, Agent)]:
+        return self.surface.findStaticAgents(position=position, radius=radius, lineOfSight=lineOfSight)
+
+    async def findAgents(self, position: np.ndarray[np.float32], radius: float, lineOfSight: bool=False) -> list[(id, Agent)]:
+        return self.surface.findAgents(position=position, radius=radius, lineOfSight=lineOfSight)
+
+    async def findNearest(self, position: np.ndarray[np.float32], k: int, kind: str='all') -> list[(id, Agent, float)]:
+        return self.surface.findNearest(position=position, k=k, kind=kind)
+
+    async def findNearestMany(self, positions: np.ndarray[np.float32], k: int, kind: str='all') -> tuple[np.ndarray, np.ndarray]:
+        return self.surface.findNearestMany(positions=positions, k=k, kind=kind)
+
+    async def getTrajectory(self, id, t0: float=-np.inf, t1: float=np.inf) -> np.ndarray:
+        return self.surface.getTrajectory(id=id, t0=t0, t1=t1)
+
+    async def findAgentsDuring(self, position: np.ndarray[np.float32], radius: float, t0: float, t1: float) -> np.ndarray:
+        return self.surface.findAgentsDuring(position=position, radius=radius, t0=t0, t1=t1)
+
+    async def addWatch(self, radius: float, center: np.ndarray[np.float32]=None, anchorId=None, kind: str='mobile', callback=None) -> int:
+        return self.surface.addWatch(radius=radius, center=center, anchorId=anchorId, kind=kind, callback=callback)
+
+    async def removeWatch(self, watchId: int) -> None:
+        self.surface.removeWatch(watchId)
+
+    async def findNeighbourPairs(self, radius: float, kind: str='mobile', csr: bool=False):
+        return self.surface.findNeighbourPairs(radius=radius, kind=kind, csr=csr)
+
+    async def findNeighbourPairsByRadius(self, radii: dict, kind: str='mobile', defaultRadius: float=0., csr: bool=False):
+        return self.surface.findNeighbourPairsByRadius(radii=radii, kind=kind, defaultRadius=defaultRadius, csr=csr)
+
+class LocalEnvironmentAPI():
+    """
+        Getters offered to a wearable agent by its local environment, shared by
+        LocalEnvironment and the environments of a LocalEnvironmentHost.
+        Subclasses provide _position and _sensor.
+
+        The sensor getters return read-through views updated in place every
+        tick, copy them to keep a reading. Temperature and pulse are 0-d arrays,
+        blood pressure is (systolic, diastolic).
+    """
+    async def getPosition(self) -> np.ndarray[np.float32]:
+        return self._position()
+
+    async def getTemperature(self) -> np.ndarray[np.float32]:
+        return self._sensor('temperature')
+
+    async def getPulse(self) -> np.ndarray[np.float32]:
+        return self._sensor('pulse')
+
+    async def getBloodPressure(self) -> np.ndarray[np.float32]:
+        return self._sensor('bloodPressure')
+
+    async def getAcceleration(self) -> np.ndarray[np.float32]:
+        return self._sensor('acceleration')
+
+class LocalEnvironment(LocalEnvironmentAPI, Agent):
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.globalEnv = None
+        self.agentId = None
 
-class LocalEnvironment(Agent):
-        
     async def setup(self) -> None:
         self.logger = prepareDefaultLogger(loggerName=PROJECT_VARS['LOCAL_ENV_LOGGER_NAME'], fileName=f'localEnv.{self.name}.log')
 
@@ -224,9 +691,37 @@ class LocalEnvironment(Agent):
             envSimSpeed=PROJECT_VARS['ENV_SIM_SPEED'],
             envTicks=PROJECT_VARS['ENV_TICKS'],
             sleepType=PROJECT_VARS['ENV_SLEEP_TYPE'],
+            spinTail=PROJECT_VARS['ENV_SPIN_TAIL'],
+            timeMode=PROJECT_VARS['ENV_TIME_MODE'],
+            idleSleep=PROJECT_VARS['ENV_EVENT_IDLE_SLEEP'],
+            # every local environment draws from its own stream derived from the seed
+            seed=None if PROJECT_VARS['ENV_SEED'] is None else (PROJECT_VARS['ENV_SEED'], zlib.crc32(self.name.encode())),
         )
+        self.rng = self.timebehav.rng
         self.add_behaviour(self.timebehav)
 
+    def bind(self, globalEnv: GlobalEnvironmentAgent, id) -> None:
+        """
+            Attaches the local environment to the agent id of the global environment,
+            its getters read from there. The agent becomes a wearer of the global
+            sensor model, which synthesizes the readings of all wearers every tick.
+        """
+        self.globalEnv = globalEnv
+        self.agentId = id
+        globalEnv.sensors.addWearer(id)
+
+    def _checkBound(self) -> None:
+        if(self.globalEnv is None):
+            raise Exception(f"Local environment {self.name} is not bound to an agent")
+
+    def _position(self) -> np.ndarray[np.float32]:
+        self._checkBound()
+        return self.globalEnv.surface.getPosition(self.agentId)
+
+    def _sensor(self, signal: str) -> np.ndarray[np.float32]:
+        self._checkBound()
+        return self.globalEnv.sensors.view(self.agentId, signal)
+
     def isSetup(self):
         """
             Check if the setup of the environment behaviour is done.
@@ -237,27 +732,140 @@ class LocalEnvironment(Agent):
         """
         return not self.timebehav.isSetup()
 
-    async def getPosition(self) -> np.ndarray[np.float32]:
-        pass
+class HostedLocalEnvironment(LocalEnvironmentAPI):
+    """
+        Local environment of one wearer living inside a LocalEnvironmentHost.
+    """
+    def __init__(self, host: 'LocalEnvironmentHost', id) -> None:
+        self.host = host
+        self.agentId = id
+        self.name = f"{host.name}/{id}"
 
-    async def getTemperature(self) -> float:
-        pass
+    def _position(self) -> np.ndarray[np.float32]:
+        return self.host.position(self.agentId)
 
-    async def getPulse(self) -> float:
-        pass
+    def _sensor(self, signal: str) -> np.ndarray[np.float32]:
+        return self.host.globalEnv.sensors.view(self.agentId, signal)
 
-    async def getBloodPressure(self) -> float:
-        pass
+    def isSetup(self):
+        return self.host.isSetup()
+
+class LocalEnvironmentHost(Agent):
+    """
+        One agent with a single tick and log serving the local environments of
+        many wearers. attach(id) returns the HostedLocalEnvironment of a wearer,
+        which offers the same getters as LocalEnvironment. Every tick the host
+        copies the positions of all its wearers from the published snapshot of
+        the global environment into one array, so getPosition is a view as well
+        and is valid until the host grows past its capacity.
+    """
+    def __init__(self, *args, capacity: int=64, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.globalEnv = None
+        self.environments = {}
+        self.idToSlot = {}
+        capacity = max(int(capacity), 1)
+        self.positions = np.zeros((capacity, 2), dtype=np.float32)
+        self.slotIds = np.empty(capacity, dtype=object)
+        self.freeSlots = list(range(capacity - 1, -1, -1))
+        self._rows = None
+        self._rowsKey = None
 
-    async def getAcceleration(self) -> np.ndarray[np.float32]:
-        pass
+    async def setup(self) -> None:
+        self.logger = prepareDefaultLogger(loggerName=PROJECT_VARS['LOCAL_ENV_LOGGER_NAME'], fileName=f'localEnvHost.{self.name}.log')
+
+        self.logger.info(f"Agent {self.name} starting . . .")
+        self.timebehav = GlobalEnvTimeBehaviour(
+            logger=self.logger,
+            loggerPrefix=f"Local Environment host {self.name}",
+            envSimSpeed=PROJECT_VARS['ENV_SIM_SPEED'],
+            envTicks=PROJECT_VARS['ENV_TICKS'],
+            sleepType=PROJECT_VARS['ENV_SLEEP_TYPE'],
+            spinTail=PROJECT_VARS['ENV_SPIN_TAIL'],
+            timeMode=PROJECT_VARS['ENV_TIME_MODE'],
+            idleSleep=PROJECT_VARS['ENV_EVENT_IDLE_SLEEP'],
+            seed=None if PROJECT_VARS['ENV_SEED'] is None else (PROJECT_VARS['ENV_SEED'], zlib.crc32(self.name.encode())),
+        )
+        self.timebehav.pipeline.add('positions', self._gatherPositions)
+        self.rng = self.timebehav.rng
+        self.add_behaviour(self.timebehav)
+
+    def bind(self, globalEnv: GlobalEnvironmentAgent) -> None:
+        """
+            In 'EVENT' mode the host has no events of its own, the global
+            environment gathers the positions at each of its steps instead.
+        """
+        self.globalEnv = globalEnv
+        if(globalEnv.timebehav.timeMode == 'EVENT'):
+            globalEnv.timebehav.pipeline.add(f'positions:{self.name}', self._gatherPositions)
+
+    def isSetup(self):
+        """
+            Same as LocalEnvironment.isSetup.
+        """
+        return not self.timebehav.isSetup()
+
+    def attach(self, id) -> HostedLocalEnvironment:
+        """
+            Local environment of the agent id of the global environment, which becomes a wearer.
+        """
+        if(self.globalEnv is None):
+            raise Exception(f"Local environment host {self.name} is not bound to a global environment")
+        environment = self.environments.get(id)
+        if(environment is not None):
+            return environment
+        if(not self.freeSlots):
+            old = self.positions.shape[0]
+            positions = np.zeros((old * 2, 2), dtype=np.float32)
+            positions[:old] = self.positions
+            slotIds = np.empty(old * 2, dtype=object)
+            slotIds[:old] = self.slotIds
+            self.positions, self.slotIds = positions, slotIds
+            self.freeSlots = list(range(old * 2 - 1, old - 1, -1))
+        slot = self.freeSlots.pop()
+        self.idToSlot[id] = slot
+        self.slotIds[slot] = id
+        self.positions[slot] = self.globalEnv.surface.getPosition(id)
+        self._rowsKey = None
+        self.globalEnv.sensors.addWearer(id)
+        environment = HostedLocalEnvironment(self, id)
+        self.environments[id] = environment
+        return environment
+
+    def detach(self, id) -> None:
+        slot = self.idToSlot.pop(id, None)
+        if(slot is None):
+            return
+        del self.environments[id]
+        self.slotIds[slot] = None
+        self.freeSlots.append(slot)
+        self._rowsKey = None
+        self.globalEnv.sensors.removeWearer(id)
+
+    def environment(self, id) -> HostedLocalEnvironment:
+        return self.environments[id]
+
+    def position(self, id) -> np.ndarray[np.float32]:
+        return self.positions[self.idToSlot[id]]
+
+    def _gatherPositions(self) -> None:
+        if(self.globalEnv is None or not self.idToSlot):
+            return
+        snapshot = self.globalEnv.surface.snapshot
+        if(self._rowsKey is not snapshot.idToRow):
+            self._rows = np.fromiter((snapshot.idToRow.get(id, -1) if id is not None else -1 for id in self.slotIds), dtype=np.int64, count=self.slotIds.shape[0])
+            self._rowsKey = snapshot.idToRow
+        present = self._rows >= 0
+        self.positions[present] = snapshot.positions[self._rows[present]]
 
 if __name__ == "__main__":
     envAgent = GlobalEnvironmentAgent(
         PROJECT_VARS['ENV_AGENT_NAME'] + '@' + PROJECT_VARS['SERVER'], 
         PROJECT_VARS['ENV_PASSW']
     )
-    future = envAgent.start()
+    if(PROJECT_VARS['LOOPBACK']):
+        LoopbackServer().install()
+    future = startAgent(envAgent)
     future.result()
     
     while envAgent.isSetup():
@@ -269,12 +877,15 @@ if __name__ == "__main__":
             runtime = envAgent.get(ENV_TIME_RUNTIME_SECONDS)
             fps = envAgent.get('fps')
             counter = envAgent.get('stepCounter')
-            print(f'Env runtime: {runtime} \t SimulatedSec: {simSec} \t fps: {fps} \t counter: {counter}')
+            simPerWall = envAgent.get(ENV_TIME_SIM_PER_WALL)
+            print(f'Env runtime: {runtime} \t SimulatedSec: {simSec} \t SimPerWallSec: {simPerWall} \t fps: {fps} \t counter: {counter}')
             if(runtime >= ENV_TEST_END_SECONDS):
                 break
             time.sleep(1)
     except KeyboardInterrupt:
         print("Stopping...")
-    envAgent.stop()
+    stopAgent(envAgent)
+    envAgent.closeRecorder()
+    envAgent.closeSurface()
     
     quit_spade()
\ No newline at end of file
@@ -0,0 +1,103 @@
+import heapq
+import itertools
+import threading as th
+
+
+class Event():
+    """
+        Callback due at the simulated time `time`, called as fn(time, *args).
+        seq orders events due at the same time by scheduling order.
+    """
+    __slots__ = ('time', 'seq', 'fn', 'args', 'cancelled', 'popped')
+
+    def __init__(self, time: float, seq: int, fn, args: tuple) -> None:
+        self.time = time
+        self.seq = seq
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+        self.popped = False
+
+    def __lt__(self, other: 'Event') -> bool:
+        return (self.time, self.seq) < (other.time, other.seq)
+
+class EventQueue():
+    """
+        Binary heap of events ordered by simulated time. Cancelled events stay
+        in the heap and are skipped when they come up, so cancel() is O(1).
+        Events may be scheduled from any thread, they are run by the thread
+        calling runDue, which is the environment's tick.
+    """
+    def __init__(self) -> None:
+        self.heap = []
+        self.lock = th.Lock()
+        self._seq = itertools.count()
+        self.scheduled = 0
+        self.fired = 0
+        self.cancelledCount = 0
+
+    def __len__(self) -> int:
+        return len(self.heap) - self.cancelledCount
+
+    def schedule(self, time: float, fn, *args) -> Event:
+        self.lock.acquire()
+        event = Event(float(time), next(self._seq), fn, args)
+        heapq.heappush(self.heap, event)
+        self.scheduled += 1
+        self.lock.release()
+        return event
+
+    def cancel(self, event: Event) -> None:
+        self.lock.acquire()
+        if(not event.cancelled):
+            event.cancelled = True
+            # popped events are no longer counted in the heap
+            if(not event.popped):
+                self.cancelledCount += 1
+        self.lock.release()
+
+    def _dropCancelled(self) -> None:
+        """
+            Pops cancelled events off the top. Expects the lock to be held.
+        """
+        while(self.heap and self.heap[0].cancelled):
+            heapq.heappop(self.heap)
+            self.cancelledCount -= 1
+
+    def peek(self) -> float:
+        """
+            Time of the next event, None when nothing is scheduled.
+        """
+        self.lock.acquire()
+        self._dropCancelled()
+        time = self.heap[0].time if self.heap else None
+        self.lock.release()
+        return time
+
+    def runDue(self, time: float) -> int:
+        """
+            Runs the events due at or before time in time order. The due events
+            are taken off the heap first, so events the callbacks schedule at or
+            before time wait for the next call and an event rescheduling itself
+            at the same time can not stall the tick.
+            Returns the number of events run.
+        """
+        self.lock.acquire()
+        due = []
+        while(True):
+            self._dropCancelled()
+            if(not self.heap or self.heap[0].time > time):
+                break
+            event = heapq.heappop(self.heap)
+            event.popped = True
+            due.append(event)
+        self.lock.release()
+        fired = 0
+        for event in due:
+            # cancelled by an earlier callback of the same batch
+            if(event.cancelled):
+                continue
+            event.fn(event.time, *event.args)
+            fired += 1
+        self.fired += fired
+        return fired
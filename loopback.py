@@ -0,0 +1,124 @@
+import asyncio
+import logging
+from defaults import PROJECT_VARS
+from sendhooks import addSendHook, removeSendHook
+
+_server = None
+
+def activeServer() -> 'LoopbackServer':
+    return _server
+
+def startAgent(agent):
+    """
+        agent.start() or, with an installed LoopbackServer, its XMPP-less equivalent.
+    """
+    if(_server is not None):
+        return _server.start(agent)
+    return agent.start()
+
+def stopAgent(agent):
+    if(_server is not None and _server.isRegistered(agent.jid)):
+        return _server.stop(agent)
+    return agent.stop()
+
+def _bare(jid) -> str:
+    return str(jid).split('/')[0]
+
+class LoopbackServer():
+    """
+        In-memory stand-in for the XMPP server for agents sharing one process.
+        Once installed, a send hook hands messages addressed to a
+        registered agent straight to the queues of its matching behaviours,
+        the Message object itself is delivered, nothing is serialized, so
+        neither side should modify a message after sending or receiving it.
+
+        Agents started with start() never connect to XMPP, messages they send
+        to agents the server does not know are dropped. Agents started the usual
+        way can be added with register() to reach the others through the loopback.
+    """
+    def __init__(self) -> None:
+        self.agents = {}
+        self.delivered = 0
+        self.unmatched = 0
+        self.dropped = 0
+        self._offline = set()
+        self.logger = logging.getLogger(PROJECT_VARS['LOOPBACK_LOGGER_NAME'])
+
+    def install(self) -> 'LoopbackServer':
+        global _server
+        if(_server is not None):
+            _server.uninstall()
+        _server = self
+        addSendHook(self.deliver)
+        return self
+
+    def uninstall(self) -> None:
+        global _server
+        if(_server is self):
+            _server = None
+            removeSendHook(self.deliver)
+
+    def register(self, agent) -> None:
+        self.agents[_bare(agent.jid)] = agent
+
+    def unregister(self, jid) -> None:
+        self.agents.pop(_bare(jid), None)
+        self._offline.discard(_bare(jid))
+
+    def isRegistered(self, jid) -> bool:
+        return _bare(jid) in self.agents
+
+    def start(self, agent):
+        """
+            Runs what Agent.start does apart from connecting to the XMPP server:
+            setup() and then the behaviours. Returns a future like Agent.start.
+        """
+        self.register(agent)
+        self._offline.add(_bare(agent.jid))
+        return asyncio.run_coroutine_threadsafe(self._start(agent), agent.loop)
+
+    async def _start(self, agent) -> None:
+        await agent.setup()
+        agent._alive.set()
+        for behaviour in agent.behaviours:
+            if(not behaviour.is_running):
+                behaviour.start()
+
+    def stop(self, agent) -> None:
+        for behaviour in agent.behaviours:
+            behaviour.kill()
+        agent._alive.clear()
+        self.unregister(agent.jid)
+
+    def deliver(self, msg) -> bool:
+        """
+            Whether the loopback took care of the message, if not it has to go through XMPP.
+        """
+        receiver = self.agents.get(_bare(msg.to))
+        if(receiver is None):
+            if(_bare(msg.sender) in self._offline):
+                self.dropped += 1
+                self.logger.warning(f"Dropped message from {msg.sender} to unknown agent {msg.to}")
+                return True
+            return False
+        matched = False
+        for behaviour in receiver.behaviours:
+            if(behaviour.queue is not None and behaviour.match(msg)):
+                self._put(receiver, behaviour, msg)
+                matched = True
+        if(matched):
+            self.delivered += 1
+        else:
+            self.unmatched += 1
+            self.logger.warning(f"No behaviour of {msg.to} matched message from {msg.sender}")
+        return True
+
+    def _put(self, agent, behaviour, msg) -> None:
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if(running is agent.loop):
+            behaviour.queue.put_nowait(msg)
+        else:
+            agent.loop.call_soon_threadsafe(behaviour.queue.put_nowait, msg)
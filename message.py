@@ -24,10 +24,17 @@ class Message():
         BROADCAST: int = 1
         INFORM: int = 2
         DANGER: int = 3
+        QUERY: int = 4
+        REPLY: int = 5
 
     class DangerType(Enum):
         BASIC = 1
 
+    class QueryType(int, Enum):
+        POSITION: int = 1 # position of agentId
+        FIND_AGENTS: int = 2 # agents of agentKind closer than radius to position
+        FIND_NEAREST: int = 3 # k agents of agentKind nearest to position
+
     MESSAGE_TYPE = 'msgtype'
     DISTANCE = 'dst'
     POSITION = 'pos'
@@ -39,6 +46,14 @@ class Message():
     SENDER = 'sender'
     RECEIVER = 'receiver'
     ID = 'ID'
+    QUERY_TYPE = 'qtype'
+    AGENT_ID = 'aid'
+    AGENT_IDS = 'aids'
+    AGENT_KIND = 'akind'
+    RADIUS = 'rad'
+    K = 'k'
+    RESULTS = 'res'
+    ERROR = 'err'
 
     def __init__(self, sender, receiver) -> None:
         self._clear()
@@ -63,6 +78,11 @@ class Message():
         self.dangerType = None
         self.urgency = None
         self.additionalInfo = None
+        self.queryType = None
+        self.agentKind = None
+        self.radius = None
+        self.k = None
+        self.results = None
 
     def _strMsgType(self) -> str:
         string = Message.MESSAGE_TYPE
@@ -75,6 +95,10 @@ class Message():
                 string += '::INFORM\n'
             case Message.Type.DANGER:
                 string += '::DANGER\n'
+            case Message.Type.QUERY:
+                string += '::QUERY\n'
+            case Message.Type.REPLY:
+                string += '::REPLY\n'
             case _:
                 string += '::ERROR_UNKNOWN_TYPE\n'
         return string
@@ -96,6 +120,14 @@ class Message():
         ret += self._strTemplate(Message.DISTANCE, self.distance)
         ret += self._strTemplate(Message.POSITION, self.position)
         ret += self._strTemplate(Message.ADDITIONAL_INFO, self.additionalInfo)
+        if(self.queryType is not None):
+            ret += self._strTemplate(Message.QUERY_TYPE, self.queryType)
+            ret += self._strTemplate(Message.AGENT_ID, self.agentId)
+            ret += self._strTemplate(Message.AGENT_KIND, self.agentKind)
+            ret += self._strTemplate(Message.RADIUS, self.radius)
+            ret += self._strTemplate(Message.K, self.k)
+        if(self.results is not None):
+            ret += self._strTemplate(Message.RESULTS, len(self.results))
         return ret
 
     def _checkMsgForDanger(self) -> bool:
@@ -116,8 +148,29 @@ class Message():
             return False
         return True
 
+    def _checkMsgForQuery(self) -> bool:
+        if(self.messageType != Message.Type.QUERY or self.queryType is None):
+            return False
+        match self.queryType:
+            case Message.QueryType.POSITION:
+                return self.agentId is not None
+            case Message.QueryType.FIND_AGENTS:
+                return self.position is not None and self.radius is not None
+            case Message.QueryType.FIND_NEAREST:
+                return self.position is not None and self.k is not None
+        return False
+
+    def _checkMsgForReply(self) -> bool:
+        if(self.messageType != Message.Type.REPLY or self.results is None):
+            return False
+        return True
+
     def checkMessage(self, msgType) -> bool:
         match msgType:
+            case Message.Type.QUERY:
+                return self._checkMsgForQuery()
+            case Message.Type.REPLY:
+                return self._checkMsgForReply()
             case Message.Type.BROADCAST:
                 return self._checkMsgForBroadcast()
             case Message.Type.INFORM:
@@ -152,6 +205,14 @@ class Message():
             self._dump(msg, Message.URGENCY, self.urgency)
         elif(self.checkMessage(Message.Type.DANGER)):
             self._dump(msg, Message.URGENCY, self.urgency)
+        elif(self.checkMessage(Message.Type.QUERY)):
+            self._dump(msg, Message.QUERY_TYPE, self.queryType)
+            self._dump(msg, Message.AGENT_ID, self.agentId)
+            self._dump(msg, Message.AGENT_KIND, self.agentKind)
+            self._dump(msg, Message.RADIUS, self.radius)
+            self._dump(msg, Message.K, self.k)
+        elif(self.checkMessage(Message.Type.REPLY)):
+            self._dump(msg, Message.RESULTS, self.results)
         else:
             if(logger is not None):
                 logger.info(f'Message {self.msgId} could not be compiled. {self._strLogInfo()}')
@@ -202,6 +263,18 @@ class Message():
                     self.urgency = value
                 case Message.ADDITIONAL_INFO:
                     self.additionalInfo = value
+                case Message.QUERY_TYPE:
+                    self.queryType = Message.QueryType(value)
+                case Message.AGENT_ID:
+                    self.agentId = value
+                case Message.AGENT_KIND:
+                    self.agentKind = value
+                case Message.RADIUS:
+                    self.radius = float(value)
+                case Message.K:
+                    self.k = int(value)
+                case Message.RESULTS:
+                    self.results = value
                 case Message.ID:
                     id = value
                 case Message.SENDER:
@@ -0,0 +1,132 @@
+import math
+from math import frexp
+
+
+class Counter():
+    def __init__(self, name: str, help: str) -> None:
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount: int=1) -> None:
+        self.value += amount
+
+    def exposition(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter", f"{self.name} {self.value}"]
+
+class CounterFunc(Counter):
+    """
+        Counter whose value is read from fn() at export time, for counts kept
+        as plain attributes of other objects so the hot path only adds to an int.
+    """
+    def __init__(self, name: str, help: str, fn) -> None:
+        super().__init__(name, help)
+        self.fn = fn
+
+    def exposition(self) -> list[str]:
+        self.value = self.fn()
+        return super().exposition()
+
+class Histogram():
+    """
+        Log-linear histogram in the spirit of HDR histograms: every power of two
+        between lowest and highest is split into subBuckets equal buckets, so
+        the relative error of a recorded value is below 1 / subBuckets and
+        recording is one frexp and a list increment. Bucket 0 counts values
+        under lowest and the last bucket values over highest.
+    """
+    def __init__(self, name: str, help: str, lowest: float=1e-6, highest: float=10., subBuckets: int=16) -> None:
+        self.name = name
+        self.help = help
+        self.lowest = lowest
+        self.subBuckets = subBuckets
+        self.octaves = max(int(math.ceil(math.log2(highest / lowest))), 1)
+        self.counts = [0] * (self.octaves * subBuckets + 2)
+        self.sum = 0.
+        self.count = 0
+        self._scale = 1. / lowest
+        self._twoSub = 2 * subBuckets
+        self._offset = 1 - 2 * subBuckets
+
+    def record(self, value: float) -> None:
+        self.sum += value
+        self.count += 1
+        # value / lowest = mantissa * 2 ** exponent with mantissa in [0.5, 1),
+        # exponent e lands in octave e - 1, bucket 1 + (e - 1) * sub + int((mantissa - 0.5) * 2 * sub)
+        mantissa, exponent = frexp(value * self._scale)
+        if(0 < exponent <= self.octaves):
+            self.counts[int(mantissa * self._twoSub) + exponent * self.subBuckets + self._offset] += 1
+        else:
+            self.counts[0 if exponent <= 0 else -1] += 1
+
+    def _upper(self, index: int) -> float:
+        """
+            Upper bound of bucket index.
+        """
+        if(index == 0):
+            return self.lowest
+        if(index > self.octaves * self.subBuckets):
+            return math.inf
+        octave, sub = divmod(index - 1, self.subBuckets)
+        return self.lowest * 2. ** octave * (1. + (sub + 1) / self.subBuckets)
+
+    def percentile(self, q: float) -> float:
+        """
+            Upper bound of the bucket holding the q-th percentile, 0 when nothing was recorded.
+        """
+        if(self.count == 0):
+            return 0.
+        rank = max(math.ceil(self.count * q / 100.), 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if(seen >= rank):
+                return self._upper(index)
+        return math.inf
+
+    def exposition(self) -> list[str]:
+        """
+            Exported with one cumulative bucket per power of two to keep scrapes small.
+        """
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = sum(self.counts[:1])
+        lines.append(f'{self.name}_bucket{{le="{self.lowest:.9g}"}} {cumulative}')
+        for octave in range(self.octaves):
+            start = octave * self.subBuckets + 1
+            cumulative += sum(self.counts[start:start + self.subBuckets])
+            lines.append(f'{self.name}_bucket{{le="{self.lowest * 2. ** (octave + 1):.9g}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.sum:.9g}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+class MetricsRegistry():
+    """
+        Named metrics of one agent, exported in the Prometheus text format.
+    """
+    def __init__(self, prefix: str='') -> None:
+        self.prefix = prefix
+        self.metrics = {}
+
+    def _get(self, name: str, factory):
+        name = self.prefix + name
+        metric = self.metrics.get(name)
+        if(metric is None):
+            metric = factory(name)
+            self.metrics[name] = metric
+        return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._get(name, lambda name: Counter(name, help))
+
+    def counterFunc(self, name: str, help: str, fn) -> CounterFunc:
+        return self._get(name, lambda name: CounterFunc(name, help, fn))
+
+    def histogram(self, name: str, help: str, lowest: float=1e-6, highest: float=10., subBuckets: int=16) -> Histogram:
+        return self._get(name, lambda name: Histogram(name, help, lowest=lowest, highest=highest, subBuckets=subBuckets))
+
+    def exposition(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines += metric.exposition()
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,99 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Stage():
+    """
+        One named step of the tick. fn() runs every `every` ticks, lastTime and
+        meanTime are its duration in seconds at the last run and averaged
+        exponentially over the previous runs.
+    """
+    def __init__(self, name: str, fn, every: int=1, parallel: bool=False) -> None:
+        if(every < 1):
+            raise Exception(f"Stage {name} has to run at least every tick, got every: {every}")
+        self.name = name
+        self.fn = fn
+        self.every = int(every)
+        self.parallel = parallel
+        self.lastTime = 0.
+        self.meanTime = 0.
+        self.runs = 0
+
+    def __call__(self) -> None:
+        start = time.perf_counter_ns()
+        self.fn()
+        self._record((time.perf_counter_ns() - start) * 1e-9)
+
+    def _record(self, seconds: float) -> None:
+        self.lastTime = seconds
+        self.meanTime = seconds if self.runs == 0 else self.meanTime + TickPipeline.SMOOTHING * (seconds - self.meanTime)
+        self.runs += 1
+
+class TickPipeline():
+    """
+        Stages run in the order they were added. Consecutive stages added with
+        parallel=True form a batch that runs concurrently on the thread pool,
+        so only mark stages parallel when they share no state, with workers=0
+        they run one after another. Stages skipped at a tick keep their timings.
+    """
+    SMOOTHING = 0.1
+
+    def __init__(self, workers: int=0) -> None:
+        self.stages = []
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tick-stage') if workers > 0 else None
+        self.lastTime = 0.
+
+    def add(self, name: str, fn, every: int=1, parallel: bool=False, before: str=None) -> Stage:
+        """
+            Appends the stage, or inserts it in front of the stage named before.
+        """
+        if(any(stage.name == name for stage in self.stages)):
+            raise Exception(f"Stage {name} already exists")
+        stage = Stage(name, fn, every=every, parallel=parallel)
+        if(before is None):
+            self.stages.append(stage)
+        else:
+            self.stages.insert(self._index(before), stage)
+        return stage
+
+    def remove(self, name: str) -> None:
+        del self.stages[self._index(name)]
+
+    def _index(self, name: str) -> int:
+        for i, stage in enumerate(self.stages):
+            if(stage.name == name):
+                return i
+        raise Exception(f"Unknown stage: {name}")
+
+    def _batches(self, tick: int) -> list[list[Stage]]:
+        batches = []
+        for stage in self.stages:
+            if(tick % stage.every != 0):
+                continue
+            if(stage.parallel and batches and batches[-1][0].parallel):
+                batches[-1].append(stage)
+            else:
+                batches.append([stage])
+        return batches
+
+    def run(self, tick: int) -> None:
+        start = time.perf_counter_ns()
+        for batch in self._batches(tick):
+            if(len(batch) == 1 or self.pool is None):
+                for stage in batch:
+                    stage()
+            else:
+                for future in [self.pool.submit(stage) for stage in batch]:
+                    future.result()
+        self.lastTime = (time.perf_counter_ns() - start) * 1e-9
+
+    def timings(self) -> dict[str, tuple[float, float]]:
+        """
+            name -> (last, mean) duration of every stage in milliseconds.
+        """
+        return {stage.name: (stage.lastTime * 1e+3, stage.meanTime * 1e+3) for stage in self.stages}
+
+    def close(self) -> None:
+        if(self.pool is not None):
+            self.pool.shutdown(wait=True)
+            self.pool = None
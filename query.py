@@ -0,0 +1,206 @@
+import json
+import logging
+import math
+import uuid
+import numpy as np
+from spade.message import Message as SpadeMessage
+from message import Message
+from spatial import radiusQueryMany
+from surface import kindMask
+
+# metadata of the spade messages carrying queries to the environment and replies back
+QUERY_METADATA = {'performative': 'query-ref', 'ontology': 'environment'}
+REPLY_METADATA = {'performative': 'inform', 'ontology': 'environment'}
+
+def _bare(jid) -> str:
+    return str(jid).split('/')[0]
+
+def makeQuery(sender, envJid, queryType: Message.QueryType, agentId=None, position=None, radius: float=None, k: int=None, agentKind: str='all') -> tuple[str, SpadeMessage]:
+    """
+        Query message to send to the environment and the id its result is
+        returned under, see readReply.
+    """
+    msg = Message(_bare(sender), _bare(envJid))
+    msg.messageType = Message.Type.QUERY
+    msg.queryType = Message.QueryType(queryType)
+    msg.agentId = agentId
+    msg.position = None if position is None else np.asarray(position, dtype=np.float32)
+    msg.radius = radius
+    msg.k = k
+    msg.agentKind = agentKind
+    # message ids come from the clock, queries made within the same nanosecond would share one
+    msg.msgId = uuid.uuid4().hex
+    queryId = msg.msgId
+    body = msg.dump()
+    if(body is None):
+        raise Exception(f"Incomplete {Message.QueryType(queryType).name} query")
+    return queryId, SpadeMessage(to=_bare(envJid), body=body, metadata=dict(QUERY_METADATA))
+
+def readReply(msg: SpadeMessage, receiver) -> dict:
+    """
+        Results of a reply by query id. A result holds the position for
+        POSITION queries, the agent ids and distances for FIND_AGENTS and
+        FIND_NEAREST queries, or the error of a query that failed.
+    """
+    reply = Message(_bare(msg.sender), _bare(receiver))
+    reply.loadd(json.loads(msg.body))
+    if(not reply.checkMessage(Message.Type.REPLY)):
+        return {}
+    return {result[Message.ID]: result for result in reply.results}
+
+class QueryBatcher():
+    """
+        Environment side of the query protocol. collect() takes the query
+        messages received since the last tick, answer() computes all of them
+        at once on the published snapshot, one vectorized pass per query type
+        and agent kind, and returns one reply per requesting agent carrying
+        the results of all its queries of the tick.
+    """
+    def __init__(self, jid, logger: logging.Logger=None) -> None:
+        self.jid = _bare(jid)
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.pending = []
+        self.received = 0
+        self.rejected = 0
+        self.replies = 0
+
+    def collect(self, queue) -> int:
+        """
+            Drains the asyncio queue of the behaviour the queries are delivered to.
+        """
+        count = 0
+        while(not queue.empty()):
+            self.submit(queue.get_nowait())
+            count += 1
+        return count
+
+    def submit(self, msg: SpadeMessage) -> None:
+        self.received += 1
+        try:
+            content = json.loads(msg.body)
+            # loadd rejects queries whose payload names another sender than the transport
+            query = Message(_bare(msg.sender), self.jid)
+            query.loadd(content)
+        except Exception as e:
+            self.rejected += 1
+            self.logger.warning(f"Unreadable query from {msg.sender}: {e}")
+            return
+        if(not query.checkMessage(Message.Type.QUERY)):
+            self.rejected += 1
+            self.logger.warning(f"Invalid query from {msg.sender}")
+            return
+        error = self._validate(query)
+        if(error is not None):
+            # answered with the error instead of being computed, see answer
+            self.rejected += 1
+            self.logger.warning(f"Rejected query from {msg.sender}: {error}")
+        self.pending.append((str(msg.sender), content.get(Message.ID), query, error))
+
+    @staticmethod
+    def _validate(query: Message) -> str:
+        """
+            Why a readable query can not be answered, None if it can.
+        """
+        if(query.agentKind is not None and query.agentKind not in ('all', 'mobile', 'static')):
+            return f"Unknown agent kind: {query.agentKind}"
+        if(query.queryType == Message.QueryType.POSITION):
+            try:
+                hash(query.agentId)
+            except TypeError:
+                return f"Agent id has to be hashable, got: {type(query.agentId).__name__}"
+            return None
+        position = query.position
+        if(position.shape != (2,) or not np.issubdtype(position.dtype, np.number) or not np.isfinite(position).all()):
+            return f"Position has to be two finite numbers, got: {position.tolist()}"
+        if(query.queryType == Message.QueryType.FIND_AGENTS and not (math.isfinite(query.radius) and query.radius > 0.)):
+            return f"Radius has to be positive, got: {query.radius}"
+        if(query.queryType == Message.QueryType.FIND_NEAREST and query.k < 1):
+            return f"k has to be positive, got: {query.k}"
+        return None
+
+    def answer(self, snapshot) -> list[SpadeMessage]:
+        pending, self.pending = self.pending, []
+        if(not pending):
+            return []
+        results = [None] * len(pending)
+        byType = {}
+        for index, (_, queryId, query, error) in enumerate(pending):
+            if(error is not None):
+                results[index] = {Message.ERROR: error, Message.ID: queryId}
+            else:
+                byType.setdefault(query.queryType, []).append(index)
+        for queryType, indices in byType.items():
+            queries = [pending[index][2] for index in indices]
+            if(queryType == Message.QueryType.POSITION):
+                answers = self._guarded(self._positions, snapshot, queries)
+            else:
+                answers = [None] * len(queries)
+                # one pass per agent kind, the kinds select different rows
+                byKind = {}
+                for i, query in enumerate(queries):
+                    byKind.setdefault(query.agentKind or 'all', []).append(i)
+                for kind, group in byKind.items():
+                    rows = np.flatnonzero(kindMask(snapshot.mobileMask, kind))
+                    method = self._findAgents if queryType == Message.QueryType.FIND_AGENTS else self._findNearest
+                    for i, answer in zip(group, self._guarded(method, snapshot, [queries[i] for i in group], rows)):
+                        answers[i] = answer
+            for index, answer in zip(indices, answers):
+                answer[Message.ID] = pending[index][1]
+                results[index] = answer
+
+        grouped = {}
+        for (sender, *_), result in zip(pending, results):
+            grouped.setdefault(sender, []).append(result)
+        replies = []
+        for sender, senderResults in grouped.items():
+            reply = Message(self.jid, _bare(sender))
+            reply.messageType = Message.Type.REPLY
+            reply.results = senderResults
+            replies.append(SpadeMessage(to=sender, sender=self.jid, body=reply.dump(), metadata=dict(REPLY_METADATA)))
+        self.replies += len(replies)
+        return replies
+
+    def _guarded(self, method, snapshot, queries: list[Message], *args) -> list[dict]:
+        """
+            Answers of method for all queries at once. If the batch fails the
+            queries are answered one by one, so a query that slipped through
+            _validate only fails itself and not the whole tick.
+        """
+        try:
+            return method(snapshot, *args, queries)
+        except Exception as e:
+            self.logger.warning(f"Batched {method.__name__} queries failed, answering them one by one: {e}")
+        answers = []
+        for query in queries:
+            try:
+                answers += method(snapshot, *args, [query])
+            except Exception as e:
+                answers.append({Message.ERROR: str(e)})
+        return answers
+
+    def _positions(self, snapshot, queries: list[Message]) -> list[dict]:
+        rows = np.fromiter((snapshot.idToRow.get(query.agentId, -1) for query in queries), dtype=np.int64, count=len(queries))
+        positions = snapshot.positions[np.maximum(rows, 0)].tolist() if len(snapshot.positions) else [None] * len(queries)
+        return [{Message.POSITION: position} if row >= 0 else {Message.ERROR: f"Unknown agent: {query.agentId}"} for query, row, position in zip(queries, rows.tolist(), positions)]
+
+    def _findAgents(self, snapshot, rows: np.ndarray, queries: list[Message]) -> list[dict]:
+        centers = np.array([query.position for query in queries], dtype=np.float64).reshape(-1, 2)
+        radii = np.array([query.radius for query in queries], dtype=np.float64)
+        query, point, dist = radiusQueryMany(snapshot.positions[rows], centers, radii)
+        bounds = np.searchsorted(query, np.arange(len(queries) + 1))
+        ids = snapshot.ids[rows[point]].tolist()
+        dist = dist.tolist()
+        return [{Message.AGENT_IDS: ids[start:end], Message.DISTANCE: dist[start:end]} for start, end in zip(bounds[:-1].tolist(), bounds[1:].tolist())]
+
+    def _findNearest(self, snapshot, rows: np.ndarray, queries: list[Message]) -> list[dict]:
+        centers = np.array([query.position for query in queries], dtype=np.float64).reshape(-1, 2)
+        ks = [max(query.k, 0) for query in queries]
+        if(rows.shape[0] == 0 or max(ks) == 0):
+            return [{Message.AGENT_IDS: [], Message.DISTANCE: []} for _ in queries]
+        # one batched kNN with the largest k, every query keeps its own first k
+        ids, dist = snapshot.findNearestMany(centers, max(ks), kind=queries[0].agentKind or 'all')
+        answers = []
+        for k, rowIds, rowDist in zip(ks, ids.tolist(), dist.tolist()):
+            found = min(k, rows.shape[0])
+            answers.append({Message.AGENT_IDS: rowIds[:found], Message.DISTANCE: rowDist[:found]})
+        return answers
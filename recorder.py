@@ -0,0 +1,363 @@
+import asyncio
+import io
+import itertools
+import json
+import logging
+import threading as th
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from checkpoint import idArray
+
+LOG_MAGIC = b'AASDTLOG'
+LOG_VERSION = 2
+CHUNK_MAGIC = b'TCHK'
+# magic, version
+LOG_HEADER = np.dtype([('magic', 'S8'), ('version', '<i8')])
+# magic, ticks in the chunk, step of its first tick, size of the columns before and after compression
+CHUNK_HEADER = np.dtype([('magic', 'S4'), ('ticks', '<i4'), ('firstStep', '<i8'), ('rawBytes', '<i8'), ('compressedBytes', '<i8')])
+SENSOR_SIGNALS = ('temperature', 'pulse', 'bloodPressure', 'acceleration')
+ID_COLUMNS = ('moveIds', 'addIds', 'removeIds', 'sensorIds')
+# how an id column is stored: the array of checkpoint.idArray, or JSON text for ids mixing ints and strs
+IDS_PLAIN = 0
+IDS_JSON = 1
+# columns of a chunk in file order, each one an npy array, message metadata and bodies as JSON text
+CHUNK_COLUMNS = ('step', 'simTime', 'idEncodings', 'moveIdsCounts', 'moveIds', 'movePositions', 'addIdsCounts', 'addIds', 'addMobile', 'addPositions', 'removeIdsCounts', 'removeIds', 'sensorIdsCounts', 'sensorIds') + SENSOR_SIGNALS + ('messageCounts', 'messageSender', 'messageTo', 'messageMetadata', 'messageBody')
+
+_recorder = None
+
+def activeRecorder() -> 'Recorder':
+    return _recorder
+
+def _textColumn(values: list[str]) -> np.ndarray:
+    # at least one character, numpy has no zero width strings
+    return np.asarray(values, dtype=f'<U{max(max(map(len, values), default=1), 1)}')
+
+def _idColumn(ids) -> tuple[int, np.ndarray]:
+    ids = list(ids)
+    try:
+        return IDS_PLAIN, idArray(ids)
+    except Exception:
+        return IDS_JSON, _textColumn([json.dumps(id) for id in ids])
+
+class TickRecord():
+    """
+        What changed at one recorded tick. Positions are the new ones, messages
+        are (sender, to, metadata, body) tuples of the messages sent since the
+        previous tick and sensors maps every signal to the rows of sensorIds.
+    """
+    def __init__(self, step: int, simTime: float, moveIds, movePositions, addIds, addMobile, addPositions, removeIds, messages: list, sensorIds, sensors: dict) -> None:
+        self.step = step
+        self.simTime = simTime
+        self.moveIds = moveIds
+        self.movePositions = movePositions
+        self.addIds = addIds
+        self.addMobile = addMobile
+        self.addPositions = addPositions
+        self.removeIds = removeIds
+        self.messages = messages
+        self.sensorIds = sensorIds
+        self.sensors = sensors
+
+class Recorder():
+    """
+        Append-only log of a run. Every record() call stores the difference
+        between the published snapshot and the previously recorded one: the
+        moved agents with their new positions, the added agents and the
+        removed ids, together with the messages sent meanwhile and the
+        readings of the sensor model. The first tick records every agent as
+        added, so a log replays from an empty surface.
+
+        Ticks are buffered column-wise and every chunkTicks ticks the columns
+        are written as typed npy arrays, compressed and appended to the file by
+        a writer thread, the tick only pays for the diff. Ids are stored like
+        checkpoint ids, or as JSON text when ints and strs are mixed, so
+        replaying a log from elsewhere never unpickles anything. Call close()
+        to write the last chunk.
+        An existing file at path is overwritten, a log holds exactly one run.
+    """
+    def __init__(self, path: str, chunkTicks: int=100, level: int=1, logger: logging.Logger=None) -> None:
+        if(chunkTicks < 1):
+            raise Exception(f"A chunk needs at least one tick, got chunkTicks: {chunkTicks}")
+        self.path = path
+        self.chunkTicks = int(chunkTicks)
+        self.level = level
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        # a second run appended to the log would replay on top of the state of the first
+        self.file = open(path, 'wb')
+        self.file.write(np.array([(LOG_MAGIC, LOG_VERSION)], dtype=LOG_HEADER).tobytes())
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='recorder')
+        self.messageLock = th.Lock()
+        self.pendingMessages = []
+        self.ticks = 0
+        self.chunks = 0
+        self.bytesWritten = 0
+        self._lastIds = np.empty(0, dtype=object)
+        self._lastIdToRow = {}
+        self._lastPositions = np.empty((0, 2), dtype=np.float32)
+        self._clearChunk()
+
+    def install(self) -> 'Recorder':
+        """
+            Makes CyclicBehaviour.send pass every sent message to recordMessage.
+        """
+        # imported here so reading logs does not need spade
+        from sendhooks import addSendHook
+        global _recorder
+        if(_recorder is not None):
+            _recorder.uninstall()
+        _recorder = self
+        addSendHook(self.recordMessage)
+        return self
+
+    def uninstall(self) -> None:
+        global _recorder
+        if(_recorder is self):
+            from sendhooks import removeSendHook
+            _recorder = None
+            removeSendHook(self.recordMessage)
+
+    def recordMessage(self, msg) -> None:
+        entry = (str(msg.sender), str(msg.to), dict(msg.metadata or {}), msg.body)
+        self.messageLock.acquire()
+        self.pendingMessages.append(entry)
+        self.messageLock.release()
+
+    def _clearChunk(self) -> None:
+        self.chunk = {name: [] for name in ('step', 'simTime', 'moveIds', 'movePositions', 'addIds', 'addMobile', 'addPositions', 'removeIds', 'messages', 'sensorIds') + SENSOR_SIGNALS}
+
+    def _diff(self, snapshot) -> tuple:
+        ids, positions = snapshot.ids, snapshot.positions
+        if(ids is self._lastIds):
+            # published with the same layout, rows still belong to the same agents
+            moved = np.flatnonzero(np.any(positions != self._lastPositions, axis=1))
+            empty = np.empty(0, dtype=np.int64)
+            return moved, empty, []
+        # one dict lookup per agent, only at ticks where agents were added or removed
+        oldRows = np.fromiter(map(self._lastIdToRow.get, ids.tolist(), itertools.repeat(-1)), dtype=np.int64, count=ids.shape[0])
+        kept = np.flatnonzero(oldRows >= 0)
+        moved = kept[np.any(positions[kept] != self._lastPositions[oldRows[kept]], axis=1)]
+        added = np.flatnonzero(oldRows < 0)
+        removed = list(self._lastIdToRow.keys() - snapshot.idToRow.keys()) if kept.shape[0] < len(self._lastIdToRow) else []
+        return moved, added, removed
+
+    def record(self, snapshot, simTime: float, sensors=None) -> None:
+        """
+            Records the tick of a SurfaceSnapshot, called by the environment
+            after publishing. sensors is an optional sensors.SensorModel.
+        """
+        moved, added, removed = self._diff(snapshot)
+        chunk = self.chunk
+        chunk['step'].append(snapshot.step or 0)
+        chunk['simTime'].append(simTime)
+        chunk['moveIds'].append(snapshot.ids[moved])
+        chunk['movePositions'].append(snapshot.positions[moved])
+        chunk['addIds'].append(snapshot.ids[added])
+        chunk['addMobile'].append(snapshot.mobileMask[added])
+        chunk['addPositions'].append(snapshot.positions[added])
+        chunk['removeIds'].append(removed)
+        self._lastIds, self._lastIdToRow, self._lastPositions = snapshot.ids, snapshot.idToRow, snapshot.positions
+
+        self.messageLock.acquire()
+        messages, self.pendingMessages = self.pendingMessages, []
+        self.messageLock.release()
+        chunk['messages'].append(messages)
+
+        if(sensors is not None):
+            sensors.lock.acquire()
+            slots = np.flatnonzero(sensors.used)
+            chunk['sensorIds'].append(sensors.slotIds[slots])
+            for signal in SENSOR_SIGNALS:
+                chunk[signal].append(getattr(sensors, signal)[slots])
+            sensors.lock.release()
+        else:
+            chunk['sensorIds'].append(np.empty(0, dtype=object))
+            for signal in SENSOR_SIGNALS:
+                chunk[signal].append(np.empty((0,) + (2,) * (signal in ('bloodPressure', 'acceleration')), dtype=np.float32))
+
+        self.ticks += 1
+        if(len(chunk['step']) >= self.chunkTicks):
+            self.flush()
+
+    def flush(self) -> None:
+        """
+            Hands the buffered ticks to the writer thread.
+        """
+        if(not self.chunk['step']):
+            return
+        chunk = self.chunk
+        self._clearChunk()
+        self.writer.submit(self._write, chunk)
+
+    @staticmethod
+    def _columns(chunk: dict) -> dict:
+        """
+            One array per column for the whole chunk plus per tick counts to split them again.
+        """
+        columns = {
+            'step': np.asarray(chunk['step'], dtype=np.int64),
+            'simTime': np.asarray(chunk['simTime'], dtype=np.float64),
+            'addMobile': np.concatenate(chunk['addMobile']),
+            'movePositions': np.concatenate(chunk['movePositions']).astype(np.float32),
+            'addPositions': np.concatenate(chunk['addPositions']).astype(np.float32),
+        }
+        encodings = []
+        for name in ID_COLUMNS:
+            columns[name + 'Counts'] = np.fromiter(map(len, chunk[name]), dtype=np.int64, count=len(chunk[name]))
+            encoding, columns[name] = _idColumn(itertools.chain.from_iterable(chunk[name]))
+            encodings.append(encoding)
+        columns['idEncodings'] = np.asarray(encodings, dtype=np.int64)
+        for signal in SENSOR_SIGNALS:
+            columns[signal] = np.concatenate(chunk[signal]).astype(np.float32)
+        columns['messageCounts'] = np.fromiter(map(len, chunk['messages']), dtype=np.int64, count=len(chunk['messages']))
+        messages = list(itertools.chain.from_iterable(chunk['messages']))
+        columns['messageSender'] = _textColumn([sender for sender, _, _, _ in messages])
+        columns['messageTo'] = _textColumn([to for _, to, _, _ in messages])
+        columns['messageMetadata'] = _textColumn([json.dumps(metadata) for _, _, metadata, _ in messages])
+        columns['messageBody'] = _textColumn([json.dumps(body) for _, _, _, body in messages])
+        return columns
+
+    def _write(self, chunk: dict) -> None:
+        try:
+            columns = Recorder._columns(chunk)
+            buffer = io.BytesIO()
+            for name in CHUNK_COLUMNS:
+                np.lib.format.write_array(buffer, columns[name], allow_pickle=False)
+            raw = buffer.getvalue()
+            compressed = zlib.compress(raw, self.level)
+            header = np.array([(CHUNK_MAGIC, columns['step'].shape[0], columns['step'][0], len(raw), len(compressed))], dtype=CHUNK_HEADER)
+            self.file.write(header.tobytes())
+            self.file.write(compressed)
+            self.file.flush()
+            self.chunks += 1
+            self.bytesWritten += CHUNK_HEADER.itemsize + len(compressed)
+        except Exception as e:
+            self.logger.error(f"Writing a chunk to {self.path} failed: {e}")
+
+    def close(self) -> None:
+        self.uninstall()
+        self.flush()
+        self.writer.shutdown(wait=True)
+        self.file.close()
+
+class Replayer():
+    """
+        Reads a Recorder log back. A chunk cut short by a crash ends the log.
+    """
+    def __init__(self, path: str, logger: logging.Logger=None) -> None:
+        self.path = path
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+
+    def chunks(self):
+        """
+            Column dicts of the chunks in file order.
+        """
+        with open(self.path, 'rb') as file:
+            header = np.frombuffer(file.read(LOG_HEADER.itemsize), dtype=LOG_HEADER)
+            if(header.shape[0] == 0 or header[0]['magic'] != LOG_MAGIC):
+                raise Exception(f"Not a tick log: {self.path}")
+            if(header[0]['version'] != LOG_VERSION):
+                raise Exception(f"Unsupported tick log version {header[0]['version']}: {self.path}")
+            while(True):
+                data = file.read(CHUNK_HEADER.itemsize)
+                if(len(data) < CHUNK_HEADER.itemsize):
+                    break
+                chunk = np.frombuffer(data, dtype=CHUNK_HEADER)[0]
+                compressed = file.read(int(chunk['compressedBytes']))
+                if(chunk['magic'] != CHUNK_MAGIC or len(compressed) < chunk['compressedBytes']):
+                    self.logger.warning(f"Tick log {self.path} ends with a damaged chunk at step {chunk['firstStep']}")
+                    break
+                yield Replayer._readColumns(zlib.decompress(compressed))
+
+    @staticmethod
+    def _readColumns(raw: bytes) -> dict:
+        """
+            Column dict of a decompressed chunk, object arrays are refused so reading a log runs no code from it.
+        """
+        buffer = io.BytesIO(raw)
+        columns = {name: np.lib.format.read_array(buffer, allow_pickle=False) for name in CHUNK_COLUMNS}
+        for name, encoding in zip(ID_COLUMNS, columns['idEncodings'].tolist()):
+            if(encoding == IDS_JSON):
+                ids = [json.loads(id) for id in columns[name].tolist()]
+                columns[name] = np.empty(len(ids), dtype=object)
+                columns[name][:] = ids
+        for name in ('messageSender', 'messageTo'):
+            columns[name] = columns[name].tolist()
+        for name in ('messageMetadata', 'messageBody'):
+            columns[name] = [json.loads(value) for value in columns[name].tolist()]
+        return columns
+
+    def ticks(self):
+        """
+            TickRecord of every recorded tick.
+        """
+        for columns in self.chunks():
+            splits = {}
+            for name in ('moveIds', 'addIds', 'removeIds', 'sensorIds', 'message'):
+                counts = columns[name + 'Counts']
+                splits[name] = np.concatenate(([0], np.cumsum(counts)))
+            for tick in range(columns['step'].shape[0]):
+                move = slice(splits['moveIds'][tick], splits['moveIds'][tick + 1])
+                add = slice(splits['addIds'][tick], splits['addIds'][tick + 1])
+                remove = slice(splits['removeIds'][tick], splits['removeIds'][tick + 1])
+                sensor = slice(splits['sensorIds'][tick], splits['sensorIds'][tick + 1])
+                message = slice(splits['message'][tick], splits['message'][tick + 1])
+                yield TickRecord(
+                    step=int(columns['step'][tick]),
+                    simTime=float(columns['simTime'][tick]),
+                    moveIds=columns['moveIds'][move],
+                    movePositions=columns['movePositions'][move],
+                    addIds=columns['addIds'][add],
+                    addMobile=columns['addMobile'][add],
+                    addPositions=columns['addPositions'][add],
+                    removeIds=columns['removeIds'][remove],
+                    messages=list(zip(*(columns[name][message] for name in ('messageSender', 'messageTo', 'messageMetadata', 'messageBody')))),
+                    sensorIds=columns['sensorIds'][sensor],
+                    sensors={signal: columns[signal][sensor] for signal in SENSOR_SIGNALS},
+                )
+
+    @staticmethod
+    def apply(surface, tick: TickRecord) -> None:
+        """
+            Brings the surface to the recorded state of the tick. Added agents
+            get no SPADE agent and the default move function.
+        """
+        for id in tick.removeIds.tolist():
+            surface.removeAgent(id)
+        for id, mobile, position in zip(tick.addIds.tolist(), tick.addMobile.tolist(), tick.addPositions):
+            if(mobile):
+                surface.addMobileAgent(agent=None, id=id, startPos=position)
+            else:
+                surface.addStaticAgent(agent=None, id=id, position=position)
+        surface.setPositions(tick.moveIds.tolist(), tick.movePositions)
+
+    async def replay(self, behaviour, speed: float=None, onTick=None) -> int:
+        """
+            Runs behaviour, a GlobalEnvTimeBehaviour in 'FIXED' time mode, once
+            per recorded tick after applying the tick to its surface, so the
+            whole pipeline works on the recorded positions. The ticks are paced
+            speed times faster than the recorded simulated clock, None runs them
+            back to back. onTick(tick) is called before each tick, e.g. to look
+            at the recorded messages and readings. Returns the number of ticks.
+        """
+        if(behaviour.timeMode != 'FIXED'):
+            raise Exception("Replays need a behaviour in 'FIXED' time mode, the replayer does the pacing")
+        if(speed is not None and speed <= 0.):
+            raise Exception(f"Replay speed must be positive, got: {speed}")
+        count = 0
+        start = time.monotonic()
+        firstSimTime = None
+        for tick in self.ticks():
+            if(firstSimTime is None):
+                firstSimTime = tick.simTime
+            if(speed is not None):
+                delay = start + (tick.simTime - firstSimTime) / speed - time.monotonic()
+                if(delay > 0.):
+                    await asyncio.sleep(delay)
+            Replayer.apply(behaviour.surface, tick)
+            if(onTick is not None):
+                onTick(tick)
+            await behaviour.run()
+            count += 1
+        return count
@@ -0,0 +1,35 @@
+from spade_fix.behaviour import CyclicBehaviour
+
+_hooks = []
+_send = CyclicBehaviour.send
+
+def addSendHook(hook) -> None:
+    """
+        Calls hook(msg) for every message a CyclicBehaviour sends, after the
+        sender is filled in. A hook returning True has delivered the message,
+        it is then not passed to the SPADE container. All hooks see every message.
+    """
+    if(hook not in _hooks):
+        _hooks.append(hook)
+    CyclicBehaviour.send = _hookedSend
+
+def removeSendHook(hook) -> None:
+    if(hook in _hooks):
+        _hooks.remove(hook)
+    if(not _hooks):
+        CyclicBehaviour.send = _send
+
+async def _hookedSend(self, msg) -> None:
+    """
+        CyclicBehaviour.send while hooks are installed, the vendored SPADE copy stays untouched.
+    """
+    if(not msg.sender):
+        msg.sender = str(self.agent.jid)
+    delivered = False
+    for hook in list(_hooks):
+        delivered = hook(msg) or delivered
+    if(not delivered):
+        await _send(self, msg)
+        return
+    msg.sent = True
+    self.agent.traces.append(msg, category=str(self))
@@ -0,0 +1,177 @@
+import math
+import threading as th
+import numpy as np
+
+SECONDS_PER_DAY = 86400.
+
+class Anomaly():
+    NONE = 0
+    FEVER = 1 # temperature up by 2.5 C * strength
+    TACHYCARDIA = 2 # pulse up by 60 bpm * strength
+    HYPERTENSION = 3 # blood pressure up by (40, 25) mmHg * strength
+    FALL = 4 # acceleration spike of about 30 m/s^2 * strength at the first tick, then no activity
+
+    NAMES = {'fever': FEVER, 'tachycardia': TACHYCARDIA, 'hypertension': HYPERTENSION, 'fall': FALL}
+
+class SensorModel():
+    """
+        Synthesized wearable readings of all wearers, one row per wearer in
+        (capacity,) and (capacity, 2) arrays: temperature in C, pulse in bpm,
+        blood pressure as (systolic, diastolic) mmHg and acceleration in m/s^2.
+        update() recomputes every row in a few vectorized operations per tick:
+        per wearer baselines, a daily sine drift, activity following the speed
+        of the wearer on the surface, noise and injected anomaly episodes.
+
+        The arrays are written in place, so the views returned by view() follow
+        the readings from tick to tick. A view is valid until the model grows
+        past its capacity or the wearer is removed.
+    """
+    SIGNALS = ('temperature', 'pulse', 'bloodPressure', 'acceleration')
+
+    def __init__(self, capacity: int=64, rng: np.random.Generator=None, activitySpeed: float=1.5, activityTau: float=30.) -> None:
+        """
+            activitySpeed - speed in units per simulated second counted as full activity.
+            activityTau - time constant of the activity in simulated seconds.
+        """
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.activitySpeed = activitySpeed
+        self.activityTau = activityTau
+        self.lock = th.Lock()
+        self.idToSlot = {}
+        self._allocate(max(int(capacity), 1))
+        self.freeSlots = list(range(self.capacity - 1, -1, -1))
+        self._rows = None
+        self._rowsKey = None
+
+    def _allocate(self, capacity: int) -> None:
+        old = getattr(self, 'capacity', 0)
+        def grown(name, shape, dtype, fill=0.):
+            array = np.full((capacity,) + shape, fill, dtype=dtype)
+            if(old):
+                array[:old] = getattr(self, name)
+            setattr(self, name, array)
+        grown('temperature', (), np.float32)
+        grown('pulse', (), np.float32)
+        grown('bloodPressure', (2,), np.float32)
+        grown('acceleration', (2,), np.float32)
+        grown('baseTemperature', (), np.float32, 36.6)
+        grown('basePulse', (), np.float32, 70.)
+        grown('baseBloodPressure', (2,), np.float32, 120.)
+        grown('phase', (), np.float64)
+        grown('activity', (), np.float32)
+        grown('lastPosition', (2,), np.float64)
+        grown('lastVelocity', (2,), np.float64)
+        grown('used', (), bool, False)
+        grown('fresh', (), bool, False)
+        grown('anomalyKind', (), np.int8, Anomaly.NONE)
+        grown('anomalyUntil', (), np.float64)
+        grown('anomalyStrength', (), np.float32)
+        grown('anomalyFresh', (), bool, False)
+        grown('slotIds', (), object, None)
+        self.capacity = capacity
+
+    def addWearer(self, id) -> None:
+        self.lock.acquire()
+        if(id not in self.idToSlot):
+            if(not self.freeSlots):
+                old = self.capacity
+                self._allocate(old * 2)
+                self.freeSlots = list(range(self.capacity - 1, old - 1, -1))
+            slot = self.freeSlots.pop()
+            self.idToSlot[id] = slot
+            self.slotIds[slot] = id
+            self.used[slot] = True
+            self.fresh[slot] = True
+            self.baseTemperature[slot] = self.rng.normal(36.6, 0.2)
+            self.basePulse[slot] = self.rng.normal(70., 6.)
+            self.baseBloodPressure[slot] = self.rng.normal((120., 80.), (8., 5.))
+            self.phase[slot] = self.rng.uniform(-0.5, 0.5)
+            self.activity[slot] = 0.
+            self.anomalyKind[slot] = Anomaly.NONE
+            self._rowsKey = None
+        self.lock.release()
+
+    def removeWearer(self, id) -> None:
+        self.lock.acquire()
+        slot = self.idToSlot.pop(id, None)
+        if(slot is not None):
+            self.slotIds[slot] = None
+            self.used[slot] = False
+            self.freeSlots.append(slot)
+            self._rowsKey = None
+        self.lock.release()
+
+    def injectAnomaly(self, id, kind: str, until: float, strength: float=1.) -> None:
+        """
+            Episode of the given kind ('fever', 'tachycardia', 'hypertension' or 'fall')
+            lasting until the simulated time until. A wearer has one episode at a time.
+        """
+        if(kind not in Anomaly.NAMES):
+            raise Exception(f"Unknown anomaly: {kind}")
+        self.lock.acquire()
+        slot = self.idToSlot[id]
+        self.anomalyKind[slot] = Anomaly.NAMES[kind]
+        self.anomalyUntil[slot] = until
+        self.anomalyStrength[slot] = strength
+        self.anomalyFresh[slot] = True
+        self.lock.release()
+
+    def view(self, id, signal: str) -> np.ndarray[np.float32]:
+        """
+            Zero-copy view of the wearer's row of signal, 0-d for temperature and pulse.
+        """
+        if(signal not in SensorModel.SIGNALS):
+            raise Exception(f"Unknown signal: {signal}")
+        return getattr(self, signal)[self.idToSlot[id], ...]
+
+    def _snapshotRows(self, snapshot) -> np.ndarray[np.int64]:
+        """
+            Snapshot row of every slot, -1 for free slots and wearers missing from
+            the surface. Only rebuilt when wearers or the snapshot layout changed.
+        """
+        key = (snapshot.idToRow, self.capacity)
+        if(self._rowsKey is None or self._rowsKey[0] is not key[0] or self._rowsKey[1] != key[1]):
+            self._rows = np.fromiter((snapshot.idToRow.get(id, -1) if id is not None else -1 for id in self.slotIds), dtype=np.int64, count=self.capacity)
+            self._rowsKey = key
+        return self._rows
+
+    def update(self, snapshot, simTime: float, dt: float) -> None:
+        """
+            Recomputes the readings of all wearers from a SurfaceSnapshot.
+        """
+        if(dt <= 0.):
+            return
+        self.lock.acquire()
+        rows = self._snapshotRows(snapshot)
+        present = self.used & (rows >= 0)
+        position = self.lastPosition.copy()
+        position[present] = snapshot.positions[rows[present]]
+        # new wearers start at rest instead of jumping from the origin
+        self.lastPosition[self.fresh] = position[self.fresh]
+        self.lastVelocity[self.fresh] = 0.
+        self.fresh[present] = False
+        velocity = (position - self.lastPosition) / dt
+        acceleration = (velocity - self.lastVelocity) / dt
+        self.lastPosition[:] = position
+        self.lastVelocity[:] = velocity
+
+        n = self.capacity
+        anomaly = np.where(simTime < self.anomalyUntil, self.anomalyKind, Anomaly.NONE)
+        strength = self.anomalyStrength
+        speed = np.linalg.norm(velocity, axis=1)
+        target = np.minimum(speed / self.activitySpeed, 1.)
+        target[anomaly == Anomaly.FALL] = 0.
+        self.activity += (target - self.activity) * np.float32(1. - math.exp(-dt / self.activityTau))
+        circadian = np.sin(2. * np.pi * (simTime / SECONDS_PER_DAY + self.phase))
+        activity = self.activity
+
+        self.temperature[...] = self.baseTemperature + 0.4 * circadian + 0.6 * activity \
+            + 2.5 * strength * (anomaly == Anomaly.FEVER) + self.rng.normal(0., 0.05, n)
+        self.pulse[...] = self.basePulse + 5. * circadian + 70. * activity \
+            + 60. * strength * (anomaly == Anomaly.TACHYCARDIA) + self.rng.normal(0., 2., n)
+        self.bloodPressure[...] = self.baseBloodPressure + (circadian + 3. * activity)[:, None] * np.array([4., 3.]) \
+            + (strength * (anomaly == Anomaly.HYPERTENSION))[:, None] * np.array([40., 25.]) + self.rng.normal(0., 3., (n, 2))
+        spike = (strength * ((anomaly == Anomaly.FALL) & self.anomalyFresh))[:, None] * 30. * self.rng.standard_normal((n, 2))
+        self.anomalyFresh[:] = False
+        self.acceleration[...] = acceleration + spike + self.rng.normal(0., 0.05, (n, 2))
+        self.lock.release()
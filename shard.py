@@ -0,0 +1,698 @@
+import math
+import multiprocessing as mp
+from multiprocessing.shared_memory import SharedMemory
+import threading as th
+import numpy as np
+from spade.agent import Agent
+from surface import StaticAgent, MobileAgent, SurfaceSnapshot, QueryResult, kindMask, RESTORED_MOBILE, RESTORED_STATIC
+from spatial import radiusPairs, radiusPairsDirected, toCSR
+from trajectory import TrajectoryHistory
+
+
+class ShardArrays():
+    """
+        Views over the shared memory block of one shard:
+        [count int64][keys int64 * capacity][positions, velocities, accelerations float32 * 2 * capacity each][mobile bool * capacity]
+    """
+    def __init__(self, buffer, capacity: int) -> None:
+        self.capacity = capacity
+        self.header = np.ndarray((1,), dtype=np.int64, buffer=buffer, offset=0)
+        self.keys = np.ndarray((capacity,), dtype=np.int64, buffer=buffer, offset=8)
+        self.positions = np.ndarray((capacity, 2), dtype=np.float32, buffer=buffer, offset=8 + 8 * capacity)
+        self.velocities = np.ndarray((capacity, 2), dtype=np.float32, buffer=buffer, offset=8 + 16 * capacity)
+        self.accelerations = np.ndarray((capacity, 2), dtype=np.float32, buffer=buffer, offset=8 + 24 * capacity)
+        self.mobile = np.ndarray((capacity,), dtype=bool, buffer=buffer, offset=8 + 32 * capacity)
+
+    @staticmethod
+    def size(capacity: int) -> int:
+        return 8 + 33 * capacity
+
+# per agent arrays of a shard, in the order emigrants and adds carry them
+SHARD_FIELDS = ('positions', 'mobile', 'velocities', 'accelerations')
+
+class ShardWorker():
+    """
+        Owns the agents whose x lies in [lo, hi). Runs in its own process and
+        answers commands coming through the pipe, agents that leave the strip
+        after a move are removed and handed back to the parent as
+        (keys, positions, mobile, velocities, accelerations).
+    """
+    def __init__(self, arrays: ShardArrays, lo: float, hi: float) -> None:
+        self.arrays = arrays
+        self.lo = lo
+        self.hi = hi
+        self.rows = {}
+
+    @property
+    def count(self) -> int:
+        return int(self.arrays.header[0])
+
+    def add(self, keys, positions, mobile, velocities=None, accelerations=None) -> None:
+        count = self.count
+        if(count + len(keys) > self.arrays.capacity):
+            raise Exception(f"Shard [{self.lo}, {self.hi}) is full, capacity: {self.arrays.capacity}")
+        end = count + len(keys)
+        self.arrays.keys[count:end] = keys
+        self.arrays.positions[count:end] = positions
+        self.arrays.mobile[count:end] = mobile
+        self.arrays.velocities[count:end] = 0. if velocities is None else velocities
+        self.arrays.accelerations[count:end] = 0. if accelerations is None else accelerations
+        for row, key in enumerate(keys, start=count):
+            self.rows[int(key)] = row
+        self.arrays.header[0] = end
+
+    def remove(self, key: int) -> bool:
+        row = self.rows.pop(key, None)
+        if(row is None):
+            return False
+        last = self.count - 1
+        if(row != last):
+            lastKey = int(self.arrays.keys[last])
+            self.arrays.keys[row] = lastKey
+            for field in SHARD_FIELDS:
+                array = getattr(self.arrays, field)
+                array[row] = array[last]
+            self.rows[lastKey] = row
+        self.arrays.header[0] = last
+        return True
+
+    def _emigrate(self, rows) -> tuple[np.ndarray, ...]:
+        x = self.arrays.positions[rows, 0]
+        leaving = rows[(x < self.lo) | (x >= self.hi)]
+        keys = self.arrays.keys[leaving].copy()
+        fields = tuple(getattr(self.arrays, field)[leaving].copy() for field in SHARD_FIELDS)
+        for key in keys:
+            self.remove(int(key))
+        return (keys,) + fields
+
+    def _rowsOf(self, keys) -> np.ndarray[np.int64]:
+        return np.fromiter((self.rows[int(key)] for key in keys), dtype=np.int64, count=len(keys))
+
+    def move(self, keys, vectors) -> tuple[np.ndarray, ...]:
+        rows = self._rowsOf(keys)
+        vectors = np.where(self.arrays.mobile[rows, None], vectors, 0.)
+        np.add.at(self.arrays.positions, rows, vectors.astype(np.float32))
+        return self._emigrate(np.unique(rows))
+
+    def set(self, keys, positions) -> tuple[np.ndarray, ...]:
+        rows = self._rowsOf(keys)
+        self.arrays.positions[rows] = positions
+        return self._emigrate(np.unique(rows))
+
+    def setField(self, keys, field: str, values) -> None:
+        """
+            Sets the velocities or accelerations of mobile agents.
+        """
+        rows = self._rowsOf(keys)
+        if(not self.arrays.mobile[rows].all()):
+            raise Exception("Only mobile agents have a velocity and an acceleration")
+        getattr(self.arrays, field)[rows] = values
+
+    def integrate(self, dt: float, maxSpeed: float, damping: float) -> tuple[int, tuple[np.ndarray, ...]]:
+        """
+            Surface.integrate for the agents of the shard, returns the number
+            of agents moved and the emigrants.
+        """
+        count = self.count
+        velocities = self.arrays.velocities[:count]
+        accelerations = self.arrays.accelerations[:count]
+        active = np.flatnonzero(self.arrays.mobile[:count] & (velocities.any(axis=1) | accelerations.any(axis=1)))
+        if(active.shape[0] == 0):
+            return 0, self._emigrate(active)
+        updated = velocities[active] + accelerations[active] * np.float32(dt)
+        if(damping > 0.):
+            updated *= np.float32(math.exp(-damping * dt))
+        if(maxSpeed is not None):
+            speed = np.linalg.norm(updated, axis=1)
+            over = speed > maxSpeed
+            updated[over] *= (maxSpeed / speed[over])[:, None]
+        velocities[active] = updated
+        self.arrays.positions[active] += updated * np.float32(dt)
+        return active.shape[0], self._emigrate(active)
+
+    def find(self, position, radius: float, kind: str) -> np.ndarray[np.int64]:
+        count = self.count
+        dist = np.linalg.norm(self.arrays.positions[:count] - np.asarray(position), axis=1)
+        return self.arrays.keys[:count][(dist < radius) & kindMask(self.arrays.mobile[:count], kind)].copy()
+
+    def get(self, key: int, field: str='positions') -> np.ndarray[np.float32]:
+        return getattr(self.arrays, field)[self.rows[key]].copy()
+
+def runShardWorker(conn, shmName: str, capacity: int, lo: float, hi: float) -> None:
+    shm = SharedMemory(name=shmName)
+    worker = ShardWorker(ShardArrays(shm.buf, capacity), lo, hi)
+    try:
+        while True:
+            command, *args = conn.recv()
+            if(command == 'stop'):
+                conn.send(('ok', None))
+                break
+            if(command == 'attach'):
+                # the parent grew the shard, its block already holds a copy of the agents
+                grown = SharedMemory(name=args[0])
+                worker.arrays = ShardArrays(grown.buf, args[1])
+                shm.close()
+                shm = grown
+                conn.send(('ok', None))
+                continue
+            try:
+                conn.send(('ok', getattr(worker, command)(*args)))
+            except Exception as e:
+                conn.send(('error', f"{type(e).__name__}: {e}"))
+    finally:
+        del worker
+        shm.close()
+
+class ShardedSurface():
+    """
+        Surface split into vertical strips of the plane, each owned by a worker
+        process keeping its positions in shared memory. Agents migrate between
+        workers when a move takes them over a strip boundary, radius queries are
+        sent to every strip the circle overlaps and merged.
+
+        Offers the Surface API used by GlobalEnvironmentAgent, velocities and
+        accelerations live in the workers next to the positions. Not supported,
+        and raising when used: move functions (moves are always additive since
+        functions cannot be sent to the workers), proximity watches, tile maps
+        and line of sight queries, the query cache. makeSurface refuses settings
+        that need them. Snapshot based queries (findNearest, neighbour pairs)
+        read the snapshot assembled by publish() from the shared memory of all
+        workers.
+    """
+    def __init__(self, shards: int=4, bounds: tuple[float, float]=(0., 1000.), capacity: int=100000, snapshotReads: bool=False, historyLength: int=None, maxSpeed: float=None, damping: float=0.) -> None:
+        """
+            shards - number of worker processes.
+            bounds - x range split evenly between the workers, the outer strips
+            extend to infinity.
+            capacity - agents a worker holds before its shared memory is
+            doubled.
+            maxSpeed, damping - see Surface.integrate.
+        """
+        self.cuts = np.linspace(bounds[0], bounds[1], shards + 1)[1:-1]
+        edges = np.concatenate([[-np.inf], self.cuts, [np.inf]])
+        self.capacity = int(capacity)
+        self.maxSpeed = maxSpeed
+        self.damping = damping
+        self.lock = th.Lock()
+        self.agents = {}
+        self.keyOf = {}
+        # indexed by key, so the keys read from shared memory map to ids and records without a Python loop
+        self.keyIds = np.empty(64, dtype=object)
+        self.keyRecords = np.empty(64, dtype=object)
+        self.keyShard = np.full(64, -1, dtype=np.int64)
+        self.freeKeys = []
+        self._nextKey = 0
+
+        context = mp.get_context()
+        self.shms, self.arrays, self.conns, self.processes = [], [], [], []
+        for shard in range(shards):
+            shm = SharedMemory(create=True, size=ShardArrays.size(self.capacity))
+            arrays = ShardArrays(shm.buf, self.capacity)
+            arrays.header[0] = 0
+            parentConn, childConn = context.Pipe()
+            process = context.Process(
+                target=runShardWorker,
+                args=(childConn, shm.name, self.capacity, float(edges[shard]), float(edges[shard + 1])),
+                daemon=True,
+            )
+            process.start()
+            self.shms.append(shm)
+            self.arrays.append(arrays)
+            self.conns.append(parentConn)
+            self.processes.append(process)
+
+        self.pendingMoves = []
+        self.pendingLock = th.Lock()
+        self.queryCount = 0
+        self.moveCount = 0
+        self.history = TrajectoryHistory(historyLength) if historyLength is not None else None
+
+        self.snapshotReads = snapshotReads
+        self.snapshot = None
+        self.queryCache = None
+        self._layoutChanged = True
+        self.publish()
+
+    def close(self) -> None:
+        self.lock.acquire()
+        for conn, process in zip(self.conns, self.processes):
+            if(process.is_alive()):
+                conn.send(('stop',))
+                conn.recv()
+                process.join()
+        self.arrays = []
+        for shm in self.shms:
+            shm.close()
+            shm.unlink()
+        self.shms = []
+        self.lock.release()
+
+    def _shardAt(self, x) -> np.ndarray[np.int64]:
+        return np.searchsorted(self.cuts, x, side='right')
+
+    def _callMany(self, calls: list[tuple[int, tuple]]) -> list:
+        """
+            Sends every command first and then collects the replies, so the shards work in parallel.
+        """
+        for shard, message in calls:
+            self.conns[shard].send(message)
+        replies = [self.conns[shard].recv() for shard, _ in calls]
+        for status, value in replies:
+            if(status != 'ok'):
+                raise Exception(value)
+        return [value for _, value in replies]
+
+    def _call(self, shard: int, *message):
+        return self._callMany([(shard, message)])[0]
+
+    def _reserve(self, shard: int, extra: int) -> None:
+        """
+            Grows the shared memory of the shard until extra more agents fit. The
+            agents are copied to a block of twice the size, the worker switches
+            to it before the old block is released.
+        """
+        arrays = self.arrays[shard]
+        count = int(arrays.header[0])
+        if(count + extra <= arrays.capacity):
+            return
+        capacity = arrays.capacity * 2
+        while(capacity < count + extra):
+            capacity *= 2
+        shm = SharedMemory(create=True, size=ShardArrays.size(capacity))
+        grown = ShardArrays(shm.buf, capacity)
+        grown.header[0] = count
+        grown.keys[:count] = arrays.keys[:count]
+        for field in SHARD_FIELDS:
+            getattr(grown, field)[:count] = getattr(arrays, field)[:count]
+        try:
+            self._call(shard, 'attach', shm.name, capacity)
+        except Exception:
+            del grown
+            shm.close()
+            shm.unlink()
+            raise
+        old = self.shms[shard]
+        self.shms[shard], self.arrays[shard] = shm, grown
+        del arrays
+        old.close()
+        old.unlink()
+
+    def _settle(self, emigrants: list[tuple[np.ndarray, ...]], sources: list[int]) -> None:
+        """
+            Adds the agents that left the strips of the source shards to the shards
+            now owning them. If that fails they go back to their source before
+            the error is raised, so no agent is lost.
+        """
+        emigrants = [(source, fields) for source, fields in zip(sources, emigrants) if fields[0].shape[0]]
+        if(not emigrants):
+            return
+        keys, positions, mobile, velocities, accelerations = (np.concatenate(column) for column in zip(*(fields for _, fields in emigrants)))
+        targets = self._shardAt(positions[:, 0])
+        try:
+            calls = []
+            for shard in np.unique(targets):
+                members = targets == shard
+                self._reserve(int(shard), int(members.sum()))
+                calls.append((int(shard), ('add', keys[members], positions[members], mobile[members], velocities[members], accelerations[members])))
+            self._callMany(calls)
+        except Exception:
+            self._callMany([(source, ('add',) + fields) for source, fields in emigrants])
+            raise
+        self.keyShard[keys] = targets
+        self._layoutChanged = True
+
+    def _newKey(self) -> int:
+        """
+            Key of a new agent, keys of removed agents are reused so the key arrays stay as large as the population.
+        """
+        if(self.freeKeys):
+            return self.freeKeys.pop()
+        key = self._nextKey
+        self._nextKey += 1
+        if(key == self.keyIds.shape[0]):
+            self._growKeys(key * 2)
+        return key
+
+    def _growKeys(self, capacity: int) -> None:
+        used = self.keyIds.shape[0]
+        keyIds = np.empty(capacity, dtype=object)
+        keyIds[:used] = self.keyIds
+        keyRecords = np.empty(capacity, dtype=object)
+        keyRecords[:used] = self.keyRecords
+        keyShard = np.full(capacity, -1, dtype=np.int64)
+        keyShard[:used] = self.keyShard
+        self.keyIds, self.keyRecords, self.keyShard = keyIds, keyRecords, keyShard
+
+    def _addAgent(self, agent: Agent, id, record: StaticAgent, position, mobile: bool) -> bool:
+        self.lock.acquire()
+        try:
+            if(id in self.agents):
+                return False
+            position = np.asarray(position, dtype=np.float32).reshape(1, 2)
+            key = self._newKey()
+            shard = int(self._shardAt(position[0, 0]))
+            try:
+                self._reserve(shard, 1)
+                self._call(shard, 'add', np.array([key]), position, np.array([mobile]))
+            except Exception:
+                self.freeKeys.append(key)
+                raise
+            self.agents[id] = ('m' if mobile else 's', record)
+            self.keyOf[id] = key
+            self.keyIds[key] = id
+            self.keyRecords[key] = record
+            self.keyShard[key] = shard
+            self._layoutChanged = True
+            return True
+        finally:
+            self.lock.release()
+
+    def addMobileAgent(self, agent: Agent, id, startPos: np.ndarray[np.float32], moveF=None) -> bool:
+        if(moveF is not None):
+            raise Exception("ShardedSurface supports only the default additive movement")
+        return self._addAgent(agent, id, MobileAgent(agent=agent), startPos, mobile=True)
+
+    def addStaticAgent(self, agent: Agent, id, position: np.ndarray[np.float32]) -> bool:
+        return self._addAgent(agent, id, StaticAgent(agent=agent), position, mobile=False)
+
+    def removeAgent(self, id) -> None:
+        self.lock.acquire()
+        try:
+            if(id not in self.agents):
+                return
+            _, record = self.agents.pop(id)
+            key = self.keyOf.pop(id)
+            self._call(int(self.keyShard[key]), 'remove', key)
+            self.keyIds[key] = None
+            self.keyRecords[key] = None
+            self.keyShard[key] = -1
+            self.freeKeys.append(key)
+            self._layoutChanged = True
+        finally:
+            self.lock.release()
+        if(self.history is not None):
+            self.history.forget(id)
+        if(record.agent is not None):
+            record.agent.stop()
+
+    def getPosition(self, id) -> np.ndarray[np.float32]:
+        if(self.snapshotReads):
+            snapshot = self.snapshot
+            # agents added since the last publish are read from their shard
+            if(id in snapshot.idToRow):
+                return snapshot.getPosition(id)
+        return self._livePosition(id)
+
+    def _livePosition(self, id, field: str='positions') -> np.ndarray[np.float32]:
+        self.lock.acquire()
+        try:
+            key = self.keyOf[id]
+            return self._call(int(self.keyShard[key]), 'get', key, field)
+        finally:
+            self.lock.release()
+
+    def recordHistory(self, simTime: float) -> None:
+        """
+            Appends the positions of the last published snapshot to the trajectory history.
+        """
+        if(self.history is not None):
+            self.history.recordSnapshot(self.snapshot, simTime)
+
+    def getTrajectory(self, id, t0: float=-np.inf, t1: float=np.inf) -> np.ndarray:
+        """
+            (k, 4) array of (step, simulated time, x, y) rows of the agent between t0 and t1.
+        """
+        if(self.history is None):
+            raise Exception("Trajectory history is disabled")
+        return self.history.trajectory(id, t0, t1)
+
+    def findAgentsDuring(self, position: np.ndarray[np.float32], radius: float, t0: float, t1: float) -> np.ndarray:
+        """
+            Ids of mobile agents that were closer than radius to position at some recorded time in [t0, t1].
+        """
+        if(self.history is None):
+            raise Exception("Trajectory history is disabled")
+        return self.history.findAgentsDuring(position, radius, t0, t1)
+
+    def getPositionStamped(self, id) -> tuple[np.ndarray[np.float32], int, int]:
+        snapshot = self.snapshot
+        if(id not in snapshot.idToRow):
+            return self._livePosition(id), None, None
+        return snapshot.getPosition(id), snapshot.epoch, snapshot.step
+
+    def _scatter(self, command: str, ids, values: np.ndarray[np.float32], skipMissing: bool=False) -> None:
+        values = np.asarray(values, dtype=np.float32).reshape(-1, 2)
+        if(values.shape[0] == 0):
+            return
+        self.lock.acquire()
+        try:
+            self.moveCount += values.shape[0]
+            if(skipMissing):
+                present = np.fromiter((id in self.keyOf for id in ids), dtype=bool, count=values.shape[0])
+                ids = [id for id, keep in zip(ids, present) if keep]
+                values = values[present]
+            keys = np.fromiter((self.keyOf[id] for id in ids), dtype=np.int64, count=values.shape[0])
+            shards = self.keyShard[keys]
+            calls = []
+            for shard in np.unique(shards):
+                members = shards == shard
+                calls.append((int(shard), (command, keys[members], values[members])))
+            self._settle(self._callMany(calls), [shard for shard, _ in calls])
+        finally:
+            self.lock.release()
+
+    def move(self, id, vector: np.ndarray[np.float32]) -> np.ndarray[np.float32]:
+        self.moveMany([id], vector)
+        return self._livePosition(id)
+
+    def moveMany(self, ids, vectors: np.ndarray[np.float32], skipMissing: bool=False) -> None:
+        self._scatter('move', ids, vectors, skipMissing=skipMissing)
+
+    def setPosition(self, id, position: np.ndarray[np.float32]):
+        self.setPositions([id], position)
+
+    def setPositions(self, ids, positions: np.ndarray[np.float32]) -> None:
+        self._scatter('set', ids, positions)
+
+    def queueMove(self, id, vector: np.ndarray[np.float32]) -> None:
+        self.pendingLock.acquire()
+        self.pendingMoves.append((id, vector))
+        self.pendingLock.release()
+
+    def flushMoves(self) -> int:
+        self.pendingLock.acquire()
+        pending = self.pendingMoves
+        self.pendingMoves = []
+        self.pendingLock.release()
+        if(pending):
+            ids, vectors = zip(*pending)
+            self.moveMany(ids, np.asarray(vectors, dtype=np.float32), skipMissing=True)
+        return len(pending)
+
+    def publish(self, step: int=None) -> SurfaceSnapshot:
+        """
+            Assembles a snapshot straight from the shared memory of all workers,
+            they are idle while the lock is held.
+        """
+        self.lock.acquire()
+        counts = [int(arrays.header[0]) for arrays in self.arrays]
+        positions, velocities, accelerations = (
+            np.concatenate([getattr(arrays, field)[:count] for arrays, count in zip(self.arrays, counts)])
+            for field in ('positions', 'velocities', 'accelerations')
+        )
+        previous = self.snapshot
+        if(self._layoutChanged or previous is None):
+            keys = np.concatenate([arrays.keys[:count] for arrays, count in zip(self.arrays, counts)])
+            mobileMask = np.concatenate([arrays.mobile[:count] for arrays, count in zip(self.arrays, counts)])
+            ids = self.keyIds[keys]
+            records = self.keyRecords[keys]
+            idToRow = dict(zip(ids.tolist(), range(keys.shape[0])))
+            self._layoutChanged = False
+        else:
+            mobileMask, ids, records, idToRow = previous.mobileMask, previous.ids, previous.records, previous.idToRow
+        snapshot = SurfaceSnapshot(
+            epoch=0 if previous is None else previous.epoch + 1,
+            step=step,
+            positions=positions,
+            mobileMask=mobileMask,
+            ids=ids,
+            records=records,
+            idToRow=idToRow,
+            velocities=velocities,
+            accelerations=accelerations,
+        )
+        self.lock.release()
+        self.snapshot = snapshot
+        return snapshot
+
+    def addWatch(self, radius: float, center: np.ndarray[np.float32]=None, anchorId=None, kind: str='mobile', callback=None) -> int:
+        raise Exception("Proximity watches are not supported by ShardedSurface")
+
+    def removeWatch(self, watchId: int) -> None:
+        raise Exception("Proximity watches are not supported by ShardedSurface")
+
+    def updateWatches(self, step: int=None) -> list:
+        return []
+
+    def integrate(self, dt: float) -> int:
+        """
+            Surface.integrate run by all workers in parallel, returns the number of agents moved.
+        """
+        if(dt <= 0.):
+            return 0
+        self.lock.acquire()
+        try:
+            results = self._callMany([(shard, ('integrate', dt, self.maxSpeed, self.damping)) for shard in range(len(self.conns))])
+            self._settle([emigrants for _, emigrants in results], list(range(len(results))))
+            moved = sum(count for count, _ in results)
+            self.moveCount += moved
+            return moved
+        finally:
+            self.lock.release()
+
+    def restore(self, ids, positions: np.ndarray[np.float32], mobileMask: np.ndarray[bool], velocities: np.ndarray[np.float32]=None, accelerations: np.ndarray[np.float32]=None) -> None:
+        """
+            Same as Surface.restore, the agents are sent to the shards owning their positions.
+        """
+        count = len(ids)
+        positions = np.asarray(positions, dtype=np.float32).reshape(-1, 2)
+        mobileMask = np.asarray(mobileMask, dtype=bool)
+        velocities = np.zeros((count, 2), dtype=np.float32) if velocities is None else np.asarray(velocities, dtype=np.float32)
+        accelerations = np.zeros((count, 2), dtype=np.float32) if accelerations is None else np.asarray(accelerations, dtype=np.float32)
+        self.lock.acquire()
+        try:
+            if(self.agents):
+                raise Exception(f"Restore needs an empty surface, it holds {len(self.agents)} agents")
+            ids = list(ids)
+            if(len(set(ids)) != count):
+                raise Exception("Restored ids are not unique")
+            keys = np.arange(count, dtype=np.int64)
+            if(self.keyIds.shape[0] < count):
+                self._growKeys(count)
+            targets = self._shardAt(positions[:, 0])
+            calls = []
+            for shard in np.unique(targets):
+                members = targets == shard
+                self._reserve(int(shard), int(members.sum()))
+                calls.append((int(shard), ('add', keys[members], positions[members], mobileMask[members], velocities[members], accelerations[members])))
+            self._callMany(calls)
+            self.keyIds[:count] = ids
+            records = self.keyRecords[:count]
+            records[mobileMask] = RESTORED_MOBILE
+            records[~mobileMask] = RESTORED_STATIC
+            self.keyShard[:count] = targets
+            self.freeKeys = []
+            self._nextKey = count
+            self.keyOf = dict(zip(ids, range(count)))
+            self.agents = {id: ('m', RESTORED_MOBILE) if mobile else ('s', RESTORED_STATIC) for id, mobile in zip(ids, mobileMask.tolist())}
+            self._layoutChanged = True
+        finally:
+            self.lock.release()
+
+    def attachAgent(self, id, agent) -> bool:
+        """
+            Gives a restored record its SPADE agent, False if the id is unknown or already has one.
+        """
+        self.lock.acquire()
+        entry = self.agents.get(id)
+        attached = entry is not None and entry[1].agent is None
+        if(attached):
+            typee, record = entry
+            if(record is RESTORED_MOBILE or record is RESTORED_STATIC):
+                record = MobileAgent(agent=agent) if typee == 'm' else StaticAgent(agent=agent)
+                self.agents[id] = (typee, record)
+                self.keyRecords[self.keyOf[id]] = record
+                # published snapshots still hold the shared record
+                self._layoutChanged = True
+            else:
+                record.agent = agent
+        self.lock.release()
+        return attached
+
+    def _setKinematics(self, field: str, ids, values: np.ndarray[np.float32]) -> None:
+        values = np.asarray(values, dtype=np.float32).reshape(-1, 2)
+        self.lock.acquire()
+        try:
+            keys = np.fromiter((self.keyOf[id] for id in ids), dtype=np.int64, count=values.shape[0])
+            shards = self.keyShard[keys]
+            self._callMany([(int(shard), ('setField', keys[shards == shard], field, values[shards == shard])) for shard in np.unique(shards)])
+        finally:
+            self.lock.release()
+
+    def setVelocity(self, id, velocity: np.ndarray[np.float32]) -> None:
+        self._setKinematics('velocities', [id], velocity)
+
+    def setAcceleration(self, id, acceleration: np.ndarray[np.float32]) -> None:
+        self._setKinematics('accelerations', [id], acceleration)
+
+    def setAccelerations(self, ids, accelerations: np.ndarray[np.float32]) -> None:
+        self._setKinematics('accelerations', ids, accelerations)
+
+    def getVelocity(self, id) -> np.ndarray[np.float32]:
+        if(self.snapshotReads and id in self.snapshot.idToRow):
+            return self.snapshot.getVelocity(id)
+        return self._livePosition(id, 'velocities')
+
+    def getAcceleration(self, id) -> np.ndarray[np.float32]:
+        if(self.snapshotReads and id in self.snapshot.idToRow):
+            return self.snapshot.getAcceleration(id)
+        return self._livePosition(id, 'accelerations')
+
+    def _findAgents(self, position, radius, kind: str, lineOfSight: bool=False) -> QueryResult:
+        if(lineOfSight):
+            raise Exception("Line of sight queries are not supported by ShardedSurface")
+        self.queryCount += 1
+        if(self.snapshotReads):
+            return self.snapshot.findAgents(position, radius, kind)
+        position = np.asarray(position)
+        first, last = self._shardAt([position[0] - radius, position[0] + radius])
+        self.lock.acquire()
+        try:
+            found = self._callMany([(shard, ('find', position, radius, kind)) for shard in range(first, last + 1)])
+            keys = np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+            return QueryResult(zip(self.keyIds[keys], self.keyRecords[keys]))
+        finally:
+            self.lock.release()
+
+    def findMobileAgents(self, position: np.ndarray[np.float32], radius: float, lineOfSight: bool=False) -> list[(id, Agent)]:
+        return self._findAgents(position, radius, kind='mobile', lineOfSight=lineOfSight)
+
+    def findStaticAgents(self, position: np.ndarray[np.float32], radius: float, lineOfSight: bool=False) -> list[(id, Agent)]:
+        return self._findAgents(position, radius, kind='static', lineOfSight=lineOfSight)
+
+    def findAgents(self, position: np.ndarray[np.float32], radius: float, lineOfSight: bool=False) -> list[(id, Agent)]:
+        return self._findAgents(position, radius, kind='all', lineOfSight=lineOfSight)
+
+    def findNearest(self, position: np.ndarray[np.float32], k: int, kind: str='all') -> QueryResult:
+        self.queryCount += 1
+        return self.snapshot.findNearest(position, k, kind)
+
+    def findNearestMany(self, positions: np.ndarray[np.float32], k: int, kind: str='all') -> tuple[np.ndarray, np.ndarray]:
+        self.queryCount += len(positions)
+        return self.snapshot.findNearestMany(positions, k, kind)
+
+    def _pointsOfKind(self, kind: str) -> tuple[np.ndarray, np.ndarray]:
+        self.queryCount += 1
+        snapshot = self.snapshot
+        rows = np.flatnonzero(kindMask(snapshot.mobileMask, kind))
+        return snapshot.ids[rows], snapshot.positions[rows]
+
+    def findNeighbourPairs(self, radius: float, kind: str='mobile', csr: bool=False):
+        """
+            Same as Surface.findNeighbourPairs, computed on the last published snapshot.
+        """
+        ids, points = self._pointsOfKind(kind)
+        first, second, dist = radiusPairs(points, radius)
+        if(csr):
+            indptr, indices, distances = toCSR(len(ids), np.concatenate([first, second]), np.concatenate([second, first]), np.concatenate([dist, dist]))
+            return ids, indptr, indices, distances
+        return ids[first], ids[second], dist
+
+    def findNeighbourPairsByRadius(self, radii: dict, kind: str='mobile', defaultRadius: float=0., csr: bool=False):
+        ids, points = self._pointsOfKind(kind)
+        perAgent = np.fromiter((radii.get(id, defaultRadius) for id in ids), dtype=np.float64, count=len(ids))
+        first, second, dist = radiusPairsDirected(points, perAgent)
+        if(csr):
+            indptr, indices, distances = toCSR(len(ids), first, second, dist)
+            return ids, indptr, indices, distances
+        return ids[first], ids[second], dist
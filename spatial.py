@@ -0,0 +1,498 @@
+import heapq
+import math
+import numpy as np
+
+
+class SpatialHash():
+    """
+        Uniform grid over the plane. Every id is kept in exactly one cell
+        given by floor(position / cellSize). Radius queries return the ids
+        from the cells that overlap the query circle, the exact distance
+        check is left to the caller.
+    """
+    def __init__(self, cellSize: float) -> None:
+        if(cellSize is None or cellSize <= 0.):
+            raise Exception(f"Cell size must be positive, got: {cellSize}")
+        self.cellSize = float(cellSize)
+        self.cells = {}
+        self.idToCell = {}
+        self._source = None
+
+    def _cell(self, position) -> tuple[int, int]:
+        return (math.floor(float(position[0]) / self.cellSize), math.floor(float(position[1]) / self.cellSize))
+
+    def __len__(self) -> int:
+        self._buildPending()
+        return len(self.idToCell)
+
+    def __contains__(self, id) -> bool:
+        self._buildPending()
+        return id in self.idToCell
+
+    def insert(self, id, position: np.ndarray[np.float32]) -> None:
+        self._buildPending()
+        cell = self._cell(position)
+        self.idToCell[id] = cell
+        self.cells.setdefault(cell, set()).add(id)
+
+    def remove(self, id) -> None:
+        self._buildPending()
+        cell = self.idToCell.pop(id, None)
+        if(cell is None):
+            return
+        bucket = self.cells[cell]
+        bucket.discard(id)
+        if(not bucket):
+            del self.cells[cell]
+
+    def update(self, id, position: np.ndarray[np.float32]) -> None:
+        self._buildPending()
+        cell = self._cell(position)
+        old = self.idToCell.get(id)
+        if(old == cell):
+            return
+        if(old is not None):
+            bucket = self.cells[old]
+            bucket.discard(id)
+            if(not bucket):
+                del self.cells[old]
+        self.idToCell[id] = cell
+        self.cells.setdefault(cell, set()).add(id)
+
+    def build(self, ids, positions: np.ndarray[np.float32]) -> None:
+        """
+            Replaces the content with the given agents. Agents are sorted by cell
+            so every cell set is made from one slice instead of one add per agent.
+        """
+        self._source = None
+        ids = np.asarray(ids, dtype=object)
+        cells = np.floor(np.asarray(positions, dtype=np.float64) / self.cellSize).astype(np.int64)
+        keys = list(zip(cells[:, 0].tolist(), cells[:, 1].tolist()))
+        self.idToCell = dict(zip(ids.tolist(), keys))
+        order = np.lexsort((cells[:, 1], cells[:, 0]))
+        sortedCells = cells[order]
+        starts = np.flatnonzero(np.any(sortedCells[1:] != sortedCells[:-1], axis=1)) + 1 if len(order) else np.empty(0, dtype=np.int64)
+        firsts = np.concatenate(([0], starts)) if len(order) else starts
+        groups = np.split(ids[order], starts)
+        self.cells = dict(zip(map(tuple, sortedCells[firsts].tolist()), map(set, groups)))
+
+    def buildLater(self, source) -> None:
+        """
+            Empties the grid and builds it from source(), which returns ids and
+            positions like the arguments of build, when it is used next. Bulk
+            loads that may be followed by more bulk changes only pay for one build.
+        """
+        self.cells = {}
+        self.idToCell = {}
+        self._source = source
+
+    def _buildPending(self) -> None:
+        if(self._source is not None):
+            self.build(*self._source())
+
+    def compact(self) -> None:
+        """
+            Rebuilds the dicts, which do not shrink on their own after many removals.
+        """
+        if(self._source is not None):
+            return
+        self.cells = dict(self.cells)
+        self.idToCell = dict(self.idToCell)
+
+    def query(self, position: np.ndarray[np.float32], radius: float) -> list:
+        """
+            Candidate ids from all cells touched by the query circle.
+        """
+        self._buildPending()
+        x, y = float(position[0]), float(position[1])
+        size = self.cellSize
+        minX, maxX = math.floor((x - radius) / size), math.floor((x + radius) / size)
+        minY, maxY = math.floor((y - radius) / size), math.floor((y + radius) / size)
+
+        candidates = []
+        if((maxX - minX + 1) * (maxY - minY + 1) > len(self.cells)):
+            # the circle covers more cells than are occupied, walk the occupied ones instead
+            for (cx, cy), bucket in self.cells.items():
+                if(minX <= cx <= maxX and minY <= cy <= maxY and self._cellTouches(cx, cy, x, y, radius)):
+                    candidates.extend(bucket)
+            return candidates
+
+        for cx in range(minX, maxX + 1):
+            for cy in range(minY, maxY + 1):
+                bucket = self.cells.get((cx, cy))
+                if(bucket and self._cellTouches(cx, cy, x, y, radius)):
+                    candidates.extend(bucket)
+        return candidates
+
+    def _cellTouches(self, cx: int, cy: int, x: float, y: float, radius: float) -> bool:
+        # distance from the circle center to the closest point of the cell square
+        size = self.cellSize
+        dx = max(cx * size - x, 0., x - (cx + 1) * size)
+        dy = max(cy * size - y, 0., y - (cy + 1) * size)
+        return dx * dx + dy * dy <= radius * radius
+
+
+# cells visited from every cell so that each unordered pair of neighbouring cells is seen once
+_HALF_STENCIL = ((1, -1), (1, 0), (1, 1), (0, 1))
+
+def _cellPairs(points: np.ndarray, cellSize: float) -> tuple[np.ndarray, np.ndarray]:
+    """
+        Candidate index pairs (i, j), i != j, of points lying in the same or in
+        adjacent cells of a grid with the given cell size, every unordered pair once.
+        Points are sorted by cell key and neighbouring cells are found with
+        searchsorted, so the work is linear in the number of candidates.
+    """
+    n = points.shape[0]
+    if(n < 2):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    cells = np.floor(points / cellSize).astype(np.int64)
+    cells -= cells.min(axis=0)
+    # the extra rows keep y - 1 and y + 1 from wrapping into the neighbouring column
+    width = int(cells[:, 1].max()) + 3
+    keys = cells[:, 0] * width + cells[:, 1] + 1
+    order = np.argsort(keys, kind='stable')
+    sortedKeys = keys[order]
+
+    # the same cell, only the points sorted after the current one
+    starts = [np.arange(1, n + 1)]
+    ends = [np.searchsorted(sortedKeys, sortedKeys, side='right')]
+    for dx, dy in _HALF_STENCIL:
+        target = sortedKeys + dx * width + dy
+        starts.append(np.searchsorted(sortedKeys, target, side='left'))
+        ends.append(np.searchsorted(sortedKeys, target, side='right'))
+    starts = np.concatenate(starts)
+    ends = np.concatenate(ends)
+    counts = np.maximum(ends - starts, 0)
+
+    total = int(counts.sum())
+    src = np.repeat(np.tile(np.arange(n), len(_HALF_STENCIL) + 1), counts)
+    # position inside every run of repeated sources, added to the run start
+    runOffsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    dst = np.repeat(starts, counts) + runOffsets
+    return order[src], order[dst]
+
+def radiusPairs(points: np.ndarray, radius: float) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+        All unordered pairs (i, j, distance) of points closer than radius, i < j.
+    """
+    if(radius <= 0. or points.shape[0] < 2):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    points = np.asarray(points, dtype=np.float64)
+    first, second = _cellPairs(points, radius)
+    dist = np.linalg.norm(points[first] - points[second], axis=1)
+    keep = dist < radius
+    first, second, dist = first[keep], second[keep], dist[keep]
+    swap = first > second
+    first[swap], second[swap] = second[swap], first[swap]
+    return first, second, dist
+
+def radiusPairsDirected(points: np.ndarray, radii: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+        All ordered pairs (i, j, distance) where point j is closer than radii[i] to point i.
+        Radii within a factor 2 of each other share the symmetric grid of
+        radiusPairs, mixed radii query every point as a center with
+        radiusQueryMany, which groups them by scale, so one large radius does
+        not make the cells of all points large.
+    """
+    radii = np.asarray(radii, dtype=np.float64)
+    if(points.shape[0] < 2):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    positive = radii[radii > 0.]
+    if(positive.shape[0] and math.floor(math.log2(positive.max())) != math.floor(math.log2(positive.min()))):
+        first, second, dist = radiusQueryMany(points, points, radii)
+        other = first != second
+        return first[other], second[other], dist[other]
+    first, second, dist = radiusPairs(points, float(radii.max()))
+    forward = dist < radii[first]
+    backward = dist < radii[second]
+    return (
+        np.concatenate([first[forward], second[backward]]),
+        np.concatenate([second[forward], first[backward]]),
+        np.concatenate([dist[forward], dist[backward]]),
+    )
+
+def radiusQueryMany(points: np.ndarray, centers: np.ndarray, radii: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+        All pairs (q, i, distance) where points[i] is closer than radii[q] to
+        centers[q], sorted by q. Centers are grouped by radius, radii of a group
+        are at most a factor 2 apart, so a few large queries do not make the
+        cells of all the small ones large, see _radiusQueryGroup.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+    radii = np.broadcast_to(np.asarray(radii, dtype=np.float64), centers.shape[:1])
+    positive = np.flatnonzero(radii > 0.)
+    if(positive.shape[0] == 0 or points.shape[0] == 0):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    scales = np.floor(np.log2(radii[positive])).astype(np.int64)
+    if(np.all(scales == scales[0])):
+        return _radiusQueryGroup(points, centers, radii)
+    results = []
+    for scale in np.unique(scales):
+        group = positive[scales == scale]
+        query, point, dist = _radiusQueryGroup(points, centers[group], radii[group])
+        results.append((group[query], point, dist))
+    query, point, dist = (np.concatenate(parts) for parts in zip(*results))
+    order = np.argsort(query, kind='stable')
+    return query[order], point[order], dist[order]
+
+def _radiusQueryGroup(points: np.ndarray, centers: np.ndarray, radii: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+        radiusQueryMany for one group. The points are put in a grid with cells
+        of the largest radius and every center only looks at the 3x3 cells
+        around it, all centers at once with searchsorted like _cellPairs.
+    """
+    cellSize = float(radii.max(initial=0.))
+    if(cellSize <= 0. or points.shape[0] == 0):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    pointCells = np.floor(points / cellSize).astype(np.int64)
+    centerCells = np.floor(centers / cellSize).astype(np.int64)
+    # centers far outside the points would only widen the key space, they see no point anyway
+    low = pointCells.min(axis=0)
+    high = pointCells.max(axis=0)
+    near = np.all((centerCells >= low - 1) & (centerCells <= high + 1), axis=1)
+    queries = np.flatnonzero(near)
+    width = int(high[1] - low[1]) + 5
+    pointKeys = (pointCells[:, 0] - low[0] + 2) * width + pointCells[:, 1] - low[1] + 2
+    centerKeys = (centerCells[queries, 0] - low[0] + 2) * width + centerCells[queries, 1] - low[1] + 2
+    order = np.argsort(pointKeys, kind='stable')
+    sortedKeys = pointKeys[order]
+
+    starts, ends = [], []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            target = centerKeys + dx * width + dy
+            starts.append(np.searchsorted(sortedKeys, target, side='left'))
+            ends.append(np.searchsorted(sortedKeys, target, side='right'))
+    # cells of one center are laid out next to each other so the pairs come out grouped by query
+    starts = np.stack(starts, axis=1).ravel()
+    ends = np.stack(ends, axis=1).ravel()
+    counts = ends - starts
+    total = int(counts.sum())
+    query = np.repeat(np.repeat(queries, 9), counts)
+    runOffsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    point = order[np.repeat(starts, counts) + runOffsets]
+    dist = np.linalg.norm(points[point] - centers[query], axis=1)
+    keep = dist < radii[query]
+    return query[keep], point[keep], dist[keep]
+
+def toCSR(size: int, first: np.ndarray, second: np.ndarray, dist: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+        Packs directed pairs into (indptr, indices, distances), the neighbours
+        of node i are indices[indptr[i]:indptr[i + 1]].
+    """
+    order = np.argsort(first, kind='stable')
+    indptr = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(first, minlength=size), out=indptr[1:])
+    return indptr, second[order], dist[order]
+
+
+# below this many points KDTree builds no nodes, its queries scan all points
+KD_LINEAR_THRESHOLD = 256
+# distances computed at once by KDTree.queryMany, bounds its memory
+KD_CANDIDATE_BUDGET = 1 << 22
+
+class KDTree():
+    """
+        Static 2D KD-tree for k-nearest-neighbour queries. The tree is balanced
+        and kept in arrays, node i has the children 2i + 1 and 2i + 2 and all
+        leaves are on the last level. Nodes split the widest side of their
+        bounding box at the median until at most leafSize points are left, a
+        whole level is split by one sort. Queries walk the tree level by level
+        for all query points at once. Meant to be built once per tick and
+        queried many times.
+    """
+    def __init__(self, points: np.ndarray, leafSize: int=32, linearBelow: int=KD_LINEAR_THRESHOLD) -> None:
+        """
+            linearBelow - smaller point sets are kept in a single leaf, so queries
+            compare against all points instead of walking the tree.
+        """
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        self.leafSize = max(int(leafSize), 1)
+        self.index = np.arange(self.points.shape[0])
+        # start of every leaf and the point count, leaf i holds sortedPoints[bounds[i]:bounds[i + 1]]
+        self.bounds = np.array([0, self.points.shape[0]])
+        self.depth = 0
+        # points and their ranks along both axes in tree order, permuted along while splitting
+        self.sortedPoints = self.points.copy()
+        lows, highs = [], []
+        while True:
+            lo, hi = self._boxes()
+            lows.append(lo)
+            highs.append(hi)
+            if(self.points.shape[0] < linearBelow or np.diff(self.bounds).max() <= self.leafSize):
+                break
+            self._split(lo, hi)
+        self.lo, self.hi = np.concatenate(lows), np.concatenate(highs)
+        self._ranks = None
+        # node boxes as (x0, y0, x1, y1) lists for query, made on its first call
+        self._boxList = None
+
+    def __len__(self) -> int:
+        return self.points.shape[0]
+
+    def _boxes(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+            Bounding boxes of the nodes on the current last level, empty nodes get
+            an inverted box that is infinitely far from every point.
+        """
+        sizes = np.diff(self.bounds)
+        lo = np.full((sizes.shape[0], 2), np.inf)
+        hi = np.full((sizes.shape[0], 2), -np.inf)
+        filled = sizes > 0
+        if(filled.any()):
+            starts = self.bounds[:-1][filled]
+            lo[filled] = np.minimum.reduceat(self.sortedPoints, starts, axis=0)
+            hi[filled] = np.maximum.reduceat(self.sortedPoints, starts, axis=0)
+        return lo, hi
+
+    def _split(self, lo: np.ndarray, hi: np.ndarray) -> None:
+        """
+            Splits every node of the last level at its median by sorting all points
+            on (node, rank along the node's split axis).
+        """
+        count = self.points.shape[0]
+        if(self.depth == 0):
+            # ranks instead of coordinates keep the sort keys integer and ties ordered
+            self._ranks = np.empty((count, 2), dtype=np.int64)
+            for dim in (0, 1):
+                self._ranks[np.argsort(self.points[:, dim], kind='stable'), dim] = np.arange(count)
+        sizes = np.diff(self.bounds)
+        dims = ((hi[:, 1] - lo[:, 1]) > (hi[:, 0] - lo[:, 0])).astype(np.int64)
+        node = np.repeat(np.arange(sizes.shape[0]), sizes)
+        order = np.argsort(node * count + np.where(dims[node] == 1, self._ranks[:, 1], self._ranks[:, 0]))
+        # take is much faster than fancy indexing for rows of 2D arrays
+        self.index = self.index[order]
+        self.sortedPoints = np.take(self.sortedPoints, order, axis=0)
+        self._ranks = np.take(self._ranks, order, axis=0)
+        bounds = np.empty(2 * self.bounds.shape[0] - 1, dtype=np.int64)
+        bounds[0::2] = self.bounds
+        bounds[1::2] = (self.bounds[:-1] + self.bounds[1:]) // 2
+        self.bounds = bounds
+        self.depth += 1
+
+    def _boxDistance2(self, nodes: np.ndarray, points: np.ndarray) -> np.ndarray:
+        delta = np.maximum(np.maximum(self.lo[nodes] - points, points - self.hi[nodes]), 0.)
+        return (delta ** 2).sum(axis=1)
+
+    def _bounds2(self, points: np.ndarray, k: int) -> np.ndarray:
+        """
+            Squared distance within which each point has at least k neighbours:
+            the k-th closest point of the nearest node holding k or more points.
+        """
+        sizes = [np.diff(self.bounds[::1 << (self.depth - level)]).min() for level in range(self.depth + 1)]
+        level = max(level for level, size in enumerate(sizes) if size >= k)
+        nodes = np.zeros(points.shape[0], dtype=np.int64)
+        for _ in range(level):
+            left = 2 * nodes + 1
+            nodes = np.where(self._boxDistance2(left, points) <= self._boxDistance2(left + 1, points), left, left + 1)
+        # first leaf below each node and the number of leaves it covers
+        span = 1 << (self.depth - level)
+        firstLeaf = (nodes - ((1 << level) - 1)) * span
+        starts, ends = self.bounds[firstLeaf], self.bounds[firstLeaf + span]
+        width = int((ends - starts).max())
+        rows = starts[:, None] + np.arange(width)
+        d2 = ((self.sortedPoints[np.minimum(rows, len(self) - 1)] - points[:, None]) ** 2).sum(axis=2)
+        d2[rows >= ends[:, None]] = np.inf
+        return np.partition(d2, k - 1, axis=1)[:, k - 1]
+
+    def _leafPairs(self, points: np.ndarray, bounds2: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+            (query, leaf) pairs of leaves closer than the bound, grouped by query.
+        """
+        queries = np.arange(points.shape[0])
+        nodes = np.zeros(points.shape[0], dtype=np.int64)
+        for _ in range(self.depth):
+            queries = np.repeat(queries, 2)
+            nodes = (2 * nodes[:, None] + np.array([1, 2])).ravel()
+            keep = self._boxDistance2(nodes, points[queries]) <= bounds2[queries]
+            queries, nodes = queries[keep], nodes[keep]
+        return queries, nodes - ((1 << self.depth) - 1)
+
+    def _nodeDistance2(self, node: int, x: float, y: float) -> float:
+        x0, y0, x1, y1 = self._boxList[node]
+        dx = max(x0 - x, 0., x - x1)
+        dy = max(y0 - y, 0., y - y1)
+        return dx * dx + dy * dy
+
+    def query(self, point, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+            Indices (into the points given to the constructor) and distances of the
+            k points closest to point, sorted by distance. A single point walks the
+            tree best first, cheaper than the level by level walk of queryMany.
+        """
+        k = min(int(k), len(self))
+        if(k <= 0):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        point = np.asarray(point, dtype=np.float64).reshape(2)
+        if(self.depth == 0):
+            indices, distances = self.queryMany(point.reshape(1, 2), k)
+            return indices[0], distances[0]
+        if(self._boxList is None):
+            self._boxList = np.concatenate([self.lo, self.hi], axis=1).tolist()
+        firstLeaf = (1 << self.depth) - 1
+        x, y = float(point[0]), float(point[1])
+        bestD2 = np.empty(0, dtype=np.float64)
+        bestPos = np.empty(0, dtype=np.int64)
+        worst = math.inf
+
+        heap = [(self._nodeDistance2(0, x, y), 0)]
+        while heap:
+            d2, node = heapq.heappop(heap)
+            if(d2 >= worst):
+                break
+            if(node >= firstLeaf):
+                start, end = int(self.bounds[node - firstLeaf]), int(self.bounds[node - firstLeaf + 1])
+                leafD2 = ((self.sortedPoints[start:end] - point) ** 2).sum(axis=1)
+                bestD2 = np.concatenate([bestD2, leafD2])
+                bestPos = np.concatenate([bestPos, np.arange(start, end)])
+                if(bestD2.shape[0] > k):
+                    keep = np.argpartition(bestD2, k - 1)[:k]
+                    bestD2, bestPos = bestD2[keep], bestPos[keep]
+                if(bestD2.shape[0] == k):
+                    worst = bestD2.max()
+                continue
+            for child in (2 * node + 1, 2 * node + 2):
+                childD2 = self._nodeDistance2(child, x, y)
+                if(childD2 < worst):
+                    heapq.heappush(heap, (childD2, child))
+
+        order = np.argsort(bestD2, kind='stable')
+        return self.index[bestPos[order]], np.sqrt(bestD2[order])
+
+    def queryMany(self, points, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+            Batched query, returns (m, k) index and distance arrays. When fewer
+            than k points exist the missing entries are -1 and inf.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        k = max(int(k), 0)
+        indices = np.full((points.shape[0], k), -1, dtype=np.int64)
+        distances = np.full((points.shape[0], k), np.inf, dtype=np.float64)
+        found = min(k, len(self))
+        if(found == 0 or points.shape[0] == 0):
+            return indices, distances
+        bounds2 = self._bounds2(points, found) if self.depth else np.full(points.shape[0], np.inf)
+        queries, leaves = self._leafPairs(points, bounds2)
+        starts, sizes = self.bounds[leaves], np.diff(self.bounds)[leaves]
+        # candidates of consecutive queries, in slices of at most KD_CANDIDATE_BUDGET distances
+        perQuery = np.bincount(queries, weights=sizes, minlength=points.shape[0]).astype(np.int64)
+        queryEnds = np.cumsum(perQuery)
+        pairEnds = np.searchsorted(queries, np.arange(points.shape[0]), side='right')
+        first = 0
+        while(first < points.shape[0]):
+            offset = queryEnds[first - 1] if first else 0
+            last = max(int(np.searchsorted(queryEnds, offset + KD_CANDIDATE_BUDGET, side='right')), first + 1)
+            pairs = slice(pairEnds[first - 1] if first else 0, pairEnds[last - 1])
+            pairSizes = sizes[pairs]
+            owner = np.repeat(queries[pairs], pairSizes)
+            rows = np.repeat(starts[pairs] - np.cumsum(pairSizes) + pairSizes, pairSizes) + np.arange(owner.shape[0])
+            d2 = ((self.sortedPoints[rows] - points[owner]) ** 2).sum(axis=1)
+            order = np.lexsort((d2, owner))
+            owner, rows, d2 = owner[order], rows[order], d2[order]
+            rank = np.arange(owner.shape[0]) - np.repeat(queryEnds[first:last] - perQuery[first:last] - offset, perQuery[first:last])
+            best = rank < found
+            indices[owner[best], rank[best]] = self.index[rows[best]]
+            distances[owner[best], rank[best]] = np.sqrt(d2[best])
+            first = last
+        return indices, distances
@@ -2,52 +2,291 @@ from spade.agent import Agent
 import numpy as np
 from defaults import PROJECT_VARS
 import threading as th
+import math
+import gc
+from spatial import SpatialHash, KDTree, radiusPairs, radiusPairsDirected, toCSR
+from watch import WatchManager, WatchEvent
+from tiles import TileMap
+from cache import QueryCache
+from trajectory import TrajectoryHistory
 
 import logging
 
 
-class StaticAgent():
-    def __init__(self, agent: Agent, position: np.ndarray[np.float32]) -> None:
-        self.agent = agent
-        self.position = position
+def defaultMoveF(vec, pos):
+    return pos + vec
 
-    def getPosition(self) -> np.ndarray[np.float32]:
-        return self.position
+class StaticAgent():
+    """
+        Surface record of an agent. Positions are not kept here but in
+        the Surface position store, see Surface.getPosition.
+    """
+    __slots__ = ('agent',)
 
-    def setPosition(self, position: np.ndarray[np.float32]):
-        self.position = position
+    def __init__(self, agent: Agent) -> None:
+        self.agent = agent
 
-    def move(self, vector: np.ndarray[np.float32]) -> np.ndarray[np.float32]:
-        logger = logging.getLogger(PROJECT_VARS['ENV_LOGGER_NAME'])
+    def move(self, position: np.ndarray[np.float32], vector: np.ndarray[np.float32]) -> np.ndarray[np.float32]:
+        logger = logging.getLogger(PROJECT_VARS['GLOB_ENV_LOGGER_NAME'])
         logger.info(f"Tried to move static agent by {vector}")
-        return self.position
+        return position
 
 class MobileAgent(StaticAgent):
-    def __init__(self, agent: Agent, position: np.ndarray[np.float32], moveF: None) -> None:
-        super().__init__(agent=agent, position=position)
-        self.moveF = moveF if moveF is not None else lambda vec, pos: pos + vec
+    """
+        moveF(vec, pos) returns the new position. Surface.moveMany calls it once
+        for all agents sharing the same function, with (k, 2) arrays, so it has
+        to work on arrays as well as on single positions.
+    """
+    __slots__ = ('moveF',)
+
+    def __init__(self, agent: Agent, moveF=None) -> None:
+        super().__init__(agent=agent)
+        self.moveF = moveF if moveF is not None else defaultMoveF
+
+    def move(self, position: np.ndarray[np.float32], vector: np.ndarray[np.float32]) -> np.ndarray[np.float32]:
+        return self.moveF(pos=position, vec=vector)
+
+# shared records of restored agents until attachAgent gives them their own, see Surface.restore
+RESTORED_MOBILE = MobileAgent(agent=None)
+RESTORED_STATIC = StaticAgent(agent=None)
+
+def kindMask(mobileMask: np.ndarray[bool], kind: str) -> np.ndarray[bool]:
+    if(kind == 'mobile'):
+        return mobileMask
+    elif(kind == 'static'):
+        return ~mobileMask
+    elif(kind == 'all'):
+        return np.ones(mobileMask.shape[0], dtype=bool)
+    raise Exception(f"Unknown kind: {kind}")
+
+class QueryResult(list):
+    """
+        List of query results stamped with the snapshot they were read from.
+        epoch and step are None when the query ran on the live store.
+    """
+    def __init__(self, items=(), epoch: int=None, step: int=None) -> None:
+        super().__init__(items)
+        self.epoch = epoch
+        self.step = step
+
+class SurfaceSnapshot():
+    """
+        Immutable copy of the Surface position store published once per tick.
+        Readers only ever dereference Surface.snapshot once, so they need no lock.
+    """
+    def __init__(self, epoch: int, step: int, positions, mobileMask, ids, records, idToRow: dict, velocities=None, accelerations=None) -> None:
+        self.epoch = epoch
+        self.step = step
+        self.positions = positions
+        self.mobileMask = mobileMask
+        self.ids = ids
+        self.records = records
+        self.idToRow = idToRow
+        self.velocities = velocities if velocities is not None else np.zeros_like(positions)
+        self.accelerations = accelerations if accelerations is not None else np.zeros_like(positions)
+        for array in (positions, mobileMask, ids, records, self.velocities, self.accelerations):
+            array.flags.writeable = False
+        self._trees = {}
+
+    def getPosition(self, id) -> np.ndarray[np.float32]:
+        return self.positions[self.idToRow[id]]
+
+    def getVelocity(self, id) -> np.ndarray[np.float32]:
+        return self.velocities[self.idToRow[id]]
 
-    def move(self, vector: np.ndarray[np.float32]) -> np.ndarray[np.float32]:
-        self.position = self.moveF(pos=self.position, vec=vector)
-        return self.getPosition()
+    def getAcceleration(self, id) -> np.ndarray[np.float32]:
+        return self.accelerations[self.idToRow[id]]
+
+    def rowsWithin(self, position, radius, kind: str) -> np.ndarray[np.int64]:
+        dist = np.linalg.norm(self.positions - np.asarray(position), axis=1)
+        return np.flatnonzero((dist < radius) & kindMask(self.mobileMask, kind))
+
+    def findAgents(self, position, radius, kind: str='all', tiles: TileMap=None) -> QueryResult:
+        rows = self.rowsWithin(position, radius, kind)
+        if(tiles is not None):
+            rows = rows[tiles.segmentClear(position, self.positions[rows])]
+        return QueryResult(zip(self.ids[rows], self.records[rows]), epoch=self.epoch, step=self.step)
+
+    def tree(self, kind: str) -> tuple[np.ndarray[np.int64], KDTree]:
+        """
+            KD-tree over agents of the given kind and the snapshot rows it was built from.
+            Built on first use, so at most once per kind and tick.
+        """
+        cached = self._trees.get(kind)
+        if(cached is None):
+            rows = np.flatnonzero(kindMask(self.mobileMask, kind))
+            cached = (rows, KDTree(self.positions[rows]))
+            self._trees[kind] = cached
+        return cached
+
+    def findNearest(self, position, k: int, kind: str='all') -> QueryResult:
+        rows, tree = self.tree(kind)
+        found, dist = tree.query(position, k)
+        rows = rows[found]
+        return QueryResult(zip(self.ids[rows], self.records[rows], dist), epoch=self.epoch, step=self.step)
+
+    def findNearestMany(self, positions, k: int, kind: str='all') -> tuple[np.ndarray, np.ndarray]:
+        rows, tree = self.tree(kind)
+        found, dist = tree.queryMany(positions, k)
+        ids = np.full(found.shape, None, dtype=object)
+        ids[found >= 0] = self.ids[rows[found[found >= 0]]]
+        return ids, dist
 
 class Surface():
-    def __init__(self) -> None:
+    def __init__(self, cellSize: float=None, capacity: int=64, snapshotReads: bool=False, watchCellSize: float=10., tiles: TileMap=None, tileMoveMode: str='clip', historyLength: int=None, maxSpeed: float=None, damping: float=0., queryCacheSize: int=0, queryCacheQuantum: float=0.) -> None:
+        """
+            cellSize - if set, agents are additionally kept in a uniform grid
+            with cells of that size and radius queries only visit the cells
+            overlapping the query circle. Pick it close to the typical query radius.
+            capacity - initial number of rows of the position store.
+            snapshotReads - if set, getPosition and the find* queries read the
+            snapshot made by the last publish() without taking the lock, writers
+            keep working on the live store. Agents added since the last publish
+            are read from the live store. Without it publish() defers the copy
+            to the first reader of Surface.snapshot, see publish.
+            watchCellSize - cell size of the grid proximity watches are registered in.
+            tiles - terrain the moves of mobile agents have to respect, with
+            tileMoveMode 'clip' a blocked move stops in front of the obstacle,
+            with 'reject' the agent stays where it was.
+            historyLength - if set, the last historyLength published positions of
+            every mobile agent are kept, see recordHistory.
+            maxSpeed, damping - limit of the speed of mobile agents and the rate
+            per simulated second at which their velocity decays, see integrate.
+            queryCacheSize, queryCacheQuantum - if the size is set, the last results
+            of the radius queries are kept in a cache.QueryCache with that quantum
+            until the next change of positions or agents, see mutationEpoch.
+            Live reads start a new epoch with every move, so the cache mostly
+            helps with snapshotReads, where results live for a whole tick, or
+            in worlds where few agents move. A quantum makes results approximate.
+
+            Positions of all agents live in one (capacity, 2) float32 array.
+            Rows [0, count) are occupied, removal moves the last row into
+            the freed one so the occupied part stays contiguous. After enough
+            removals the dicts are rebuilt and the store shrinks, see _compact.
+        """
         self.agents = {}
         self.mobileAgentArray = {}
         self.staticAgentArray = {}
         self.lock = th.Lock()
+        self.grid = SpatialHash(cellSize) if cellSize is not None else None
+
+        capacity = max(int(capacity), 1)
+        self.minCapacity = capacity
+        self._removedSinceCompaction = 0
+        self.positions = np.zeros((capacity, 2), dtype=np.float32)
+        self.velocities = np.zeros((capacity, 2), dtype=np.float32)
+        self.accelerations = np.zeros((capacity, 2), dtype=np.float32)
+        self.mobileMask = np.zeros(capacity, dtype=bool)
+        self.rowIds = np.empty(capacity, dtype=object)
+        self.rowRecords = np.empty(capacity, dtype=object)
+        self.idToRow = {}
+        self.count = 0
+        # mobile agents with their own moveF, while there are none moves skip the grouping
+        self._customMoves = 0
+        # plain counters read by the metrics endpoint, see metrics.CounterFunc
+        self.queryCount = 0
+        self.moveCount = 0
+        # bumped by every change of positions or agents, cached query results of older epochs are stale
+        self.mutationEpoch = 0
+        self.queryCache = QueryCache(queryCacheSize, queryCacheQuantum) if queryCacheSize else None
+
+        if(maxSpeed is not None and maxSpeed < 0.):
+            raise Exception(f"Max speed can not be negative, got: {maxSpeed}")
+        if(damping < 0.):
+            raise Exception(f"Damping can not be negative, got: {damping}")
+        self.maxSpeed = maxSpeed
+        self.damping = damping
+
+        self.snapshotReads = snapshotReads
+        self._snapshot = None
+        self._snapshotStale = False
+        self._publishedStep = None
+        self._layoutChanged = True
+        self.publish()
+
+        self.pendingMoves = []
+        self.pendingLock = th.Lock()
+
+        self.watches = WatchManager(watchCellSize)
+        self._touched = set()
+
+        if(tileMoveMode not in ('clip', 'reject')):
+            raise Exception(f"Unknown tile move mode: {tileMoveMode}")
+        self.tiles = tiles
+        self.tileMoveMode = tileMoveMode
+        self.history = TrajectoryHistory(historyLength) if historyLength is not None else None
 
-        self.tiles = []
+    def _grow(self) -> None:
+        self._resize(self.positions.shape[0] * 2)
 
-    def addMobileAgent(self, agent: Agent, id, startPos: np.ndarray[np.float32]) -> bool:
+    def _resize(self, capacity: int) -> None:
+        positions = np.zeros((capacity, 2), dtype=np.float32)
+        positions[:self.count] = self.positions[:self.count]
+        velocities = np.zeros((capacity, 2), dtype=np.float32)
+        velocities[:self.count] = self.velocities[:self.count]
+        accelerations = np.zeros((capacity, 2), dtype=np.float32)
+        accelerations[:self.count] = self.accelerations[:self.count]
+        mobileMask = np.zeros(capacity, dtype=bool)
+        mobileMask[:self.count] = self.mobileMask[:self.count]
+        rowIds = np.empty(capacity, dtype=object)
+        rowIds[:self.count] = self.rowIds[:self.count]
+        rowRecords = np.empty(capacity, dtype=object)
+        rowRecords[:self.count] = self.rowRecords[:self.count]
+        self.positions, self.mobileMask, self.rowIds, self.rowRecords = positions, mobileMask, rowIds, rowRecords
+        self.velocities, self.accelerations = velocities, accelerations
+
+    def _addRow(self, id, record: StaticAgent, position, mobile: bool) -> None:
+        if(self.count == self.positions.shape[0]):
+            self._grow()
+        row = self.count
+        self.positions[row] = position
+        self.velocities[row] = 0.
+        self.accelerations[row] = 0.
+        self.mobileMask[row] = mobile
+        self.rowIds[row] = id
+        self.rowRecords[row] = record
+        self._layoutChanged = True
+        self.mutationEpoch += 1
+        self.idToRow[id] = row
+        self.count += 1
+        if(self.grid is not None):
+            self.grid.insert(id, self.positions[row])
+        if(self.watches):
+            self._touched.add(id)
+
+    def _removeRow(self, id) -> None:
+        row = self.idToRow.pop(id)
+        last = self.count - 1
+        if(row != last):
+            lastId = self.rowIds[last]
+            self.positions[row] = self.positions[last]
+            self.velocities[row] = self.velocities[last]
+            self.accelerations[row] = self.accelerations[last]
+            self.mobileMask[row] = self.mobileMask[last]
+            self.rowIds[row] = lastId
+            self.rowRecords[row] = self.rowRecords[last]
+            self.idToRow[lastId] = row
+        self.rowIds[last] = None
+        self.rowRecords[last] = None
+        self.count = last
+        self._layoutChanged = True
+        self.mutationEpoch += 1
+        if(self.grid is not None):
+            self.grid.remove(id)
+        if(self.watches):
+            self._touched.add(id)
+
+    def addMobileAgent(self, agent: Agent, id, startPos: np.ndarray[np.float32], moveF=None) -> bool:
         self.lock.acquire()
         if(id in self.agents):
             self.lock.release()
             return False
-        tmp = MobileAgent(agent=agent, position=startPos)
+        tmp = MobileAgent(agent=agent, moveF=moveF)
+        if(tmp.moveF is not defaultMoveF):
+            self._customMoves += 1
         self.agents[id] = ('m', tmp)
         self.mobileAgentArray[id] = tmp
+        self._addRow(id, tmp, startPos, mobile=True)
         self.lock.release()
         return True
 
@@ -59,55 +298,598 @@ class Surface():
         tmp = StaticAgent(agent=agent)
         self.agents[id] = ('s', tmp)
         self.staticAgentArray[id] = tmp
+        self._addRow(id, tmp, position, mobile=False)
         self.lock.release()
         return True
 
     def removeAgent(self, id) -> None:
         self.lock.acquire()
         if(id in self.agents):
-            typee, agent = self.agents[id]
-            self.agents[id] = None
+            typee, agent = self.agents.pop(id)
             if(typee == 'm'):
-                self.mobileAgentArray[id] = None
+                del self.mobileAgentArray[id]
+                if(agent.moveF is not defaultMoveF):
+                    self._customMoves -= 1
             elif(typee == 's'):
-                self.staticAgentArray[id] = None
+                del self.staticAgentArray[id]
             else:
                 raise Exception(f'Unknown agent type: {typee}')
-            agent.stop()
+            self._removeRow(id)
+            if(self.history is not None):
+                self.history.forget(id)
+            self._removedSinceCompaction += 1
+            if(self._removedSinceCompaction > max(self.count, self.minCapacity)):
+                self._compact()
+            if(agent.agent is not None):
+                agent.agent.stop()
         self.lock.release()
 
-    def getPosition(self, id) -> np.ndarray[np.float32]:
+    def restore(self, ids, positions: np.ndarray[np.float32], mobileMask: np.ndarray[bool], velocities: np.ndarray[np.float32]=None, accelerations: np.ndarray[np.float32]=None) -> None:
+        """
+            Fills an empty surface with many agents at once, e.g. from a checkpoint.
+            The agents share the records RESTORED_MOBILE and RESTORED_STATIC, which
+            have no SPADE agent and use the default move function, attachAgent
+            gives an agent rejoining later a record of its own. The grid is built
+            when it is first used.
+        """
+        count = len(ids)
+        mobileMask = np.asarray(mobileMask, dtype=bool)
+        # the collector would otherwise run over the dicts being filled
+        gcEnabled = gc.isenabled()
+        gc.disable()
+        self.lock.acquire()
+        try:
+            if(self.count):
+                raise Exception(f"Restore needs an empty surface, it holds {self.count} agents")
+            capacity = self.minCapacity
+            while(capacity < count):
+                capacity *= 2
+            self._resize(capacity)
+            self.positions[:count] = positions
+            self.mobileMask[:count] = mobileMask
+            if(velocities is not None):
+                self.velocities[:count] = velocities
+            if(accelerations is not None):
+                self.accelerations[:count] = accelerations
+            self.rowIds[:count] = list(ids)
+            rowIds = self.rowIds[:count]
+            mobileIds, staticIds = rowIds[mobileMask].tolist(), rowIds[~mobileMask].tolist()
+            rowRecords = self.rowRecords[:count]
+            rowRecords[mobileMask] = RESTORED_MOBILE
+            rowRecords[~mobileMask] = RESTORED_STATIC
+            ids = rowIds.tolist()
+            # dict builders keep the per-agent work in C
+            self.idToRow = dict(zip(ids, range(count)))
+            if(len(self.idToRow) != count):
+                raise Exception("Restored ids are not unique")
+            self.mobileAgentArray = dict.fromkeys(mobileIds, RESTORED_MOBILE)
+            self.staticAgentArray = dict.fromkeys(staticIds, RESTORED_STATIC)
+            self.agents = dict.fromkeys(mobileIds, ('m', RESTORED_MOBILE))
+            self.agents.update(dict.fromkeys(staticIds, ('s', RESTORED_STATIC)))
+            self.count = count
+            self._layoutChanged = True
+            self.mutationEpoch += 1
+            if(self.grid is not None):
+                self.grid.buildLater(lambda: (self.rowIds[:self.count], self.positions[:self.count]))
+            if(self.watches):
+                self._touched.update(ids)
+        except Exception:
+            self.count = 0
+            self.idToRow, self.agents, self.mobileAgentArray, self.staticAgentArray = {}, {}, {}, {}
+            raise
+        finally:
+            self.lock.release()
+            if(gcEnabled):
+                gc.enable()
+
+    def attachAgent(self, id, agent: Agent) -> bool:
+        """
+            Gives a restored record its SPADE agent, False if the id is unknown or already has one.
+        """
         self.lock.acquire()
-        tmp = self.agents[id][1].getPosition()
+        entry = self.agents.get(id)
+        attached = entry is not None and entry[1].agent is None
+        if(attached):
+            typee, record = entry
+            if(record is RESTORED_MOBILE or record is RESTORED_STATIC):
+                record = MobileAgent(agent=agent) if typee == 'm' else StaticAgent(agent=agent)
+                self.agents[id] = (typee, record)
+                (self.mobileAgentArray if typee == 'm' else self.staticAgentArray)[id] = record
+                self.rowRecords[self.idToRow[id]] = record
+                # published snapshots still hold the shared record
+                self._layoutChanged = True
+            else:
+                record.agent = agent
+            # cached query results still carry the record without its agent
+            self.mutationEpoch += 1
         self.lock.release()
-        return tmp
+        return attached
+
+    def _compact(self) -> None:
+        """
+            Dicts keep their size after deletions, so once more agents were removed
+            than are present they are rebuilt, and the position store is halved
+            while it is less than a quarter full. Expects the lock to be held.
+        """
+        self.agents = dict(self.agents)
+        self.mobileAgentArray = dict(self.mobileAgentArray)
+        self.staticAgentArray = dict(self.staticAgentArray)
+        self.idToRow = dict(self.idToRow)
+        if(self.grid is not None):
+            self.grid.compact()
+        capacity = self.positions.shape[0]
+        while(capacity // 2 >= self.minCapacity and self.count < capacity // 4):
+            capacity //= 2
+        if(capacity != self.positions.shape[0]):
+            self._resize(capacity)
+        self._removedSinceCompaction = 0
+
+    def _constrain(self, old: np.ndarray, new: np.ndarray) -> np.ndarray:
+        """
+            Applies the terrain to moves from old to new positions, (k, 2) arrays.
+        """
+        if(self.tiles is None):
+            return new
+        if(self.tileMoveMode == 'clip'):
+            return self.tiles.clipSegment(old, new)
+        return np.where(self.tiles.segmentClear(old, new)[:, None], new, old)
+
+    def publish(self, step: int=None) -> SurfaceSnapshot:
+        """
+            Copies the live store into a new immutable snapshot and swaps it in.
+            Called by the environment once per tick. Ids, records and the row map
+            are only copied when agents were added or removed since the last publish.
+            Without snapshotReads the copy is left to the first reader of
+            Surface.snapshot and skipped in ticks nobody reads it, such a
+            snapshot holds the store as it was at that read. Returns the
+            snapshot, None when the copy was deferred.
+        """
+        self.lock.acquire()
+        self._publishedStep = step
+        self._snapshotStale = True
+        if(self.snapshotReads or self._snapshot is None):
+            self._copySnapshot()
+        self.lock.release()
+        return None if self._snapshotStale else self._snapshot
+
+    @property
+    def snapshot(self) -> SurfaceSnapshot:
+        if(self._snapshotStale):
+            self.lock.acquire()
+            # another reader may have made the copy while we waited
+            if(self._snapshotStale):
+                self._copySnapshot()
+            self.lock.release()
+        return self._snapshot
+
+    def _copySnapshot(self) -> None:
+        """
+            Makes the snapshot of the last publish. Expects the lock to be held.
+        """
+        count = self.count
+        previous = self._snapshot
+        if(self._layoutChanged or previous is None):
+            mobileMask = self.mobileMask[:count].copy()
+            ids = self.rowIds[:count].copy()
+            records = self.rowRecords[:count].copy()
+            idToRow = dict(self.idToRow)
+            self._layoutChanged = False
+        else:
+            mobileMask, ids, records, idToRow = previous.mobileMask, previous.ids, previous.records, previous.idToRow
+        snapshot = SurfaceSnapshot(
+            epoch=0 if previous is None else previous.epoch + 1,
+            step=self._publishedStep,
+            positions=self.positions[:count].copy(),
+            mobileMask=mobileMask,
+            ids=ids,
+            records=records,
+            idToRow=idToRow,
+            velocities=self.velocities[:count].copy(),
+            accelerations=self.accelerations[:count].copy(),
+        )
+        self._snapshot = snapshot
+        self._snapshotStale = False
+
+    def recordHistory(self, simTime: float) -> None:
+        """
+            Appends the positions of the last published snapshot to the trajectory history.
+        """
+        if(self.history is not None):
+            self.history.recordSnapshot(self.snapshot, simTime)
+
+    def getTrajectory(self, id, t0: float=-np.inf, t1: float=np.inf) -> np.ndarray:
+        """
+            (k, 4) array of (step, simulated time, x, y) rows of the agent between t0 and t1.
+        """
+        if(self.history is None):
+            raise Exception("Trajectory history is disabled")
+        return self.history.trajectory(id, t0, t1)
+
+    def findAgentsDuring(self, position: np.ndarray[np.float32], radius: float, t0: float, t1: float) -> np.ndarray:
+        """
+            Ids of mobile agents that were closer than radius to position at some recorded time in [t0, t1].
+        """
+        if(self.history is None):
+            raise Exception("Trajectory history is disabled")
+        return self.history.findAgentsDuring(position, radius, t0, t1)
+
+    def getPositionStamped(self, id) -> tuple[np.ndarray[np.float32], int, int]:
+        """
+            Position from the published snapshot with the snapshot epoch and step.
+            Agents added since the last publish are read from the live store,
+            epoch and step are None then.
+        """
+        snapshot = self.snapshot
+        if(id in snapshot.idToRow):
+            return snapshot.getPosition(id), snapshot.epoch, snapshot.step
+        return self._readLive(self.positions, id), None, None
+
+    def _readLive(self, array: np.ndarray, id) -> np.ndarray[np.float32]:
+        self.lock.acquire()
+        try:
+            return array[self.idToRow[id]].copy()
+        finally:
+            self.lock.release()
+
+    def getPosition(self, id) -> np.ndarray[np.float32]:
+        if(self.snapshotReads):
+            snapshot = self.snapshot
+            if(id in snapshot.idToRow):
+                return snapshot.getPosition(id)
+        return self._readLive(self.positions, id)
+
+    def getPositions(self) -> np.ndarray[np.float32]:
+        """
+            Read-only (count, 2) view of the position store, row i belongs to getIds()[i].
+            No copy is made, so the view follows later moves and is only valid
+            until the next add or remove.
+        """
+        view = self.positions[:self.count]
+        view.flags.writeable = False
+        return view
+
+    def getIds(self) -> np.ndarray:
+        return self.rowIds[:self.count].copy()
 
     def move(self, id, vector: np.ndarray[np.float32]) -> np.ndarray[np.float32]:
         self.lock.acquire()
-        self.agents[id][1].move(vector)
+        self.moveCount += 1
+        self.mutationEpoch += 1
+        row = self.idToRow[id]
+        old = self.positions[row].copy()
+        self.positions[row] = self._constrain(old[None], np.reshape(self.agents[id][1].move(old.copy(), vector), (1, 2)))[0]
+        tmp = self.positions[row].copy()
+        if(self.grid is not None):
+            self.grid.update(id, tmp)
+        if(self.watches):
+            self._touched.add(id)
         self.lock.release()
+        return tmp
 
     def setPosition(self, id, position: np.ndarray[np.float32]):
         self.lock.acquire()
-        self.agents[id][1].setPosition(position)
+        self.moveCount += 1
+        self.mutationEpoch += 1
+        row = self.idToRow[id]
+        self.positions[row] = position
+        if(self.grid is not None):
+            self.grid.update(id, self.positions[row])
+        if(self.watches):
+            self._touched.add(id)
         self.lock.release()
-    
-    def _findAgents(self, position, radius, agentDict) -> list[(id, Agent)]:
+
+    def moveMany(self, ids, vectors: np.ndarray[np.float32], skipMissing: bool=False) -> None:
+        """
+            Moves many agents in one locked pass. Vectors given for the same id
+            more than once are summed first. Agents sharing a move function are
+            moved with a single call on (k, 2) arrays, static agents stay in place.
+            With skipMissing ids that are not on the surface (any more) are ignored.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, 2)
+        if(vectors.shape[0] == 0):
+            return
         self.lock.acquire()
-        toReturn = []
-        for id, (_, agent) in agentDict.items():
-            if(np.linalg.norm(position - agent.getPosition()) < radius):
-                toReturn.append((id, agent))
+        rows = np.fromiter((self.idToRow.get(id, -1) for id in ids), dtype=np.int64, count=vectors.shape[0])
+        if((rows < 0).any()):
+            if(not skipMissing):
+                self.lock.release()
+                raise KeyError(next(id for id in ids if id not in self.idToRow))
+            vectors = vectors[rows >= 0]
+            rows = rows[rows >= 0]
+        rows, inverse = np.unique(rows, return_inverse=True)
+        summed = np.zeros((rows.shape[0], 2), dtype=np.float32)
+        np.add.at(summed, inverse, vectors)
+        self._applyMoves(rows, summed)
+        self.lock.release()
+
+    def _applyMoves(self, rows: np.ndarray[np.int64], vectors: np.ndarray[np.float32]) -> None:
+        """
+            Moves the agents in the given distinct rows by vectors through their move
+            functions and the terrain. Expects the lock to be held.
+        """
+        movedIds = self.rowIds[rows]
+        mobile = self.mobileMask[rows]
+        self.moveCount += rows.shape[0]
+        self.mutationEpoch += 1
+        if(self._customMoves == 0):
+            groups = {defaultMoveF: np.flatnonzero(mobile)}
+        else:
+            groups = {}
+            for i in np.flatnonzero(mobile):
+                groups.setdefault(self.rowRecords[rows[i]].moveF, []).append(i)
+        for i in np.flatnonzero(~mobile):
+            self.rowRecords[rows[i]].move(self.positions[rows[i]], vectors[i])
+        for moveF, members in groups.items():
+            members = np.asarray(members, dtype=np.int64)
+            groupRows = rows[members]
+            old = self.positions[groupRows]
+            self.positions[groupRows] = self._constrain(old, moveF(vec=vectors[members], pos=old.copy()))
+        if(self.grid is not None):
+            for id, row in zip(movedIds, rows):
+                self.grid.update(id, self.positions[row])
+        if(self.watches):
+            self._touched.update(movedIds)
+
+    def integrate(self, dt: float) -> int:
+        """
+            Advances all mobile agents with a velocity or an acceleration by dt
+            simulated seconds in one pass: v += a * dt, v decays by exp(-damping * dt)
+            and is capped at maxSpeed, then the agent moves by v * dt through its
+            move function. When the terrain stops a move the velocity is cut to
+            what was actually travelled. Called by the environment once per tick,
+            returns the number of agents moved.
+        """
+        if(dt <= 0.):
+            return 0
+        self.lock.acquire()
+        count = self.count
+        active = np.flatnonzero(self.mobileMask[:count] & (self.velocities[:count].any(axis=1) | self.accelerations[:count].any(axis=1)))
+        if(active.shape[0] == 0):
+            self.lock.release()
+            return 0
+        velocities = self.velocities[active] + self.accelerations[active] * np.float32(dt)
+        if(self.damping > 0.):
+            velocities *= np.float32(math.exp(-self.damping * dt))
+        if(self.maxSpeed is not None):
+            speed = np.linalg.norm(velocities, axis=1)
+            over = speed > self.maxSpeed
+            velocities[over] *= (self.maxSpeed / speed[over])[:, None]
+        old = self.positions[active]
+        self._applyMoves(active, velocities * np.float32(dt))
+        if(self.tiles is not None):
+            velocities = (self.positions[active] - old) / np.float32(dt)
+        self.velocities[active] = velocities
+        self.lock.release()
+        return active.shape[0]
+
+    def _rowsOf(self, ids, count: int) -> np.ndarray[np.int64]:
+        rows = np.fromiter((self.idToRow[id] for id in ids), dtype=np.int64, count=count)
+        if(not self.mobileMask[rows].all()):
+            raise Exception("Only mobile agents have a velocity and an acceleration")
+        return rows
+
+    def setVelocity(self, id, velocity: np.ndarray[np.float32]) -> None:
+        self.lock.acquire()
+        try:
+            self.velocities[self._rowsOf([id], 1)] = velocity
+        finally:
+            self.lock.release()
+
+    def setAcceleration(self, id, acceleration: np.ndarray[np.float32]) -> None:
+        """
+            The acceleration stays in effect until it is changed, integrate applies it every tick.
+        """
+        self.setAccelerations([id], acceleration)
+
+    def setAccelerations(self, ids, accelerations: np.ndarray[np.float32]) -> None:
+        accelerations = np.asarray(accelerations, dtype=np.float32).reshape(-1, 2)
+        self.lock.acquire()
+        try:
+            self.accelerations[self._rowsOf(ids, accelerations.shape[0])] = accelerations
+        finally:
+            self.lock.release()
+
+    def getVelocity(self, id) -> np.ndarray[np.float32]:
+        if(self.snapshotReads):
+            snapshot = self.snapshot
+            if(id in snapshot.idToRow):
+                return snapshot.getVelocity(id)
+        return self._readLive(self.velocities, id)
+
+    def getAcceleration(self, id) -> np.ndarray[np.float32]:
+        if(self.snapshotReads):
+            snapshot = self.snapshot
+            if(id in snapshot.idToRow):
+                return snapshot.getAcceleration(id)
+        return self._readLive(self.accelerations, id)
+
+    def setPositions(self, ids, positions: np.ndarray[np.float32]) -> None:
+        """
+            Sets positions of many agents in one locked pass.
+        """
+        positions = np.asarray(positions, dtype=np.float32).reshape(-1, 2)
+        if(positions.shape[0] == 0):
+            return
+        self.lock.acquire()
+        self.moveCount += positions.shape[0]
+        self.mutationEpoch += 1
+        rows = np.fromiter((self.idToRow[id] for id in ids), dtype=np.int64, count=positions.shape[0])
+        self.positions[rows] = positions
+        if(self.grid is not None):
+            for id, row in zip(self.rowIds[rows], rows):
+                self.grid.update(id, self.positions[row])
+        if(self.watches):
+            self._touched.update(self.rowIds[rows])
+        self.lock.release()
+
+    def queueMove(self, id, vector: np.ndarray[np.float32]) -> None:
+        """
+            Stores the move until the next flushMoves, which the environment calls once per tick.
+        """
+        self.pendingLock.acquire()
+        self.pendingMoves.append((id, vector))
+        self.pendingLock.release()
+
+    def flushMoves(self) -> int:
+        self.pendingLock.acquire()
+        pending = self.pendingMoves
+        self.pendingMoves = []
+        self.pendingLock.release()
+        if(pending):
+            ids, vectors = zip(*pending)
+            # agents may have left since they queued the move
+            self.moveMany(ids, np.asarray(vectors, dtype=np.float32), skipMissing=True)
+        return len(pending)
+
+    def addWatch(self, radius: float, center: np.ndarray[np.float32]=None, anchorId=None, kind: str='mobile', callback=None) -> int:
+        """
+            Registers a standing proximity watch around a fixed center or around the
+            agent anchorId and returns its id. callback(WatchEvent) is called from
+            updateWatches for every agent entering or leaving the circle, agents
+            inside at registration time are reported as entering.
+        """
+        self.lock.acquire()
+        try:
+            watchId = self.watches.add(self, radius=radius, kind=kind, center=center, anchorId=anchorId, callback=callback)
+        finally:
+            self.lock.release()
+        return watchId
+
+    def removeWatch(self, watchId: int) -> None:
+        self.lock.acquire()
+        self.watches.remove(watchId)
+        self.lock.release()
+
+    def updateWatches(self, step: int=None) -> list[WatchEvent]:
+        """
+            Turns the agents added, moved or removed since the last call into
+            enter/leave events and hands them to the watch callbacks.
+            Called by the environment once per tick.
+        """
+        self.lock.acquire()
+        touched, self._touched = self._touched, set()
+        events = self.watches.update(self, touched, step=step)
+        self.lock.release()
+        self.watches.dispatch(events)
+        return events
+
+    def _rowsWithin(self, position, radius, kind: str, grid: SpatialHash=None) -> np.ndarray[np.int64]:
+        """
+            Rows of agents of the given kind that are closer than radius to position.
+            grid - index of all agents to take the candidates from, by default the
+            surface grid if there is one. Expects the lock to be held.
+        """
+        position = np.asarray(position)
+        grid = self.grid if grid is None else grid
+        if(grid is not None):
+            rows = np.fromiter((self.idToRow[id] for id in grid.query(position, radius)), dtype=np.int64)
+            dist = np.linalg.norm(self.positions[rows] - position, axis=1)
+            return rows[(dist < radius) & kindMask(self.mobileMask[rows], kind)]
+        rows = slice(0, self.count)
+        dist = np.linalg.norm(self.positions[rows] - position, axis=1)
+        return np.flatnonzero((dist < radius) & kindMask(self.mobileMask[rows], kind))
+
+    def _findAgents(self, position, radius, kind: str, lineOfSight: bool=False) -> QueryResult:
+        tiles = self.tiles if lineOfSight else None
+        if(lineOfSight and tiles is None):
+            raise Exception("Line of sight queries need a tile map")
+        self.queryCount += 1
+        cache = self.queryCache
+        if(cache is not None):
+            key = cache.key(position, radius, kind, lineOfSight)
+        if(self.snapshotReads):
+            snapshot = self.snapshot
+            if(cache is None):
+                return snapshot.findAgents(position, radius, kind, tiles=tiles)
+            # snapshots never change, their epoch is enough to tag the results
+            cached = cache.get(key, ('snapshot', snapshot.epoch))
+            if(cached is None):
+                cached = snapshot.findAgents(position, radius, kind, tiles=tiles)
+                cache.put(key, ('snapshot', snapshot.epoch), cached)
+            return QueryResult(cached, epoch=cached.epoch, step=cached.step)
+        self.lock.acquire()
+        if(cache is not None):
+            cached = cache.get(key, self.mutationEpoch)
+            if(cached is not None):
+                self.lock.release()
+                return QueryResult(cached)
+        rows = self._rowsWithin(position, radius, kind)
+        if(tiles is not None):
+            rows = rows[tiles.segmentClear(position, self.positions[rows])]
+        toReturn = QueryResult(zip(self.rowIds[rows], self.rowRecords[rows]))
+        if(cache is not None):
+            cache.put(key, self.mutationEpoch, QueryResult(toReturn))
         self.lock.release()
         return toReturn
 
-    def findMobileAgents(self, position: np.ndarray[np.float32], radius: float) -> list[(id, Agent)]:
-        return self._findAgents(position, radius, agentDict=self.mobileAgentArray)
+    def findMobileAgents(self, position: np.ndarray[np.float32], radius: float, lineOfSight: bool=False) -> list[(id, Agent)]:
+        return self._findAgents(position, radius, kind='mobile', lineOfSight=lineOfSight)
 
-    def findStaticAgents(self, position: np.ndarray[np.float32], radius: float) -> list[(id, Agent)]:
-        return self._findAgents(position, radius, agentDict=self.staticAgentArray)
+    def findStaticAgents(self, position: np.ndarray[np.float32], radius: float, lineOfSight: bool=False) -> list[(id, Agent)]:
+        return self._findAgents(position, radius, kind='static', lineOfSight=lineOfSight)
 
-    def findAgents(self, position: np.ndarray[np.float32], radius: float) -> list[(id, Agent)]:
-        tmp = self.findMobileAgents(position, radius)
-        tmp.extend(self.findStaticAgents(position, radius))
-        return tmp
+    def findAgents(self, position: np.ndarray[np.float32], radius: float, lineOfSight: bool=False) -> list[(id, Agent)]:
+        return self._findAgents(position, radius, kind='all', lineOfSight=lineOfSight)
+
+    def _pointsOfKind(self, kind: str) -> tuple[np.ndarray, np.ndarray]:
+        self.queryCount += 1
+        if(self.snapshotReads):
+            snapshot = self.snapshot
+            rows = np.flatnonzero(kindMask(snapshot.mobileMask, kind))
+            return snapshot.ids[rows], snapshot.positions[rows]
+        self.lock.acquire()
+        rows = np.flatnonzero(kindMask(self.mobileMask[:self.count], kind))
+        points = self.positions[rows]
+        ids = self.rowIds[rows]
+        self.lock.release()
+        return ids, points
+
+    def _packPairs(self, ids, first, second, dist, csr: bool):
+        if(csr):
+            indptr, indices, distances = toCSR(len(ids), first, second, dist)
+            return ids, indptr, indices, distances
+        return ids[first], ids[second], dist
+
+    def findNearest(self, position: np.ndarray[np.float32], k: int, kind: str='all') -> QueryResult:
+        """
+            The k agents of the given kind closest to position as (id, agent, distance),
+            nearest first. Served from the KD-tree of the snapshot published at the
+            last tick, so moves made since then are not visible yet.
+            kind is 'mobile', 'static' or 'all'.
+        """
+        self.queryCount += 1
+        return self.snapshot.findNearest(position, k, kind)
+
+    def findNearestMany(self, positions: np.ndarray[np.float32], k: int, kind: str='all') -> tuple[np.ndarray, np.ndarray]:
+        """
+            Batched findNearest for (m, 2) query points. Returns (m, k) arrays of ids
+            and distances, padded with None and inf when fewer than k agents exist.
+        """
+        self.queryCount += len(positions)
+        return self.snapshot.findNearestMany(positions, k, kind)
+
+    def findNeighbourPairs(self, radius: float, kind: str='mobile', csr: bool=False):
+        """
+            Every unordered pair of agents of the given kind closer than radius.
+            The lock is held only while the positions are copied.
+
+            Returns (idsA, idsB, distances) arrays with each pair once, or with csr=True
+            (ids, indptr, indices, distances) where the neighbours of ids[i] are
+            ids[indices[indptr[i]:indptr[i + 1]]], listed in both directions.
+        """
+        ids, points = self._pointsOfKind(kind)
+        first, second, dist = radiusPairs(points, radius)
+        if(csr):
+            first, second, dist = np.concatenate([first, second]), np.concatenate([second, first]), np.concatenate([dist, dist])
+        return self._packPairs(ids, first, second, dist, csr)
+
+    def findNeighbourPairsByRadius(self, radii: dict, kind: str='mobile', defaultRadius: float=0., csr: bool=False):
+        """
+            Directed variant of findNeighbourPairs where every agent has its own radius,
+            e.g. its broadcast range. A pair (a, b, distance) means b is closer to a than radii[a].
+            Agents missing from radii use defaultRadius.
+        """
+        ids, points = self._pointsOfKind(kind)
+        perAgent = np.fromiter((radii.get(id, defaultRadius) for id in ids), dtype=np.float64, count=len(ids))
+        first, second, dist = radiusPairsDirected(points, perAgent)
+        return self._packPairs(ids, first, second, dist, csr)
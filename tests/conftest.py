@@ -0,0 +1,48 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+# the modules live flat in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def projectVars(monkeypatch, tmp_path):
+    """
+        Sets PROJECT_VARS entries for one test, logs go to tmp_path.
+    """
+    from defaults import PROJECT_VARS
+    monkeypatch.setitem(PROJECT_VARS, 'LOG_DIR', os.path.join(str(tmp_path), ''))
+    def update(**values) -> None:
+        for key, value in values.items():
+            monkeypatch.setitem(PROJECT_VARS, key, value)
+    return update
+
+def populateSurface(surface, rng, ids) -> dict:
+    """
+        Adds the agents ids (or range(ids) for a count) at random positions in
+        [0, 100)², every fourth one static. Returns the positions by id.
+    """
+    positions = {}
+    for index, id in enumerate(range(ids) if isinstance(ids, int) else ids):
+        positions[id] = rng.uniform(0., 100., 2).astype(np.float32)
+        if(index % 4):
+            surface.addMobileAgent(agent=None, id=id, startPos=positions[id])
+        else:
+            surface.addStaticAgent(agent=None, id=id, position=positions[id])
+    return positions
+
+def resultIds(result) -> list:
+    """
+        Sorted ids of a radius query result.
+    """
+    return sorted(id for id, *_ in result)
+
+@pytest.fixture
+def populate():
+    return populateSurface
+
+@pytest.fixture
+def foundIds():
+    return resultIds
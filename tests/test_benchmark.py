@@ -0,0 +1,31 @@
+import asyncio
+import numpy as np
+import pytest
+import benchmark
+
+
+def test_linear_nearest_matches_tree():
+    rng = np.random.default_rng(0)
+    surface = benchmark.populateSurface(500, rng)
+    surface.publish(step=0)
+    for point in rng.uniform(0., benchmark.BENCH_SIDE, (20, 2)):
+        assert np.array_equal(benchmark.linearNearest(surface, point, 5), [id for id, _, _ in surface.findNearest(point, 5)])
+
+def test_headless_run_reports_ticks(projectVars):
+    # the environment module needs pandas
+    pytest.importorskip('pandas')
+    projectVars(ENV_SHARDS=1)
+    result = asyncio.run(benchmark.runHeadless(count=200, ticks=5, queries=3, movers=0.5, radius=50., seed=0))
+    assert result['agents'] == 200 and result['ticks'] == 5
+    assert result['ticksPerSec'] > 0. and result['tickP99Ms'] >= result['tickP50Ms'] > 0.
+    assert result['queryP99Us'] >= result['queryP50Us'] > 0.
+    assert {'moves', 'publish'} <= set(result['stageMeanMs'])
+    assert result['surfaceBytes'] > 0
+
+def test_event_run_stops_at_duration(projectVars):
+    pytest.importorskip('pandas')
+    projectVars(ENV_SHARDS=1)
+    result = asyncio.run(benchmark.runEvents(count=10, duration=100., interval=10., seed=0))
+    assert result['simSeconds'] >= 100. and result['events'] >= 10
+    # only the ticks with due events are stepped through
+    assert result['steps'] <= result['events']
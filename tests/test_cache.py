@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from cache import QueryCache
+from surface import Surface
+
+
+def test_new_epoch_drops_cached_results():
+    cache = QueryCache(size=4)
+    key = cache.key((1., 2.), 3., 'all')
+    assert cache.get(key, 0) is None
+    cache.put(key, 0, 'result')
+    assert cache.get(key, 0) == 'result'
+    assert cache.get(key, 1) is None
+    assert cache.invalidations == 1 and cache.hits == 1 and cache.misses == 2
+    # a result of an older epoch is not stored once a newer one was seen
+    cache.put(key, 0, 'stale')
+    assert cache.get(key, 1) is None
+
+def test_least_recently_used_result_is_evicted():
+    cache = QueryCache(size=2)
+    keys = [cache.key((float(x), 0.), 1., 'all') for x in range(3)]
+    cache.get(keys[0], 0)
+    cache.put(keys[0], 0, 0)
+    cache.put(keys[1], 0, 1)
+    assert cache.get(keys[0], 0) == 0
+    cache.put(keys[2], 0, 2)
+    assert cache.get(keys[1], 0) is None
+    assert cache.get(keys[0], 0) == 0 and cache.get(keys[2], 0) == 2
+
+def test_quantum_shares_keys_of_close_positions():
+    cache = QueryCache(quantum=1.)
+    assert cache.key((0.2, 0.4), 5., 'all') == cache.key((-0.3, 0.1), 5., 'all')
+    assert cache.key((0.2, 0.4), 5., 'all') != cache.key((0.7, 0.4), 5., 'all')
+    assert QueryCache().key((0.2, 0.4), 5., 'all') != QueryCache().key((0.21, 0.4), 5., 'all')
+    with pytest.raises(Exception):
+        QueryCache(size=0)
+
+@pytest.mark.parametrize('snapshotReads', [False, True])
+def test_cached_surface_matches_uncached(snapshotReads, populate, foundIds):
+    rng = np.random.default_rng(0)
+    cached, plain = Surface(snapshotReads=snapshotReads, queryCacheSize=16), Surface(snapshotReads=snapshotReads)
+    populate(cached, np.random.default_rng(1), 200)
+    populate(plain, np.random.default_rng(1), 200)
+    # a few repeated query positions so the cache gets hits
+    centers = rng.uniform(0., 100., (5, 2))
+    for step in range(100):
+        if(step % 3 == 0):
+            ids = [int(id) for id in rng.choice(200, 20, replace=False)]
+            vectors = rng.normal(0., 3., (len(ids), 2)).astype(np.float32)
+            cached.moveMany(ids, vectors)
+            plain.moveMany(ids, vectors)
+        if(step % 5 == 0):
+            cached.publish(step=step)
+            plain.publish(step=step)
+        center = centers[rng.integers(0, 5)]
+        assert foundIds(cached.findAgents(center, 20.)) == foundIds(plain.findAgents(center, 20.))
+    assert cached.queryCache.hits > 0
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from checkpoint import writeCheckpoint, readCheckpoint
+from surface import Surface, RESTORED_MOBILE
+
+
+@pytest.mark.parametrize('ids', [list(range(0, 600, 2)), [f'agent{id}@host' for id in range(300)]])
+def test_checkpoint_round_trip_and_restore(tmp_path, ids, populate, foundIds):
+    rng = np.random.default_rng(0)
+    original = Surface(cellSize=5.)
+    populate(original, rng, ids)
+    for id in original.mobileAgentArray:
+        original.setVelocity(id, rng.normal(0., 1., 2).astype(np.float32))
+    original.publish(step=7)
+    path = str(tmp_path / 'state.ckpt')
+    writeCheckpoint(path, original.snapshot, simTime=3.5)
+    checkpoint = readCheckpoint(path)
+    assert list(checkpoint.ids) == list(original.snapshot.ids)
+    assert checkpoint.step == 7 and checkpoint.simTime == 3.5
+    assert np.array_equal(checkpoint.positions, original.snapshot.positions)
+    restored = Surface(cellSize=5.)
+    restored.restore(checkpoint.ids, checkpoint.positions, checkpoint.mobileMask, checkpoint.velocities, checkpoint.accelerations)
+    for id in ids:
+        assert np.array_equal(restored.getPosition(id), original.getPosition(id))
+        assert np.array_equal(restored.getVelocity(id), original.getVelocity(id))
+    assert sorted(restored.mobileAgentArray) == sorted(original.mobileAgentArray)
+    # the grid is built on the first query after restore
+    for _ in range(20):
+        center, radius = rng.uniform(0., 100., 2), float(rng.uniform(1., 40.))
+        assert foundIds(restored.findAgents(center, radius)) == foundIds(original.findAgents(center, radius))
+        assert foundIds(restored.findMobileAgents(center, radius)) == foundIds(original.findMobileAgents(center, radius))
+
+def test_attach_agent_replaces_shared_record():
+    surface = Surface()
+    surface.restore([1, 2], np.zeros((2, 2), dtype=np.float32), np.array([True, True]))
+    surface.publish(step=0)
+    agent = object()
+    assert surface.attachAgent(1, agent)
+    assert not surface.attachAgent(1, object())
+    assert not surface.attachAgent(3, object())
+    assert surface.mobileAgentArray[1].agent is agent
+    assert surface.mobileAgentArray[2] is RESTORED_MOBILE and RESTORED_MOBILE.agent is None
+    surface.publish(step=1)
+    assert surface.snapshot.records[surface.snapshot.idToRow[1]].agent is agent
+
+@pytest.mark.parametrize('ids', [[1, 'a'], [1.5, 2.5]])
+def test_checkpoint_rejects_unsupported_ids(tmp_path, ids):
+    surface = Surface()
+    for id in ids:
+        surface.addStaticAgent(agent=None, id=id, position=np.zeros(2, dtype=np.float32))
+    surface.publish(step=0)
+    with pytest.raises(Exception):
+        writeCheckpoint(str(tmp_path / 'state.ckpt'), surface.snapshot, simTime=0.)
+
+def test_empty_checkpoint(tmp_path):
+    path = str(tmp_path / 'state.ckpt')
+    writeCheckpoint(path, Surface().snapshot, simTime=0.)
+    checkpoint = readCheckpoint(path)
+    assert len(checkpoint.ids) == 0 and checkpoint.positions.shape == (0, 2)
+    restored = Surface()
+    restored.restore(checkpoint.ids, checkpoint.positions, checkpoint.mobileMask)
+    assert restored.count == 0
+
+def test_attach_agent_invalidates_cached_queries():
+    surface = Surface(queryCacheSize=8)
+    surface.restore([1, 2], np.array([[0., 0.], [1., 0.]], dtype=np.float32), np.array([True, False]))
+    assert all(record.agent is None for _, record in surface.findAgents([0., 0.], 5.))
+    agent = object()
+    assert surface.attachAgent(1, agent)
+    assert dict(surface.findAgents([0., 0.], 5.))[1].agent is agent
@@ -0,0 +1,148 @@
+import asyncio
+import time
+import numpy as np
+import pytest
+
+# environment.py imports message.py, which needs pandas
+pytest.importorskip('pandas')
+from spade.message import Message as SpadeMessage
+import environment as env
+
+
+async def started(agent):
+    await agent.setup()
+    await agent.timebehav.on_start()
+    return agent.timebehav
+
+@pytest.mark.parametrize('agentClass', [env.LocalEnvironment, env.LocalEnvironmentHost])
+def test_event_mode_ignores_messages_nobody_consumes(projectVars, agentClass):
+    projectVars(ENV_TIME_MODE='EVENT', ENV_TICKS=None, ENV_EVENT_IDLE_SLEEP=0.)
+    async def main():
+        behaviour = await started(agentClass('local@localhost', 'pw'))
+        behaviour.queue.put_nowait(SpadeMessage(to='local@localhost', body='unrelated'))
+        for _ in range(5):
+            await behaviour.run()
+        return behaviour
+    behaviour = asyncio.run(main())
+    assert behaviour.stepCounter == 0 and behaviour.lastSimTime == 0.
+
+def test_event_mode_steps_once_for_a_received_query(projectVars):
+    projectVars(ENV_TIME_MODE='EVENT', ENV_TICKS=None, ENV_EVENT_IDLE_SLEEP=0.)
+    async def main():
+        behaviour = await started(env.GlobalEnvironmentAgent('env@localhost', 'pw'))
+        behaviour.queue.put_nowait(SpadeMessage(to='env@localhost', body='{}'))
+        for _ in range(5):
+            await behaviour.run()
+        return behaviour
+    behaviour = asyncio.run(main())
+    # the query stage drains the queue, then there is nothing left to do
+    assert behaviour.stepCounter == 1 and behaviour.queue.empty()
+
+@pytest.mark.parametrize('name, value', [('ENV_TILE_MAP', 'map.tiles'), ('ENV_QUERY_CACHE_SIZE', 64)])
+def test_sharded_surface_refuses_unsupported_settings(projectVars, name, value):
+    projectVars(ENV_SHARDS=2, **{name: value})
+    with pytest.raises(Exception, match=name):
+        env.makeSurface()
+
+def test_sharded_surface_gets_kinematics_settings(projectVars):
+    projectVars(ENV_SHARDS=2, ENV_MAX_SPEED=3., ENV_DAMPING=0.5)
+    surface = env.makeSurface()
+    try:
+        assert isinstance(surface, env.ShardedSurface)
+        assert surface.maxSpeed == 3. and surface.damping == 0.5
+    finally:
+        surface.close()
+
+def fixedRun(name: str, ticks: int):
+    """
+        Global environment in FIXED mode whose agents random-walk on its rng.
+    """
+    async def main():
+        agent = env.GlobalEnvironmentAgent(f'{name}@localhost', 'pw')
+        behaviour = await started(agent)
+        for id in range(20):
+            await agent.addAgent(None, 'mobile', id, startPos=agent.rng.uniform(0., 100., 2).astype(np.float32))
+        def walk():
+            for id in range(20):
+                agent.surface.queueMove(id=id, vector=agent.rng.normal(0., 1., 2).astype(np.float32))
+        behaviour.pipeline.add('walk', walk, before='moves')
+        for _ in range(ticks):
+            await behaviour.run()
+        return agent, np.array([agent.surface.getPosition(id) for id in range(20)])
+    return asyncio.run(main())
+
+def test_fixed_mode_is_exact_and_repeatable(projectVars):
+    projectVars(ENV_TIME_MODE='FIXED', ENV_TICKS=10, ENV_SIM_SPEED=2., ENV_SEED=7)
+    first, positions = fixedRun('first', ticks=25)
+    second, again = fixedRun('second', ticks=25)
+    behaviour = first.timebehav
+    assert behaviour.stepCounter == 25 and behaviour.lastSimTime == 25 * 2. / 10
+    assert first.get(env.ENV_TIME_SIM_SECONDS) == behaviour.lastSimTime
+    assert first.get(env.ENV_TIME_SIM_PER_WALL) > 0.
+    assert np.array_equal(positions, again)
+
+@pytest.mark.parametrize('sleepType, yields', [('SLEEP', True), ('HYBRID', True), ('LOOP', False)])
+def test_sleep_types_wake_at_deadline(projectVars, sleepType, yields):
+    projectVars(ENV_TIME_MODE='REALTIME', ENV_TICKS=10, ENV_SLEEP_TYPE=sleepType, ENV_SPIN_TAIL=0.002)
+    async def main():
+        behaviour = await started(env.GlobalEnvironmentAgent('env@localhost', 'pw'))
+        ran = []
+        async def other():
+            ran.append(time.monotonic_ns())
+        deadline = time.monotonic_ns() + 20e+6
+        task = asyncio.ensure_future(other())
+        await behaviour.sleepTypeF(deadline)
+        woke = time.monotonic_ns()
+        await task
+        return deadline, woke, ran[0]
+    deadline, woke, other = asyncio.run(main())
+    # asyncio.sleep alone may wake a little early, the spinning types do not
+    assert woke >= deadline - (2e+6 if sleepType == 'SLEEP' else 0)
+    # only LOOP keeps the event loop to itself until the deadline
+    assert (other < deadline) == yields
+
+def test_late_tick_skips_missed_deadlines_without_drift(projectVars):
+    projectVars(ENV_TIME_MODE='REALTIME', ENV_TICKS=10, ENV_SLEEP_TYPE='HYBRID')
+    async def main():
+        behaviour = await started(env.GlobalEnvironmentAgent('env@localhost', 'pw'))
+        interval = 1e+9 / 10
+        start = time.monotonic_ns() - 5.5 * interval
+        behaviour.nextDeadline = start
+        await behaviour._customAwait()
+        assert behaviour.skippedTicks == 4 and behaviour.nextDeadline == start + 5 * interval
+        assert behaviour.tickOverruns.value == 1 and behaviour.tickLateness.count == 1
+        await behaviour._customAwait()
+        # back on the original grid, waited for instead of skipped
+        assert behaviour.skippedTicks == 4 and behaviour.nextDeadline == start + 6 * interval
+        assert behaviour.tickOverruns.value == 1 and time.monotonic_ns() >= behaviour.nextDeadline
+    asyncio.run(main())
+
+def test_host_serves_wearers_from_one_array(projectVars):
+    projectVars(ENV_TIME_MODE='FIXED', ENV_TICKS=10, ENV_SEED=3)
+    async def main():
+        globalEnv = env.GlobalEnvironmentAgent('env@localhost', 'pw')
+        globalBehaviour = await started(globalEnv)
+        host = env.LocalEnvironmentHost('host@localhost', 'pw', capacity=2)
+        hostBehaviour = await started(host)
+        with pytest.raises(Exception, match='not bound'):
+            host.attach(0)
+        host.bind(globalEnv)
+        for id in range(5):
+            await globalEnv.addAgent(None, 'mobile', id, startPos=np.array([id, 0.], dtype=np.float32))
+        environments = [host.attach(id) for id in range(5)]
+        assert host.positions.shape[0] == 8 and host.attach(3) is environments[3]
+        position = await environments[3].getPosition()
+        assert position.tolist() == [3., 0.]
+        await globalEnv.setAgentVector(3, np.array([0., 2.], dtype=np.float32))
+        await globalBehaviour.run()
+        await hostBehaviour.run()
+        # a view, moved in place by the host's tick
+        assert position.tolist() == [3., 2.] and (await environments[4].getPosition()).tolist() == [4., 0.]
+        pulse = await environments[1].getPulse()
+        assert np.shares_memory(pulse, globalEnv.sensors.pulse) and 30. < float(pulse) < 120.
+        host.detach(1)
+        assert 1 not in globalEnv.sensors.idToSlot and 1 not in host.environments
+        host.detach(1)
+        # the freed slot is reused
+        assert host.attach(1).agentId == 1 and host.positions.shape[0] == 8
+    asyncio.run(main())
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+from events import EventQueue
+
+
+def test_events_run_in_time_then_scheduling_order():
+    queue = EventQueue()
+    ran = []
+    for time, name in ((2., 'c'), (1., 'a'), (2., 'd'), (1., 'b'), (5., 'e')):
+        queue.schedule(time, lambda time, name: ran.append((time, name)), name)
+    assert queue.peek() == 1.
+    assert queue.runDue(2.) == 4
+    assert ran == [(1., 'a'), (1., 'b'), (2., 'c'), (2., 'd')]
+    assert len(queue) == 1 and queue.peek() == 5.
+
+def test_cancel_before_and_after_popping():
+    queue = EventQueue()
+    ran = []
+    first = queue.schedule(1., lambda time: ran.append('first'))
+    queue.schedule(2., lambda time: queue.cancel(third))
+    third = queue.schedule(2., lambda time: ran.append('third'))
+    queue.schedule(3., lambda time: ran.append('fourth'))
+    queue.cancel(first)
+    queue.cancel(first)
+    assert len(queue) == 3 and queue.cancelledCount == 1
+    assert queue.peek() == 2.
+    # third is already popped when the earlier callback cancels it
+    assert queue.runDue(2.) == 1
+    assert ran == [] and len(queue) == 1 and queue.cancelledCount == 0
+    assert queue.runDue(3.) == 1 and ran == ['fourth']
+    assert len(queue) == 0 and queue.peek() is None
+
+def test_events_scheduled_by_callbacks_wait_for_next_call():
+    queue = EventQueue()
+    ran = []
+    def reschedule(time):
+        ran.append(time)
+        queue.schedule(time, reschedule)
+    queue.schedule(1., reschedule)
+    assert queue.runDue(1.) == 1
+    assert queue.runDue(1.) == 1
+    assert ran == [1., 1.] and len(queue) == 1
+
+@pytest.mark.parametrize('seed', range(5))
+def test_random_schedule_and_cancel_matches_sorted_list(seed):
+    rng = np.random.default_rng(seed)
+    queue = EventQueue()
+    reference = []
+    live = []
+    ran = []
+    now = 0.
+    for index in range(600):
+        action = rng.random()
+        if(action < 0.55):
+            # coarse times so many events tie
+            time = now + float(rng.integers(0, 20))
+            event = queue.schedule(time, lambda time, index: ran.append((time, index)), index)
+            reference.append((time, index))
+            live.append((event, (time, index)))
+        elif(action < 0.8 and live):
+            event, entry = live.pop(int(rng.integers(0, len(live))))
+            queue.cancel(event)
+            reference.remove(entry)
+        else:
+            now += float(rng.integers(0, 10))
+            reference.sort()
+            expected = [entry for entry in reference if entry[0] <= now]
+            reference = [entry for entry in reference if entry[0] > now]
+            live = [(event, entry) for event, entry in live if entry[0] > now]
+            del ran[:]
+            assert queue.runDue(now) == len(expected)
+            assert ran == expected
+        assert len(queue) == len(reference)
+        assert queue.peek() == (min(reference)[0] if reference else None)
@@ -0,0 +1,73 @@
+import asyncio
+import types
+from spade.message import Message as SpadeMessage
+from spade.template import Template
+from spade_fix.behaviour import CyclicBehaviour
+import loopback
+from loopback import LoopbackServer
+
+
+def fakeAgent(jid: str, *templates):
+    """
+        What the server uses of a SPADE agent: its jid, loop and the queues of its behaviours.
+    """
+    behaviours = [types.SimpleNamespace(queue=asyncio.Queue(), match=template.match) for template in templates]
+    return types.SimpleNamespace(jid=jid, loop=asyncio.get_running_loop(), behaviours=behaviours, traces=types.SimpleNamespace(append=lambda msg, category: None))
+
+def message(sender: str, to: str, kind: str) -> SpadeMessage:
+    msg = SpadeMessage(to=to, sender=sender, body='hello')
+    msg.set_metadata('kind', kind)
+    return msg
+
+def test_messages_reach_matching_behaviours():
+    async def main():
+        server = LoopbackServer()
+        receiver = fakeAgent('b@localhost', Template(metadata={'kind': 'ping'}), Template(metadata={'kind': 'pong'}))
+        server.register(receiver)
+        server._offline.add('a@localhost')
+        assert server.deliver(message('a@localhost', 'b@localhost/resource', 'ping'))
+        assert server.deliver(message('a@localhost', 'b@localhost', 'other'))
+        # known to the server but reachable through XMPP only
+        assert not server.deliver(message('c@localhost', 'd@localhost', 'ping'))
+        assert server.deliver(message('a@localhost', 'd@localhost', 'ping'))
+        ping, pong = receiver.behaviours
+        assert ping.queue.qsize() == 1 and pong.queue.empty()
+        assert ping.queue.get_nowait().body == 'hello'
+        assert (server.delivered, server.unmatched, server.dropped) == (1, 1, 1)
+    asyncio.run(main())
+
+def test_installed_server_intercepts_send():
+    async def main():
+        server = LoopbackServer().install()
+        try:
+            sender = types.SimpleNamespace(agent=fakeAgent('a@localhost'))
+            receiver = fakeAgent('b@localhost', Template(metadata={'kind': 'ping'}))
+            server.register(receiver)
+            msg = message('a@localhost', 'b@localhost', 'ping')
+            await CyclicBehaviour.send(sender, msg)
+            assert msg.sent
+            assert receiver.behaviours[0].queue.get_nowait() is msg
+            assert loopback.activeServer() is server
+        finally:
+            server.uninstall()
+        assert loopback.activeServer() is None
+        assert CyclicBehaviour.send is loopback.removeSendHook.__globals__['_send']
+    asyncio.run(main())
+
+def test_start_runs_setup_and_behaviours_without_xmpp():
+    async def main():
+        server = LoopbackServer()
+        ran = []
+        agent = fakeAgent('a@localhost')
+        agent._alive = asyncio.Event()
+        async def setup():
+            ran.append('setup')
+        agent.setup = setup
+        agent.behaviours = [types.SimpleNamespace(is_running=False, queue=None, start=lambda: ran.append('start'), kill=lambda: ran.append('kill'))]
+        server.register(agent)
+        await server._start(agent)
+        assert ran == ['setup', 'start'] and agent._alive.is_set()
+        server.stop(agent)
+        assert ran[-1] == 'kill' and not agent._alive.is_set()
+        assert not server.isRegistered('a@localhost')
+    asyncio.run(main())
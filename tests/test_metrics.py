@@ -0,0 +1,51 @@
+import math
+import time
+import numpy as np
+import pytest
+from metrics import Histogram, MetricsRegistry
+
+
+def test_histogram_percentiles_are_within_bucket_error():
+    histogram = Histogram('latency', "Latency", lowest=1e-6, highest=10., subBuckets=16)
+    values = np.random.default_rng(0).lognormal(-7., 1.5, 20000)
+    for value in values:
+        histogram.record(float(value))
+    for q in (50., 90., 99., 99.9):
+        exact = np.percentile(values, q)
+        # the upper bound of a bucket is at most 1 / subBuckets above its values
+        assert exact <= histogram.percentile(q) <= exact * (1. + 1. / 16) * 1.001
+    assert histogram.count == 20000 and math.isclose(histogram.sum, values.sum())
+
+def test_histogram_counts_values_out_of_range():
+    histogram = Histogram('latency', "Latency", lowest=1e-3, highest=1.)
+    assert histogram.percentile(50.) == 0.
+    for value in (0., 1e-4, 0.5, 100.):
+        histogram.record(value)
+    assert histogram.counts[0] == 2 and histogram.counts[-1] == 1
+    assert histogram.percentile(100.) == math.inf
+
+def test_registry_exposition():
+    registry = MetricsRegistry(prefix='env_')
+    counter = registry.counter('ticks_total', "Ticks")
+    counter.inc()
+    counter.inc(2)
+    assert registry.counter('ticks_total', "Ticks") is counter
+    state = {'moves': 5}
+    registry.counterFunc('moves_total', "Moves", lambda: state['moves'])
+    histogram = registry.histogram('tick_seconds', "Tick", lowest=1e-3, highest=1.)
+    histogram.record(0.003)
+    state['moves'] = 7
+    lines = registry.exposition().splitlines()
+    assert '# TYPE env_ticks_total counter' in lines and 'env_ticks_total 3' in lines
+    assert 'env_moves_total 7' in lines
+    assert 'env_tick_seconds_bucket{le="0.002"} 0' in lines and 'env_tick_seconds_bucket{le="0.004"} 1' in lines
+    assert 'env_tick_seconds_bucket{le="+Inf"} 1' in lines and 'env_tick_seconds_count 1' in lines
+
+def test_recording_is_cheap():
+    histogram = Histogram('latency', "Latency")
+    count = 200000
+    start = time.perf_counter()
+    for _ in range(count):
+        histogram.record(0.0005)
+    # generous bound, the recording itself is well below a microsecond
+    assert (time.perf_counter() - start) / count < 5e-6
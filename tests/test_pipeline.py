@@ -0,0 +1,51 @@
+import threading as th
+import time
+import pytest
+from pipeline import TickPipeline
+
+
+def test_stages_run_in_order_at_their_rate():
+    pipeline = TickPipeline()
+    ran = []
+    pipeline.add('b', lambda: ran.append('b'))
+    pipeline.add('c', lambda: ran.append('c'), every=2)
+    pipeline.add('a', lambda: ran.append('a'), before='b')
+    for tick in range(1, 5):
+        pipeline.run(tick)
+    assert ran == ['a', 'b', 'a', 'b', 'c', 'a', 'b', 'a', 'b', 'c']
+    pipeline.remove('a')
+    assert [stage.name for stage in pipeline.stages] == ['b', 'c']
+    with pytest.raises(Exception, match='already exists'):
+        pipeline.add('b', lambda: None)
+    with pytest.raises(Exception, match='Unknown stage'):
+        pipeline.add('d', lambda: None, before='missing')
+    with pytest.raises(Exception):
+        pipeline.add('e', lambda: None, every=0)
+
+def test_parallel_stages_run_concurrently():
+    pipeline = TickPipeline(workers=2)
+    barrier = th.Barrier(2, timeout=5.)
+    ran = []
+    # each stage waits for the other, so they only finish when run at the same time
+    pipeline.add('left', barrier.wait, parallel=True)
+    pipeline.add('right', barrier.wait, parallel=True)
+    pipeline.add('after', lambda: ran.append(barrier.n_waiting))
+    try:
+        pipeline.run(1)
+    finally:
+        pipeline.close()
+    assert ran == [0]
+    assert pipeline.pool is None
+
+def test_stage_timings_are_recorded():
+    pipeline = TickPipeline()
+    pipeline.add('slow', lambda: time.sleep(0.01))
+    pipeline.add('rare', lambda: None, every=10)
+    pipeline.run(1)
+    timings = pipeline.timings()
+    last, mean = timings['slow']
+    assert last >= 10. and mean == last
+    assert timings['rare'] == (0., 0.)
+    assert pipeline.lastTime >= 0.01
+    pipeline.run(2)
+    assert pipeline.stages[0].runs == 2 and pipeline.stages[1].runs == 0
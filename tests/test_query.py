@@ -0,0 +1,71 @@
+import json
+import numpy as np
+import pytest
+
+# message.py needs pandas
+pytest.importorskip('pandas')
+from message import Message
+from query import QueryBatcher, makeQuery, readReply
+from surface import Surface
+
+
+def published() -> Surface:
+    surface = Surface()
+    for id in range(20):
+        surface.addMobileAgent(agent=None, id=id, startPos=np.array([id, 0.], dtype=np.float32))
+    surface.publish(step=0)
+    return surface
+
+def query(sender: str, queryType, **fields):
+    queryId, msg = makeQuery(sender, 'env@localhost', queryType, **fields)
+    msg.sender = sender
+    return queryId, msg
+
+def tampered(sender: str, queryType, key: str, value, **fields):
+    """
+        Valid query whose field key is replaced after encoding, the way a
+        misbehaving agent would send it.
+    """
+    queryId, msg = query(sender, queryType, **fields)
+    content = json.loads(msg.body)
+    content[key] = value
+    msg.body = json.dumps(content)
+    return queryId, msg
+
+@pytest.mark.parametrize('queryType, key, value, fields', [
+    (Message.QueryType.FIND_AGENTS, Message.POSITION, [1., 2., 3.], dict(position=[0., 0.], radius=1.)),
+    (Message.QueryType.FIND_AGENTS, Message.POSITION, ['a', 'b'], dict(position=[0., 0.], radius=1.)),
+    (Message.QueryType.FIND_AGENTS, Message.RADIUS, -1., dict(position=[0., 0.], radius=1.)),
+    (Message.QueryType.FIND_NEAREST, Message.K, 0, dict(position=[0., 0.], k=1)),
+    (Message.QueryType.FIND_NEAREST, Message.AGENT_KIND, 'bogus', dict(position=[0., 0.], k=1)),
+    (Message.QueryType.POSITION, Message.AGENT_ID, [1, 2], dict(agentId=1)),
+])
+def test_malformed_query_gets_error_and_batch_is_answered(queryType, key, value, fields):
+    batcher = QueryBatcher('env@localhost')
+    badId, bad = tampered('a@localhost', queryType, key, value, **fields)
+    findId, find = query('a@localhost', Message.QueryType.FIND_AGENTS, position=[5., 0.], radius=1.5)
+    nearestId, nearest = query('b@localhost', Message.QueryType.FIND_NEAREST, position=[5.2, 0.], k=2)
+    positionId, position = query('b@localhost', Message.QueryType.POSITION, agentId=7)
+    for msg in (bad, find, nearest, position):
+        batcher.submit(msg)
+    assert batcher.rejected == 1
+    replies = {str(reply.to): readReply(reply, reply.to) for reply in batcher.answer(published().snapshot)}
+    assert Message.ERROR in replies['a@localhost'][badId]
+    assert sorted(replies['a@localhost'][findId][Message.AGENT_IDS]) == [4, 5, 6]
+    assert replies['b@localhost'][nearestId][Message.AGENT_IDS] == [5, 6]
+    assert replies['b@localhost'][positionId][Message.POSITION] == [7., 0.]
+    assert not batcher.pending
+
+def test_failing_batch_falls_back_to_single_queries():
+    batcher = QueryBatcher('env@localhost')
+    queryIds = []
+    for position in ([5., 0.], [12., 0.]):
+        queryId, msg = query('a@localhost', Message.QueryType.FIND_AGENTS, position=position, radius=1.5)
+        batcher.submit(msg)
+        queryIds.append(queryId)
+    # bypasses validation, e.g. a field that only fails once computed
+    batcher.pending[0][2].position = np.array([1., 2., 3.])
+    reply, = batcher.answer(published().snapshot)
+    results = readReply(reply, reply.to)
+    assert Message.ERROR in results[queryIds[0]]
+    assert results[queryIds[1]][Message.AGENT_IDS] == [11, 12, 13]
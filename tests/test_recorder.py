@@ -0,0 +1,103 @@
+import io
+import types
+import zlib
+import numpy as np
+import pytest
+from recorder import Recorder, Replayer, CHUNK_MAGIC, CHUNK_HEADER
+from surface import Surface
+
+
+def state(surface: Surface) -> dict:
+    return {id: (tuple(surface.getPosition(id).tolist()), id in surface.mobileAgentArray) for id in surface.idToRow}
+
+def run(path: str, seed: int, ticks: int) -> list:
+    """
+        Records a random run and returns the surface state after every tick.
+    """
+    rng = np.random.default_rng(seed)
+    surface = Surface()
+    recorder = Recorder(path, chunkTicks=7)
+    nextId = 0
+    states = []
+    for step in range(ticks):
+        for _ in range(int(rng.integers(0, 6))):
+            position = rng.uniform(0., 100., 2).astype(np.float32)
+            if(rng.random() < 0.7):
+                surface.addMobileAgent(agent=None, id=nextId, startPos=position)
+            else:
+                surface.addStaticAgent(agent=None, id=nextId, position=position)
+            nextId += 1
+        present = list(surface.idToRow)
+        if(present and rng.random() < 0.5):
+            surface.removeAgent(int(rng.choice(present)))
+        mobile = list(surface.mobileAgentArray)
+        if(mobile):
+            ids = [int(id) for id in rng.choice(mobile, min(len(mobile), 4), replace=False)]
+            surface.moveMany(ids, rng.normal(0., 2., (len(ids), 2)).astype(np.float32))
+        recorder.recordMessage(types.SimpleNamespace(sender='a@host', to='b@host', metadata={'step': str(step)}, body=str(step)))
+        surface.publish(step=step)
+        recorder.record(surface.snapshot, simTime=step * 0.5)
+        states.append(state(surface))
+    recorder.close()
+    return states
+
+def test_replay_matches_recorded_run(tmp_path):
+    path = str(tmp_path / 'run.tlog')
+    states = run(path, seed=0, ticks=40)
+    surface = Surface()
+    ticks = list(Replayer(path).ticks())
+    assert len(ticks) == len(states)
+    for step, (tick, expected) in enumerate(zip(ticks, states)):
+        assert tick.step == step and tick.simTime == step * 0.5
+        assert tick.messages == [('a@host', 'b@host', {'step': str(step)}, str(step))]
+        Replayer.apply(surface, tick)
+        assert state(surface) == expected
+
+def test_second_recorder_overwrites_log(tmp_path):
+    path = str(tmp_path / 'run.tlog')
+    run(path, seed=1, ticks=30)
+    states = run(path, seed=2, ticks=10)
+    surface = Surface()
+    ticks = list(Replayer(path).ticks())
+    assert len(ticks) == len(states)
+    for tick in ticks:
+        Replayer.apply(surface, tick)
+    assert state(surface) == states[-1]
+
+def test_str_ids_and_message_bodies_round_trip(tmp_path):
+    path = str(tmp_path / 'run.tlog')
+    surface = Surface()
+    recorder = Recorder(path)
+    surface.addMobileAgent(agent=None, id='walker@localhost', startPos=np.array([1., 2.], dtype=np.float32))
+    surface.addStaticAgent(agent=None, id='sensor@localhost', position=np.array([3., 4.], dtype=np.float32))
+    recorder.recordMessage(types.SimpleNamespace(sender='a@host', to='b@host', metadata=None, body=None))
+    surface.publish(step=0)
+    recorder.record(surface.snapshot, simTime=0.)
+    recorder.close()
+    tick, = Replayer(path).ticks()
+    assert sorted(tick.addIds.tolist()) == ['sensor@localhost', 'walker@localhost']
+    assert tick.messages == [('a@host', 'b@host', {}, None)]
+
+def test_replayer_refuses_pickled_columns(tmp_path):
+    path = str(tmp_path / 'run.tlog')
+    Recorder(path).close()
+    buffer = io.BytesIO()
+    np.lib.format.write_array(buffer, np.array([object()], dtype=object), allow_pickle=True)
+    compressed = zlib.compress(buffer.getvalue())
+    header = np.array([(CHUNK_MAGIC, 1, 0, len(buffer.getvalue()), len(compressed))], dtype=CHUNK_HEADER)
+    with open(path, 'ab') as file:
+        file.write(header.tobytes() + compressed)
+    with pytest.raises(ValueError):
+        list(Replayer(path).ticks())
+
+def test_mixed_ids_round_trip(tmp_path):
+    path = str(tmp_path / 'run.tlog')
+    surface = Surface()
+    recorder = Recorder(path)
+    for id in (1, 'two', 2 ** 70):
+        surface.addStaticAgent(agent=None, id=id, position=np.zeros(2, dtype=np.float32))
+    surface.publish(step=0)
+    recorder.record(surface.snapshot, simTime=0.)
+    recorder.close()
+    tick, = Replayer(path).ticks()
+    assert sorted(tick.addIds.tolist(), key=str) == sorted([1, 'two', 2 ** 70], key=str)
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+from sensors import SensorModel
+from surface import Surface
+
+
+def wornSurface(count: int) -> Surface:
+    surface = Surface()
+    for id in range(count):
+        surface.addMobileAgent(agent=None, id=id, startPos=np.array([10. * id, 0.], dtype=np.float32))
+    surface.publish(step=0)
+    return surface
+
+def models(count: int, seed: int):
+    """
+        Two models drawing the same random numbers for the same wearers.
+    """
+    pair = (SensorModel(capacity=count, rng=np.random.default_rng(seed)), SensorModel(capacity=count, rng=np.random.default_rng(seed)))
+    for model in pair:
+        for id in range(count):
+            model.addWearer(id)
+    return pair
+
+def test_views_follow_updates_and_survive_growth():
+    surface = wornSurface(6)
+    model = SensorModel(capacity=2, rng=np.random.default_rng(0))
+    model.addWearer(0)
+    pulse = model.view(0, 'pulse')
+    base = float(model.basePulse[model.idToSlot[0]])
+    model.update(surface.snapshot, simTime=0., dt=1.)
+    before = float(pulse)
+    assert abs(before - base) < 20.
+    model.update(surface.snapshot, simTime=1., dt=1.)
+    assert float(pulse) != before
+    for id in range(1, 6):
+        model.addWearer(id)
+    assert model.capacity == 8 and model.basePulse[model.idToSlot[0]] == np.float32(base)
+    model.update(surface.snapshot, simTime=2., dt=1.)
+    temperature = np.array([model.view(id, 'temperature') for id in range(6)])
+    assert ((temperature > 35.) & (temperature < 38.5)).all()
+    assert model.view(3, 'bloodPressure').shape == (2,)
+    with pytest.raises(Exception, match='Unknown signal'):
+        model.view(0, 'glucose')
+
+def test_anomalies_shift_readings_until_they_end():
+    surface = wornSurface(4)
+    plain, sick = models(4, seed=1)
+    sick.injectAnomaly(0, 'fever', until=5.)
+    sick.injectAnomaly(1, 'tachycardia', until=5., strength=0.5)
+    sick.injectAnomaly(2, 'hypertension', until=5.)
+    with pytest.raises(Exception, match='Unknown anomaly'):
+        sick.injectAnomaly(3, 'hiccups', until=5.)
+    for simTime in (1., 2., 6.):
+        for model in (plain, sick):
+            model.update(surface.snapshot, simTime=simTime, dt=1.)
+        ongoing = simTime < 5.
+        assert np.isclose(sick.temperature[0] - plain.temperature[0], 2.5 * ongoing, atol=1e-4)
+        assert np.isclose(sick.pulse[1] - plain.pulse[1], 30. * ongoing, atol=1e-3)
+        assert np.allclose(sick.bloodPressure[2] - plain.bloodPressure[2], np.array([40., 25.]) * ongoing, atol=1e-3)
+        assert sick.pulse[3] == plain.pulse[3]
+
+def test_moving_wearer_gets_active_and_missing_ones_keep_still():
+    surface = wornSurface(3)
+    model = SensorModel(capacity=4, rng=np.random.default_rng(2), activityTau=2.)
+    for id in range(4):
+        model.addWearer(id)
+    # wearer 3 is not on the surface, wearer 2 is taken off it after the first tick
+    model.update(surface.snapshot, simTime=0., dt=1.)
+    surface.removeAgent(2)
+    for step in range(1, 11):
+        surface.moveMany([0], np.array([[3., 0.]], dtype=np.float32))
+        surface.publish(step=step)
+        model.update(surface.snapshot, simTime=float(step), dt=1.)
+    slots = [model.idToSlot[id] for id in range(4)]
+    assert model.activity[slots[0]] > 0.9
+    assert (model.activity[slots[1:]] == 0.).all()
+    # fresh wearers start at rest instead of jumping from the origin
+    assert (np.abs(model.acceleration[slots[1:]]) < 1.).all()
+    model.removeWearer(3)
+    assert 3 not in model.idToSlot and model.freeSlots == [slots[3]]
@@ -0,0 +1,132 @@
+import numpy as np
+import pytest
+from shard import ShardedSurface
+from surface import Surface
+
+
+def test_sharded_surface_matches_single_surface(populate, foundIds):
+    rng = np.random.default_rng(0)
+    sharded, single = ShardedSurface(shards=3, bounds=(0., 100.), capacity=1000), Surface()
+    try:
+        populate(sharded, np.random.default_rng(1), 300)
+        populate(single, np.random.default_rng(1), 300)
+        for step in range(40):
+            present = sorted(single.idToRow)
+            mobile = [id for id in present if id % 4]
+            # large steps so agents keep crossing strip boundaries
+            ids = [int(id) for id in rng.choice(mobile, 30, replace=False)]
+            vectors = rng.normal(0., 20., (len(ids), 2)).astype(np.float32)
+            sharded.moveMany(ids, vectors)
+            single.moveMany(ids, vectors)
+            # removed ids come back later and reuse freed shard keys
+            removed = int(rng.choice(present))
+            sharded.removeAgent(removed)
+            single.removeAgent(removed)
+            if(step % 3 == 0):
+                id = int(rng.choice([id for id in range(300) if id not in single.idToRow]))
+                position = rng.uniform(0., 100., 2).astype(np.float32)
+                sharded.addMobileAgent(agent=None, id=id, startPos=position)
+                single.addMobileAgent(agent=None, id=id, startPos=position)
+            for id in ids:
+                if(id != removed):
+                    assert np.allclose(sharded.getPosition(id), single.getPosition(id))
+            center, radius = rng.uniform(-10., 110., 2), float(rng.uniform(1., 60.))
+            assert foundIds(sharded.findAgents(center, radius)) == foundIds(single.findAgents(center, radius))
+            assert foundIds(sharded.findMobileAgents(center, radius)) == foundIds(single.findMobileAgents(center, radius))
+            assert foundIds(sharded.findStaticAgents(center, radius)) == foundIds(single.findStaticAgents(center, radius))
+            snapshot = sharded.publish(step=step)
+            assert sorted(snapshot.ids.tolist()) == sorted(single.idToRow)
+            for id, row in snapshot.idToRow.items():
+                assert np.allclose(snapshot.positions[row], single.getPosition(id))
+                assert snapshot.mobileMask[row] == bool(id in single.mobileAgentArray)
+    finally:
+        sharded.close()
+
+def test_agents_added_since_publish_are_read_live():
+    sharded = ShardedSurface(shards=2, bounds=(0., 100.), capacity=16, snapshotReads=True)
+    try:
+        sharded.addMobileAgent(agent=None, id='late', startPos=np.array([70., 5.], dtype=np.float32))
+        assert sharded.getPosition('late').tolist() == [70., 5.]
+        position, epoch, step = sharded.getPositionStamped('late')
+        assert position.tolist() == [70., 5.] and epoch is None and step is None
+        assert sharded.getVelocity('late').tolist() == [0., 0.]
+        assert sharded.getAcceleration('late').tolist() == [0., 0.]
+    finally:
+        sharded.close()
+
+def test_full_shard_grows_and_keeps_migrating_agents(foundIds):
+    sharded = ShardedSurface(shards=2, bounds=(0., 100.), capacity=4)
+    try:
+        for id in range(10):
+            sharded.addMobileAgent(agent=None, id=id, startPos=np.array([10. + id, 0.], dtype=np.float32))
+        sharded.setVelocity(3, np.array([1., 2.], dtype=np.float32))
+        # every agent crosses into the other strip at once
+        sharded.moveMany(list(range(10)), np.full((10, 2), [60., 0.], dtype=np.float32))
+        assert [arrays.header[0] for arrays in sharded.arrays] == [0, 10]
+        assert sharded.arrays[1].capacity >= 10
+        assert sharded.keyShard[[sharded.keyOf[id] for id in range(10)]].tolist() == [1] * 10
+        for id in range(10):
+            assert sharded.getPosition(id).tolist() == [70. + id, 0.]
+        assert sharded.getVelocity(3).tolist() == [1., 2.]
+        assert foundIds(sharded.findAgents(np.array([75., 0.]), 3.)) == [3, 4, 5, 6, 7]
+        assert sorted(sharded.publish(step=0).ids.tolist()) == list(range(10))
+    finally:
+        sharded.close()
+
+def test_kinematics_match_single_surface():
+    rng = np.random.default_rng(0)
+    sharded = ShardedSurface(shards=3, bounds=(0., 100.), capacity=8, maxSpeed=15., damping=0.1)
+    single = Surface(maxSpeed=15., damping=0.1)
+    try:
+        for id in range(60):
+            position = rng.uniform(0., 100., 2).astype(np.float32)
+            for surface in (sharded, single):
+                if(id % 5):
+                    surface.addMobileAgent(agent=None, id=id, startPos=position)
+                else:
+                    surface.addStaticAgent(agent=None, id=id, position=position)
+        mobile = [id for id in range(60) if id % 5]
+        accelerations = rng.normal(0., 8., (len(mobile) - 1, 2)).astype(np.float32)
+        for surface in (sharded, single):
+            surface.setVelocity(1, np.array([-30., 0.], dtype=np.float32))
+            surface.setAccelerations(mobile[1:], accelerations)
+        for _ in range(20):
+            assert sharded.integrate(0.5) == single.integrate(0.5)
+        snapshot = sharded.publish(step=0)
+        for id in range(60):
+            assert np.allclose(sharded.getPosition(id), single.getPosition(id), atol=1e-3)
+            assert np.allclose(snapshot.getVelocity(id), single.getVelocity(id), atol=1e-4)
+        with pytest.raises(Exception, match='Only mobile agents'):
+            sharded.setVelocity(0, np.array([1., 0.], dtype=np.float32))
+    finally:
+        sharded.close()
+
+def test_restore_and_attach():
+    sharded = ShardedSurface(shards=2, bounds=(0., 100.), capacity=4)
+    try:
+        ids = [f'agent{index}' for index in range(100)]
+        positions = np.stack([np.arange(100.), np.zeros(100)], axis=1).astype(np.float32)
+        velocities = np.zeros((100, 2), dtype=np.float32)
+        velocities[:, 1] = 1.
+        sharded.restore(ids, positions, np.arange(100) % 2 == 0, velocities=velocities)
+        assert sharded.integrate(1.) == 50
+        assert sharded.getPosition('agent10').tolist() == [10., 1.] and sharded.getPosition('agent11').tolist() == [11., 0.]
+        agent = object()
+        assert sharded.attachAgent('agent10', agent) and not sharded.attachAgent('agent10', agent)
+        assert dict(sharded.findAgents(np.array([10., 1.]), 0.5))['agent10'].agent is agent
+        sharded.addMobileAgent(agent=None, id='new', startPos=np.array([0., 0.], dtype=np.float32))
+        assert len(sharded.publish(step=0).ids) == 101
+    finally:
+        sharded.close()
+
+def test_unsupported_features_raise():
+    sharded = ShardedSurface(shards=2, bounds=(0., 100.), capacity=4)
+    try:
+        with pytest.raises(Exception, match='additive'):
+            sharded.addMobileAgent(agent=None, id=0, startPos=np.zeros(2, dtype=np.float32), moveF=lambda pos, vec: pos)
+        with pytest.raises(Exception, match='watches'):
+            sharded.addWatch(5., center=np.zeros(2, dtype=np.float32))
+        with pytest.raises(Exception, match='Line of sight'):
+            sharded.findAgents(np.zeros(2), 5., lineOfSight=True)
+    finally:
+        sharded.close()
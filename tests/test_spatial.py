@@ -0,0 +1,167 @@
+import numpy as np
+import pytest
+import spatial
+from spatial import SpatialHash, KDTree, radiusPairs, radiusPairsDirected, radiusQueryMany, toCSR
+
+
+def bruteWithin(points: dict, center, radius: float) -> set:
+    return {id for id, point in points.items() if np.linalg.norm(np.asarray(point) - center) < radius}
+
+@pytest.mark.parametrize('seed', range(5))
+def test_spatial_hash_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    grid = SpatialHash(cellSize=float(rng.uniform(1., 20.)))
+    points = {}
+    for step in range(2000):
+        action = rng.random()
+        if(action < 0.4 or not points):
+            id = int(rng.integers(500))
+            points[id] = rng.uniform(-50., 50., 2)
+            if(id in grid):
+                grid.update(id, points[id])
+            else:
+                grid.insert(id, points[id])
+        elif(action < 0.6):
+            id = int(rng.choice(list(points)))
+            del points[id]
+            grid.remove(id)
+        elif(action < 0.8):
+            id = int(rng.choice(list(points)))
+            points[id] = points[id] + rng.normal(0., 5., 2)
+            grid.update(id, points[id])
+        else:
+            center, radius = rng.uniform(-60., 60., 2), float(rng.uniform(0.1, 40.))
+            candidates = grid.query(center, radius)
+            assert len(candidates) == len(set(candidates))
+            assert bruteWithin(points, center, radius) <= set(candidates)
+    assert len(grid) == len(points)
+
+def test_spatial_hash_build_matches_inserts():
+    rng = np.random.default_rng(0)
+    ids = list(range(300))
+    positions = rng.uniform(0., 100., (300, 2)).astype(np.float32)
+    built, inserted = SpatialHash(7.), SpatialHash(7.)
+    built.build(ids, positions)
+    for id, position in zip(ids, positions):
+        inserted.insert(id, position)
+    assert built.idToCell == inserted.idToCell
+    assert built.cells == inserted.cells
+
+def test_spatial_hash_build_later_uses_current_source():
+    positions = {1: np.array([1., 1.]), 2: np.array([50., 50.])}
+    grid = SpatialHash(10.)
+    grid.buildLater(lambda: (list(positions), np.array(list(positions.values()))))
+    positions[3] = np.array([2., 2.])
+    assert sorted(grid.query(np.array([0., 0.]), 5.)) == [1, 3]
+    grid.remove(3)
+    assert sorted(grid.query(np.array([0., 0.]), 5.)) == [1]
+
+def test_spatial_hash_rejects_bad_cell_size():
+    with pytest.raises(Exception):
+        SpatialHash(0.)
+
+def brutePairs(points: np.ndarray, radius: float) -> set:
+    dist = np.linalg.norm(points[:, None] - points[None], axis=2)
+    first, second = np.nonzero(np.triu(dist < radius, k=1))
+    return set(zip(first.tolist(), second.tolist()))
+
+@pytest.mark.parametrize('seed', range(5))
+def test_radius_pairs_match_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    points = rng.uniform(-50., 50., (int(rng.integers(0, 400)), 2))
+    radius = float(rng.uniform(0.5, 30.))
+    first, second, dist = radiusPairs(points, radius)
+    assert np.all(first < second)
+    assert set(zip(first.tolist(), second.tolist())) == brutePairs(points, radius)
+    assert len(first) == len(brutePairs(points, radius))
+    assert np.allclose(dist, np.linalg.norm(points[first] - points[second], axis=1))
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('spread', ['uniform', 'one scale', 'one large', 'mixed with zeros'])
+def test_radius_pairs_directed_match_brute_force(seed, spread):
+    rng = np.random.default_rng(seed)
+    points = rng.uniform(0., 100., (300, 2))
+    radii = {
+        'uniform': rng.uniform(0., 25., 300),
+        'one scale': rng.uniform(8., 15.9, 300),
+        'one large': np.where(np.arange(300) == 7, 300., 5.),
+        'mixed with zeros': rng.choice([0., 0.7, 4., 30.], 300),
+    }[spread]
+    first, second, dist = radiusPairsDirected(points, radii)
+    full = np.linalg.norm(points[:, None] - points[None], axis=2)
+    expected = (full < radii[:, None]) & ~np.eye(300, dtype=bool)
+    assert set(zip(first.tolist(), second.tolist())) == set(zip(*(axis.tolist() for axis in np.nonzero(expected))))
+    assert len(first) == int(expected.sum())
+
+def test_to_csr_lists_neighbours_per_node():
+    first, second, dist = np.array([2, 0, 2, 1]), np.array([0, 1, 1, 2]), np.array([1., 2., 3., 4.])
+    indptr, indices, distances = toCSR(4, first, second, dist)
+    assert indptr.tolist() == [0, 1, 2, 4, 4]
+    assert indices[indptr[2]:indptr[3]].tolist() == [0, 1]
+    assert distances[indptr[2]:indptr[3]].tolist() == [1., 3.]
+
+@pytest.mark.parametrize('seed', range(5))
+def test_kd_tree_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    count = int(rng.integers(1, 500))
+    # duplicates and clusters stress the median splits
+    points = np.round(rng.uniform(0., 20., (count, 2)))
+    # odd seeds walk the tree, even ones scan the single leaf
+    tree = KDTree(points, leafSize=int(rng.integers(1, 40)), linearBelow=0 if seed % 2 else 500)
+    for point in rng.uniform(-5., 25., (30, 2)):
+        k = int(rng.integers(1, count + 3))
+        found, dist = tree.query(point, k)
+        expected = np.sort(np.linalg.norm(points - point, axis=1))[:k]
+        assert found.shape[0] == min(k, count)
+        assert len(set(found.tolist())) == found.shape[0]
+        assert np.allclose(dist, expected)
+        assert np.allclose(np.linalg.norm(points[found] - point, axis=1), dist)
+
+@pytest.mark.parametrize('seed', range(4))
+def test_kd_tree_query_many_matches_brute_force(seed, monkeypatch):
+    rng = np.random.default_rng(seed)
+    count = int(rng.integers(300, 3000))
+    points = np.round(rng.uniform(0., 30., (count, 2))) if seed % 2 else rng.normal(0., 10., (count, 2))
+    tree = KDTree(points, leafSize=int(rng.integers(1, 40)), linearBelow=0)
+    assert tree.depth > 0
+    queries = rng.uniform(-50., 80., (50, 2))
+    k = int(rng.integers(1, 40))
+    # small budgets split the candidates of the batch into many slices
+    monkeypatch.setattr(spatial, 'KD_CANDIDATE_BUDGET', int(rng.integers(1, 5000)))
+    indices, distances = tree.queryMany(queries, k)
+    full = np.linalg.norm(points[None] - queries[:, None], axis=2)
+    assert np.allclose(distances, np.sort(full, axis=1)[:, :k])
+    assert np.allclose(np.take_along_axis(full, indices, axis=1), distances)
+    assert all(len(set(row)) == k for row in indices.tolist())
+
+def test_kd_tree_small_sets_are_a_single_leaf():
+    rng = np.random.default_rng(0)
+    points = rng.uniform(0., 10., (100, 2))
+    tree = KDTree(points, leafSize=4)
+    assert tree.depth == 0 and tree.lo.shape == (1, 2)
+    indices, distances = tree.queryMany(points[:3], 2)
+    assert indices[:, 0].tolist() == [0, 1, 2] and (distances[:, 0] == 0.).all()
+    assert KDTree(points, leafSize=4, linearBelow=0).depth == 5
+
+def test_kd_tree_query_many_pads_missing_neighbours():
+    tree = KDTree(np.array([[0., 0.], [3., 4.]]))
+    indices, distances = tree.queryMany(np.array([[0., 0.], [3., 4.]]), 3)
+    assert indices.tolist() == [[0, 1, -1], [1, 0, -1]]
+    assert distances[0, :2].tolist() == [0., 5.] and np.isinf(distances[:, 2]).all()
+    assert KDTree(np.empty((0, 2))).query([0., 0.], 2)[0].shape == (0,)
+
+@pytest.mark.parametrize('seed', range(10))
+def test_radius_query_many_with_mixed_radii_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    count, queries = int(rng.integers(0, 400)), int(rng.integers(1, 60))
+    points = rng.uniform(0., 100., (count, 2))
+    # zero radii, radii far apart in scale and centers outside the points' extent
+    centers = rng.uniform(-10., 110., (queries, 2))
+    radii = rng.choice([0., 0.5, 3., 20., 150.], queries) * rng.uniform(0.5, 1.5, queries)
+    q, found, dist = radiusQueryMany(points, centers, radii)
+    assert np.all(np.diff(q) >= 0)
+    distances = np.linalg.norm(points[None] - centers[:, None], axis=2)
+    expected = {(int(a), int(b)) for a, b in zip(*np.nonzero(distances < radii[:, None]))}
+    assert set(zip(q.tolist(), found.tolist())) == expected
+    assert len(expected) == q.shape[0]
+    assert np.allclose(dist, distances[q, found])
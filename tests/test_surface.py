@@ -0,0 +1,221 @@
+import numpy as np
+import pytest
+from surface import Surface
+from tiles import TileMap, Tile
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_find_agents_with_grid_matches_scan(seed, populate, foundIds):
+    rng = np.random.default_rng(seed)
+    gridded, scanned = Surface(cellSize=float(rng.uniform(2., 30.))), Surface()
+    populate(gridded, np.random.default_rng(seed), 400)
+    populate(scanned, np.random.default_rng(seed), 400)
+    for _ in range(50):
+        ids = [int(id) for id in rng.choice(400, 40, replace=False) if id % 4]
+        vectors = rng.normal(0., 5., (len(ids), 2)).astype(np.float32)
+        gridded.moveMany(ids, vectors)
+        scanned.moveMany(ids, vectors)
+        center, radius = rng.uniform(-10., 110., 2), float(rng.uniform(0.5, 60.))
+        assert foundIds(gridded.findAgents(center, radius)) == foundIds(scanned.findAgents(center, radius))
+        assert foundIds(gridded.findMobileAgents(center, radius)) == foundIds(scanned.findMobileAgents(center, radius))
+
+def assertMatchesReference(surface: Surface, reference: dict) -> None:
+    assert surface.count == len(reference)
+    ids = surface.getIds().tolist()
+    assert sorted(ids) == sorted(reference)
+    positions = surface.getPositions()
+    for row, id in enumerate(ids):
+        assert surface.idToRow[id] == row
+        assert np.array_equal(positions[row], reference[id])
+        assert np.array_equal(surface.getPosition(id), reference[id])
+
+@pytest.mark.parametrize('seed', range(4))
+def test_position_store_matches_reference(seed):
+    rng = np.random.default_rng(seed)
+    surface = Surface(capacity=4)
+    reference = {}
+    nextId = 0
+    for step in range(1500):
+        action = rng.random()
+        if(action < 0.35 or not reference):
+            position = rng.uniform(0., 100., 2).astype(np.float32)
+            assert surface.addMobileAgent(agent=None, id=nextId, startPos=position)
+            reference[nextId] = position
+            nextId += 1
+        elif(action < 0.6):
+            # swap-with-last removal, the last row moves into the freed one
+            id = int(rng.choice(list(reference)))
+            surface.removeAgent(id)
+            del reference[id]
+        elif(action < 0.8):
+            ids = [int(id) for id in rng.choice(list(reference), min(len(reference), 5), replace=False)]
+            vectors = rng.normal(0., 3., (len(ids), 2)).astype(np.float32)
+            surface.moveMany(ids, vectors)
+            for id, vector in zip(ids, vectors):
+                reference[id] = reference[id] + vector
+        else:
+            id = int(rng.choice(list(reference)))
+            position = rng.uniform(0., 100., 2).astype(np.float32)
+            surface.setPosition(id, position)
+            reference[id] = position
+        if(step % 100 == 0):
+            assertMatchesReference(surface, reference)
+    assertMatchesReference(surface, reference)
+
+def test_neighbour_pairs_match_brute_force(populate):
+    rng = np.random.default_rng(0)
+    surface = Surface()
+    positions = populate(surface, rng, 300)
+    mobile = [id for id in positions if id % 4]
+    idsA, idsB, dist = surface.findNeighbourPairs(10., kind='mobile')
+    found = {frozenset(pair) for pair in zip(idsA.tolist(), idsB.tolist())}
+    expected = {frozenset((a, b)) for i, a in enumerate(mobile) for b in mobile[i + 1:] if np.linalg.norm(positions[a] - positions[b]) < 10.}
+    assert found == expected and len(idsA) == len(expected)
+    ids, indptr, indices, _ = surface.findNeighbourPairs(10., kind='mobile', csr=True)
+    for row, id in enumerate(ids.tolist()):
+        neighbours = set(ids[indices[indptr[row]:indptr[row + 1]]].tolist())
+        assert neighbours == {b for pair in expected if id in pair for b in pair if b != id}
+
+@pytest.mark.parametrize('snapshotReads', [False, True])
+def test_snapshot_holds_published_state(snapshotReads):
+    surface = Surface(snapshotReads=snapshotReads)
+    surface.addMobileAgent(agent=None, id='a', startPos=np.array([1., 1.], dtype=np.float32))
+    surface.publish(step=1)
+    snapshot = surface.snapshot
+    surface.move('a', np.array([1., 0.], dtype=np.float32))
+    assert snapshot.step == 1
+    assert snapshot.getPosition('a').tolist() == [1., 1.]
+    with pytest.raises(ValueError):
+        snapshot.positions[0] = 0.
+    surface.publish(step=2)
+    assert surface.snapshot.getPosition('a').tolist() == [2., 1.]
+
+def test_publish_defers_the_copy_without_snapshot_reads():
+    surface = Surface()
+    surface.addMobileAgent(agent=None, id='a', startPos=np.array([1., 1.], dtype=np.float32))
+    assert surface.publish(step=1) is None
+    assert Surface(snapshotReads=True).publish(step=1) is not None
+    assert surface.snapshot.step == 1
+
+def test_snapshot_reads_fall_back_to_agents_added_since_publish():
+    surface = Surface(snapshotReads=True)
+    surface.publish(step=1)
+    surface.addMobileAgent(agent=None, id='late', startPos=np.array([3., 4.], dtype=np.float32))
+    assert surface.getPosition('late').tolist() == [3., 4.]
+    position, epoch, step = surface.getPositionStamped('late')
+    assert position.tolist() == [3., 4.] and epoch is None and step is None
+    with pytest.raises(KeyError):
+        surface.getPosition('unknown')
+
+def test_find_nearest_matches_brute_force(populate):
+    rng = np.random.default_rng(1)
+    surface = Surface()
+    positions = populate(surface, rng, 200)
+    surface.publish(step=0)
+    for point in rng.uniform(0., 100., (20, 2)):
+        for kind, ids in (('all', list(positions)), ('mobile', [id for id in positions if id % 4]), ('static', [id for id in positions if not id % 4])):
+            result = surface.findNearest(point, 5, kind=kind)
+            expected = sorted(np.linalg.norm(positions[id] - point) for id in ids)[:5]
+            assert np.allclose([dist for _, _, dist in result], expected)
+            assert all(id in ids for id, _, _ in result)
+
+def test_compaction_shrinks_store_and_keeps_state(foundIds):
+    rng = np.random.default_rng(2)
+    surface = Surface(capacity=8, cellSize=5.)
+    reference = {}
+    for id in range(1000):
+        reference[id] = rng.uniform(0., 100., 2).astype(np.float32)
+        surface.addMobileAgent(agent=None, id=id, startPos=reference[id])
+    grown = surface.positions.shape[0]
+    for id in rng.permutation(1000)[:980].tolist():
+        surface.removeAgent(id)
+        del reference[id]
+    assert surface.positions.shape[0] < grown
+    assert surface.positions.shape[0] >= 8
+    assertMatchesReference(surface, reference)
+    # removed ids can be added again after their rows were compacted away
+    for id in range(40):
+        if(id not in reference):
+            reference[id] = rng.uniform(0., 100., 2).astype(np.float32)
+            assert surface.addMobileAgent(agent=None, id=id, startPos=reference[id])
+    assertMatchesReference(surface, reference)
+    for _ in range(20):
+        center, radius = rng.uniform(0., 100., 2), float(rng.uniform(1., 50.))
+        expected = sorted(id for id, position in reference.items() if np.linalg.norm(position - center) < radius)
+        assert foundIds(surface.findAgents(center, radius)) == expected
+
+def test_move_many_sums_repeats_and_batches_move_functions():
+    calls = []
+    def doubled(vec, pos):
+        calls.append(vec.shape)
+        return pos + 2. * vec
+    surface = Surface()
+    surface.addMobileAgent(agent=None, id='a', startPos=np.zeros(2, dtype=np.float32))
+    surface.addMobileAgent(agent=None, id='b', startPos=np.zeros(2, dtype=np.float32), moveF=doubled)
+    surface.addMobileAgent(agent=None, id='c', startPos=np.ones(2, dtype=np.float32), moveF=doubled)
+    surface.addStaticAgent(agent=None, id='s', position=np.zeros(2, dtype=np.float32))
+    vectors = np.array([[1., 0.], [0., 1.], [1., 1.], [0., 2.], [5., 5.]], dtype=np.float32)
+    surface.moveMany(['a', 'b', 'c', 'b', 's'], vectors)
+    assert surface.getPosition('a').tolist() == [1., 0.]
+    assert surface.getPosition('b').tolist() == [0., 6.]
+    assert surface.getPosition('c').tolist() == [3., 3.]
+    assert surface.getPosition('s').tolist() == [0., 0.]
+    # one call for both agents sharing the function
+    assert calls == [(2, 2)]
+    assert surface.moveCount == 4
+    with pytest.raises(KeyError):
+        surface.moveMany(['a', 'gone'], vectors[:2])
+    assert surface.getPosition('a').tolist() == [1., 0.]
+    surface.moveMany(['a', 'gone'], vectors[:2], skipMissing=True)
+    assert surface.getPosition('a').tolist() == [2., 0.]
+
+def test_set_positions_and_queued_moves():
+    surface = Surface(cellSize=2.)
+    for id in range(3):
+        surface.addMobileAgent(agent=None, id=id, startPos=np.zeros(2, dtype=np.float32))
+    surface.setPositions([0, 2], np.array([[10., 10.], [-4., 3.]], dtype=np.float32))
+    assert surface.getPosition(0).tolist() == [10., 10.] and surface.getPosition(2).tolist() == [-4., 3.]
+    assert [id for id, _ in surface.findAgents(np.array([10., 10.]), 1.)] == [0]
+    surface.queueMove(1, np.array([1., 0.], dtype=np.float32))
+    surface.queueMove(1, np.array([1., 0.], dtype=np.float32))
+    surface.queueMove(2, np.array([1., 0.], dtype=np.float32))
+    assert surface.getPosition(1).tolist() == [0., 0.]
+    # agents may leave before the flush
+    surface.removeAgent(2)
+    assert surface.flushMoves() == 3
+    assert surface.getPosition(1).tolist() == [2., 0.]
+    assert surface.flushMoves() == 0
+
+def test_integrate_applies_acceleration_damping_and_speed_limit():
+    surface = Surface(maxSpeed=5.)
+    surface.addMobileAgent(agent=None, id='m', startPos=np.zeros(2, dtype=np.float32))
+    surface.addMobileAgent(agent=None, id='idle', startPos=np.zeros(2, dtype=np.float32))
+    surface.addStaticAgent(agent=None, id='s', position=np.zeros(2, dtype=np.float32))
+    surface.setVelocity('m', np.array([3., 0.], dtype=np.float32))
+    surface.setAcceleration('m', np.array([0., 4.], dtype=np.float32))
+    assert surface.integrate(0.) == 0
+    assert surface.integrate(1.) == 1
+    assert np.allclose(surface.getVelocity('m'), [3., 4.]) and np.allclose(surface.getPosition('m'), [3., 4.])
+    assert surface.getAcceleration('m').tolist() == [0., 4.]
+    surface.integrate(1.)
+    # (3, 8) is capped to the speed limit
+    assert np.allclose(np.linalg.norm(surface.getVelocity('m')), 5.)
+    assert np.allclose(surface.getVelocity('m'), np.array([3., 8.]) * 5. / np.hypot(3., 8.), atol=1e-5)
+    assert surface.getPosition('idle').tolist() == [0., 0.]
+    with pytest.raises(Exception, match='Only mobile agents'):
+        surface.setVelocity('s', np.array([1., 0.], dtype=np.float32))
+
+    damped = Surface(damping=np.log(2.))
+    damped.addMobileAgent(agent=None, id='m', startPos=np.zeros(2, dtype=np.float32))
+    damped.setVelocity('m', np.array([8., 0.], dtype=np.float32))
+    damped.integrate(1.)
+    assert np.allclose(damped.getVelocity('m'), [4., 0.]) and np.allclose(damped.getPosition('m'), [4., 0.])
+
+def test_integrate_cuts_velocity_at_walls():
+    grid = np.zeros((4, 4), dtype=np.uint8)
+    grid[:, 2] = Tile.WALL
+    surface = Surface(tiles=TileMap(grid, cellSize=1.))
+    surface.addMobileAgent(agent=None, id='m', startPos=np.array([0.5, 0.5], dtype=np.float32))
+    surface.setVelocity('m', np.array([3., 0.], dtype=np.float32))
+    surface.integrate(1.)
+    assert surface.getPosition('m')[0] < 2. and surface.getVelocity('m')[0] < 1.5
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+from tiles import TileMap, Tile
+
+
+def entry(start: np.ndarray, end: np.ndarray, x: int, y: int) -> float:
+    """
+        Parameter at which the segment enters the closed tile (x, y) of a unit
+        grid, inf if it misses it (Liang-Barsky clipping).
+    """
+    t0, t1 = 0., 1.
+    delta = end - start
+    for axis, low in ((0, x), (1, y)):
+        if(delta[axis] == 0.):
+            if(not low <= start[axis] <= low + 1):
+                return np.inf
+            continue
+        a, b = sorted(((low - start[axis]) / delta[axis], (low + 1 - start[axis]) / delta[axis]))
+        t0, t1 = max(t0, a), min(t1, b)
+    return t0 if t0 <= t1 else np.inf
+
+def firstBlocked(tiles: TileMap, start: np.ndarray, end: np.ndarray, skipStart: bool) -> float:
+    lo = np.floor(np.minimum(start, end)).astype(int) - 1
+    hi = np.floor(np.maximum(start, end)).astype(int) + 1
+    first = np.inf
+    for x in range(lo[0], hi[0] + 1):
+        for y in range(lo[1], hi[1] + 1):
+            if(skipStart and (x, y) == tuple(np.floor(start).astype(int))):
+                continue
+            if(not tiles.passable(np.array([x + 0.5, y + 0.5]))):
+                first = min(first, entry(start, end, x, y))
+    return first
+
+@pytest.mark.parametrize('seed', range(4))
+def test_segments_match_exact_tile_intersection(seed):
+    rng = np.random.default_rng(seed)
+    tiles = TileMap((rng.random((20, 20)) < 0.3).astype(np.uint8), cellSize=1., outsidePassable=bool(seed % 2))
+    starts = rng.uniform(-2., 22., (300, 2))
+    ends = starts + rng.normal(0., 4., (300, 2))
+    clear = tiles.segmentClear(starts, ends)
+    clipped = tiles.clipSegment(starts, ends)
+    for start, end, isClear, point in zip(starts, ends, clear, clipped):
+        assert isClear == (firstBlocked(tiles, start, end, skipStart=False) == np.inf)
+        reach = firstBlocked(tiles, start, end, skipStart=True)
+        expected = end if reach == np.inf else start + (end - start) * reach
+        assert np.allclose(point, expected, atol=1e-5)
+
+def test_diagonal_corner_cut_is_blocked():
+    grid = np.zeros((2, 2), dtype=np.uint8)
+    grid[0, 1] = grid[1, 0] = Tile.WALL
+    tiles = TileMap(grid, cellSize=2.)
+    starts = np.array([[1., 1.], [1., 1.], [1.9, 1.], [1., 1.]])
+    # through the shared corner, just past it and along the free diagonal's edge
+    ends = np.array([[3., 3.], [3., 3.2], [2.1, 3.], [1.5, 1.5]])
+    assert tiles.segmentClear(starts, ends).tolist() == [False, False, False, True]
+    clipped = tiles.clipSegment(starts, ends)
+    assert tiles.passable(clipped).all()
+    assert np.allclose(clipped[0], [2., 2.], atol=1e-5)
+    assert np.array_equal(clipped[3], ends[3])
+
+def test_long_segment_does_not_inflate_short_ones():
+    rng = np.random.default_rng(0)
+    tiles = TileMap((rng.random((100, 100)) < 0.2).astype(np.uint8), cellSize=1.)
+    starts = rng.uniform(0., 100., (10000, 2))
+    ends = starts + rng.normal(0., 0.5, starts.shape)
+    ends[0] = starts[0] + [5000., 3000.]
+    segment, _, _ = tiles._crossings(starts, ends)
+    # two tiles per crossed border, the long segment only pays for its own
+    borders = np.abs(np.floor(ends) - np.floor(starts)).sum()
+    assert segment.shape[0] == 2 * borders
+    assert np.array_equal(tiles.segmentClear(starts[1:], ends[1:]), tiles.segmentClear(starts, ends)[1:])
+    assert not tiles.segmentClear(starts[:1], ends[:1])[0]
+
+def test_load_round_trip(tmp_path):
+    grid = np.arange(12, dtype=np.uint8).reshape(3, 4) % 2
+    path = str(tmp_path / 'map.tiles')
+    TileMap.save(path, grid, cellSize=2.5, origin=(-1., 3.))
+    tiles = TileMap.load(path)
+    assert np.array_equal(tiles.grid, grid)
+    assert tiles.cellSize == 2.5 and tiles.origin.tolist() == [-1., 3.]
+    assert tiles.passable(np.array([[-0.5, 3.5], [2., 3.5]])).tolist() == [True, False]
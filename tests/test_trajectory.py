@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from surface import Surface
+from trajectory import TrajectoryHistory
+
+
+def test_ring_buffer_keeps_the_last_entries():
+    history = TrajectoryHistory(length=3, capacity=1)
+    for step in range(5):
+        history.record(['a', 'b'], np.array([[step, 0.], [0., step]]), step=step, simTime=step * 0.5)
+    trajectory = history.trajectory('a')
+    assert trajectory[:, 0].tolist() == [2., 3., 4.]
+    assert trajectory[:, 2].tolist() == [2., 3., 4.]
+    assert history.trajectory('b', t0=1.5, t1=1.5)[:, 3].tolist() == [3.]
+    # grown once for the second agent, never again however long it runs
+    assert history.data.shape == (2, 3, 4)
+    assert history.trajectory('unknown').shape == (0, 4)
+
+def test_find_agents_during_time_range():
+    history = TrajectoryHistory(length=10)
+    history.record(['a', 'b'], np.array([[0., 0.], [50., 0.]]), step=0, simTime=0.)
+    history.record(['a', 'b'], np.array([[20., 0.], [1., 0.]]), step=1, simTime=1.)
+    history.record(['a'], np.array([[2., 0.]]), step=2, simTime=2.)
+    assert sorted(history.findAgentsDuring([0., 0.], 5., 0., 2.).tolist()) == ['a', 'b']
+    assert history.findAgentsDuring([0., 0.], 5., 0.5, 1.5).tolist() == ['b']
+    assert history.findAgentsDuring([0., 0.], 5., 3., 4.).tolist() == []
+
+def test_forgotten_slots_are_reused():
+    history = TrajectoryHistory(length=2, capacity=2)
+    history.record(['a', 'b'], np.zeros((2, 2)), step=0, simTime=0.)
+    history.forget('a')
+    history.record(['c'], np.ones((1, 2)), step=1, simTime=1.)
+    assert history.data.shape[0] == 2
+    assert history.trajectory('a').shape == (0, 4)
+    assert history.trajectory('c')[:, 0].tolist() == [1.]
+    with pytest.raises(Exception):
+        TrajectoryHistory(length=0)
+
+def test_surface_records_published_mobile_agents():
+    surface = Surface(historyLength=4)
+    surface.addMobileAgent(agent=None, id='m', startPos=np.zeros(2, dtype=np.float32))
+    surface.addStaticAgent(agent=None, id='s', position=np.zeros(2, dtype=np.float32))
+    for step in range(6):
+        surface.publish(step=step)
+        surface.recordHistory(simTime=float(step))
+        surface.move('m', np.array([1., 0.], dtype=np.float32))
+    assert surface.getTrajectory('m')[:, 2].tolist() == [2., 3., 4., 5.]
+    assert surface.getTrajectory('s').shape == (0, 4)
+    assert surface.findAgentsDuring(np.array([0., 0.]), 0.5, 0., 10.).tolist() == []
+    assert surface.findAgentsDuring(np.array([3., 0.]), 0.5, 0., 10.).tolist() == ['m']
+    surface.removeAgent('m')
+    assert surface.getTrajectory('m').shape == (0, 4)
+    with pytest.raises(Exception, match='disabled'):
+        Surface().getTrajectory('m')
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+from surface import Surface
+from watch import WATCH_MAX_CELL_SPAN
+
+
+def point(x: float, y: float) -> np.ndarray:
+    return np.array([x, y], dtype=np.float32)
+
+def changes(events) -> list:
+    return sorted((event.watchId, event.id, event.entered) for event in events)
+
+@pytest.mark.parametrize('cellSize', [None, 5.])
+def test_enter_and_leave_of_fixed_watch(cellSize):
+    surface = Surface(cellSize=cellSize)
+    surface.addMobileAgent(agent=None, id='inside', startPos=point(1., 0.))
+    surface.addMobileAgent(agent=None, id='outside', startPos=point(20., 0.))
+    surface.addStaticAgent(agent=None, id='static', position=point(0., 1.))
+    seen = []
+    watchId = surface.addWatch(5., center=point(0., 0.), callback=seen.append)
+    assert changes(surface.updateWatches(step=0)) == [(watchId, 'inside', True)]
+    assert seen[0].step == 0
+    surface.move('outside', point(-17., 0.))
+    surface.move('inside', point(10., 0.))
+    assert changes(surface.updateWatches(step=1)) == [(watchId, 'inside', False), (watchId, 'outside', True)]
+    surface.removeAgent('outside')
+    assert changes(surface.updateWatches(step=2)) == [(watchId, 'outside', False)]
+    assert surface.updateWatches(step=3) == [] and len(seen) == 4
+
+@pytest.mark.parametrize('cellSize', [None, 5.])
+def test_anchored_watch_follows_its_anchor(cellSize):
+    surface = Surface(cellSize=cellSize)
+    surface.addMobileAgent(agent=None, id='anchor', startPos=point(0., 0.))
+    surface.addMobileAgent(agent=None, id='near', startPos=point(2., 0.))
+    surface.addStaticAgent(agent=None, id='post', position=point(30., 0.))
+    watchId = surface.addWatch(4., anchorId='anchor', kind='all')
+    assert changes(surface.updateWatches()) == [(watchId, 'near', True)]
+    # only the anchor moves, away from one agent and up to the other
+    surface.move('anchor', point(28., 0.))
+    assert changes(surface.updateWatches()) == [(watchId, 'near', False), (watchId, 'post', True)]
+    surface.removeAgent('anchor')
+    assert changes(surface.updateWatches()) == [(watchId, 'post', False)]
+    assert len(surface.watches) == 0
+
+def test_watches_match_brute_force_without_surface_grid():
+    rng = np.random.default_rng(0)
+    surface = Surface()
+    for id in range(300):
+        surface.addMobileAgent(agent=None, id=id, startPos=rng.uniform(0., 200., 2).astype(np.float32))
+    centers = {surface.addWatch(radius, center=center): (center, radius) for center, radius in zip(rng.uniform(0., 200., (6, 2)), (3., 10., 25., 60., 150., 400.))}
+    anchors = {surface.addWatch(15., anchorId=id): id for id in (0, 1)}
+    members = {watchId: set() for watchId in list(centers) + list(anchors)}
+    for step in range(30):
+        for event in surface.updateWatches(step=step):
+            (members[event.watchId].add if event.entered else members[event.watchId].discard)(event.id)
+        positions = {id: surface.getPosition(id) for id in surface.idToRow}
+        for watchId, (center, radius) in centers.items():
+            assert members[watchId] == {id for id, position in positions.items() if np.linalg.norm(position - center) < radius}
+        for watchId, anchor in anchors.items():
+            assert members[watchId] == {id for id, position in positions.items() if id != anchor and np.linalg.norm(position - positions[anchor]) < 15.}
+        ids = [int(id) for id in rng.choice(300, 40, replace=False)]
+        surface.moveMany(ids, rng.normal(0., 8., (40, 2)).astype(np.float32))
+    # the watches recompute through an agent grid instead of scanning the surface
+    assert surface.watches.grid is not None
+
+def test_large_watches_register_in_few_cells():
+    surface = Surface(watchCellSize=1.)
+    surface.addMobileAgent(agent=None, id=0, startPos=point(900., 0.))
+    watchId = surface.addWatch(1000., center=point(0., 0.))
+    watch = surface.watches.watches[watchId]
+    assert len(watch.cells) <= (WATCH_MAX_CELL_SPAN + 1) ** 2
+    assert changes(surface.updateWatches()) == [(watchId, 0, True)]
+    surface.move(0, point(200., 0.))
+    assert changes(surface.updateWatches()) == [(watchId, 0, False)]
+    surface.removeWatch(watchId)
+    assert not surface.watches.cells and not surface.watches.levels and surface.watches.grid is None
@@ -0,0 +1,137 @@
+import numpy as np
+
+TILE_MAGIC = b'AASDTILE'
+# magic, width, height, cellSize, originX, originY
+TILE_HEADER = np.dtype([('magic', 'S8'), ('width', '<i8'), ('height', '<i8'), ('cellSize', '<f8'), ('originX', '<f8'), ('originY', '<f8')])
+# in tiles, segments passing a tile corner closer than this touch both tiles beside it
+TILE_CORNER_EPS = 1e-9
+# in tiles, clipped moves stop this far in front of the blocked tile
+TILE_CLIP_BACKOFF = 1e-6
+
+class Tile():
+    FREE = 0
+    WALL = 1
+    BUILDING = 2
+    IMPASSABLE = 3
+
+class TileMap():
+    """
+        Terrain grid loaded from a binary file: a TILE_HEADER followed by
+        height * width uint8 tiles in row-major order, tile (x, y) covering
+        [origin + (x, y) * cellSize, origin + (x + 1, y + 1) * cellSize).
+        The tiles are memory-mapped, so opening a large map does not read it.
+        Every tile other than Tile.FREE blocks movement and sight.
+    """
+    def __init__(self, grid: np.ndarray[np.uint8], cellSize: float, origin: tuple[float, float]=(0., 0.), outsidePassable: bool=True) -> None:
+        self.grid = grid
+        self.cellSize = float(cellSize)
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.outsidePassable = outsidePassable
+
+    @staticmethod
+    def load(path: str, outsidePassable: bool=True) -> 'TileMap':
+        header = np.fromfile(path, dtype=TILE_HEADER, count=1)[0]
+        if(header['magic'] != TILE_MAGIC):
+            raise Exception(f"Not a tile map: {path}")
+        grid = np.memmap(path, dtype=np.uint8, mode='r', offset=TILE_HEADER.itemsize, shape=(int(header['height']), int(header['width'])))
+        return TileMap(grid, header['cellSize'], (header['originX'], header['originY']), outsidePassable=outsidePassable)
+
+    @staticmethod
+    def save(path: str, grid: np.ndarray[np.uint8], cellSize: float, origin: tuple[float, float]=(0., 0.)) -> None:
+        grid = np.ascontiguousarray(grid, dtype=np.uint8)
+        header = np.array([(TILE_MAGIC, grid.shape[1], grid.shape[0], cellSize, origin[0], origin[1])], dtype=TILE_HEADER)
+        with open(path, 'wb') as file:
+            header.tofile(file)
+            grid.tofile(file)
+
+    def passable(self, points: np.ndarray) -> np.ndarray[bool]:
+        """
+            Whether each of the (..., 2) points lies on a free tile.
+        """
+        points = np.asarray(points, dtype=np.float64)
+        cells = np.floor((points - self.origin) / self.cellSize).astype(np.int64)
+        return ~self._blocked(cells[..., 0], cells[..., 1])
+
+    def _blocked(self, x: np.ndarray, y: np.ndarray) -> np.ndarray[bool]:
+        """
+            Whether tiles (x, y) block, by tile index.
+        """
+        height, width = self.grid.shape
+        inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+        result = np.full(x.shape, not self.outsidePassable, dtype=bool)
+        result[inside] = self.grid[y[inside], x[inside]] != Tile.FREE
+        return result
+
+    def _crossings(self, starts: np.ndarray, ends: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+            Grid traversal of all segments at once: the segment index, the
+            parameter t in [0, 1] and whether the entered tile blocks for every
+            tile border a segment crosses, so a segment costs one entry per
+            crossed border instead of the longest segment setting the work of
+            all. Where a segment passes a tile corner within TILE_CORNER_EPS
+            both tiles beside the corner count as entered, it can not squeeze
+            between two diagonal blocked tiles.
+        """
+        local = (starts - self.origin) / self.cellSize
+        delta = (ends - self.origin) / self.cellSize - local
+        first = np.floor(local).astype(np.int64)
+        last = np.floor(local + delta).astype(np.int64)
+        segments, ts, blocked = [], [], []
+        for axis in (0, 1):
+            other = 1 - axis
+            counts = np.abs(last[:, axis] - first[:, axis])
+            total = int(counts.sum())
+            if(total == 0):
+                continue
+            segment = np.repeat(np.arange(counts.shape[0]), counts)
+            # k-th border of its segment, from 1
+            k = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+            step = np.sign(delta[segment, axis]).astype(np.int64)
+            entered = first[segment, axis] + step * k
+            border = entered + (step < 0)
+            t = (border - local[segment, axis]) / delta[segment, axis]
+            along = local[segment, other] + delta[segment, other] * t
+            cells = [None, None]
+            cells[axis] = entered
+            for side in (-TILE_CORNER_EPS, TILE_CORNER_EPS):
+                cells[other] = np.floor(along + side).astype(np.int64)
+                segments.append(segment)
+                ts.append(t)
+                blocked.append(self._blocked(cells[0], cells[1]))
+        if(not segments):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64), np.empty(0, dtype=bool)
+        return np.concatenate(segments), np.concatenate(ts), np.concatenate(blocked)
+
+    def segmentClear(self, starts: np.ndarray, ends: np.ndarray) -> np.ndarray[bool]:
+        """
+            Whether the straight segments from starts to ends cross only free tiles.
+            starts may be a single point shared by all segments.
+        """
+        ends = np.asarray(ends, dtype=np.float64).reshape(-1, 2)
+        starts = np.broadcast_to(np.asarray(starts, dtype=np.float64), ends.shape)
+        if(ends.shape[0] == 0):
+            return np.empty(0, dtype=bool)
+        segment, _, blocked = self._crossings(starts, ends)
+        return self.passable(starts) & (np.bincount(segment[blocked], minlength=ends.shape[0]) == 0)
+
+    def clipSegment(self, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+        """
+            The furthest point of each segment reachable from its start without
+            entering a blocked tile, just in front of the first blocked tile.
+            The start itself is not checked.
+        """
+        ends = np.asarray(ends, dtype=np.float64).reshape(-1, 2)
+        starts = np.broadcast_to(np.asarray(starts, dtype=np.float64), ends.shape)
+        if(ends.shape[0] == 0):
+            return ends.copy()
+        segment, t, blocked = self._crossings(starts, ends)
+        reach = np.full(ends.shape[0], np.inf)
+        np.minimum.at(reach, segment[blocked], t[blocked])
+        stopped = np.isfinite(reach)
+        clipped = ends.copy()
+        if(stopped.any()):
+            delta = ends[stopped] - starts[stopped]
+            # a point on the border already lies in the next tile
+            backoff = TILE_CLIP_BACKOFF * self.cellSize / np.maximum(np.linalg.norm(delta, axis=1), 1e-300)
+            clipped[stopped] = starts[stopped] + delta * np.maximum(reach[stopped] - backoff, 0.)[:, None]
+        return clipped
@@ -0,0 +1,115 @@
+import threading as th
+import numpy as np
+
+# columns of a history entry
+HISTORY_STEP = 0
+HISTORY_TIME = 1
+HISTORY_X = 2
+HISTORY_Y = 3
+
+class TrajectoryHistory():
+    """
+        Last `length` positions of every mobile agent, kept in one preallocated
+        (capacity, length, 4) array of (step, simulated time, x, y) rows used as
+        a ring buffer per agent. Slots of removed agents are reused, so memory
+        only depends on the number of agents present at the same time.
+    """
+    def __init__(self, length: int, capacity: int=64) -> None:
+        if(length <= 0):
+            raise Exception(f"History length must be positive, got: {length}")
+        self.length = int(length)
+        capacity = max(int(capacity), 1)
+        self.data = np.zeros((capacity, self.length, 4), dtype=np.float64)
+        self.heads = np.zeros(capacity, dtype=np.int64)
+        self.sizes = np.zeros(capacity, dtype=np.int64)
+        self.slotIds = np.empty(capacity, dtype=object)
+        self.idToSlot = {}
+        self.freeSlots = list(range(capacity - 1, -1, -1))
+        self.lock = th.Lock()
+
+    def _grow(self) -> None:
+        old = self.data.shape[0]
+        capacity = old * 2
+        data = np.zeros((capacity, self.length, 4), dtype=np.float64)
+        data[:old] = self.data
+        heads = np.zeros(capacity, dtype=np.int64)
+        heads[:old] = self.heads
+        sizes = np.zeros(capacity, dtype=np.int64)
+        sizes[:old] = self.sizes
+        slotIds = np.empty(capacity, dtype=object)
+        slotIds[:old] = self.slotIds
+        self.data, self.heads, self.sizes, self.slotIds = data, heads, sizes, slotIds
+        self.freeSlots = list(range(capacity - 1, old - 1, -1)) + self.freeSlots
+
+    def _slot(self, id) -> int:
+        slot = self.idToSlot.get(id)
+        if(slot is None):
+            if(not self.freeSlots):
+                self._grow()
+            slot = self.freeSlots.pop()
+            self.idToSlot[id] = slot
+            self.slotIds[slot] = id
+            self.heads[slot] = 0
+            self.sizes[slot] = 0
+        return slot
+
+    def record(self, ids, positions: np.ndarray, step: int, simTime: float) -> None:
+        positions = np.asarray(positions).reshape(-1, 2)
+        if(positions.shape[0] == 0):
+            return
+        self.lock.acquire()
+        slots = np.fromiter((self._slot(id) for id in ids), dtype=np.int64, count=positions.shape[0])
+        heads = self.heads[slots]
+        self.data[slots, heads, HISTORY_STEP] = step
+        self.data[slots, heads, HISTORY_TIME] = simTime
+        self.data[slots, heads, HISTORY_X:] = positions
+        self.heads[slots] = (heads + 1) % self.length
+        self.sizes[slots] = np.minimum(self.sizes[slots] + 1, self.length)
+        self.lock.release()
+
+    def recordSnapshot(self, snapshot, simTime: float) -> None:
+        """
+            Records the positions of all mobile agents of a SurfaceSnapshot.
+        """
+        rows = np.flatnonzero(snapshot.mobileMask)
+        self.record(snapshot.ids[rows], snapshot.positions[rows], snapshot.step, simTime)
+
+    def forget(self, id) -> None:
+        self.lock.acquire()
+        slot = self.idToSlot.pop(id, None)
+        if(slot is not None):
+            self.slotIds[slot] = None
+            self.sizes[slot] = 0
+            self.freeSlots.append(slot)
+        self.lock.release()
+
+    def trajectory(self, id, t0: float=-np.inf, t1: float=np.inf) -> np.ndarray:
+        """
+            (k, 4) array of (step, simulated time, x, y) of the agent between t0 and t1, oldest first.
+        """
+        self.lock.acquire()
+        slot = self.idToSlot.get(id)
+        if(slot is None):
+            self.lock.release()
+            return np.empty((0, 4), dtype=np.float64)
+        size, head = self.sizes[slot], self.heads[slot]
+        order = (np.arange(head - size, head)) % self.length
+        entries = self.data[slot, order]
+        self.lock.release()
+        times = entries[:, HISTORY_TIME]
+        return entries[(times >= t0) & (times <= t1)]
+
+    def findAgentsDuring(self, position, radius: float, t0: float, t1: float) -> np.ndarray:
+        """
+            Ids of agents recorded closer than radius to position at some time in [t0, t1].
+        """
+        self.lock.acquire()
+        used = np.flatnonzero(self.sizes > 0)
+        entries = self.data[used]
+        valid = np.arange(self.length)[None, :] < self.sizes[used, None]
+        ids = self.slotIds[used]
+        self.lock.release()
+        times = entries[..., HISTORY_TIME]
+        dist = np.linalg.norm(entries[..., HISTORY_X:] - np.asarray(position), axis=-1)
+        hit = (valid & (times >= t0) & (times <= t1) & (dist < radius)).any(axis=1)
+        return ids[hit]
@@ -0,0 +1,225 @@
+import math
+from typing import NamedTuple
+import numpy as np
+from spatial import SpatialHash
+
+
+class WatchEvent(NamedTuple):
+    watchId: int
+    id: object
+    entered: bool
+    step: int
+
+class ProximityWatch():
+    """
+        Standing query for agents of the given kind closer than radius to either
+        a fixed center or to the agent anchorId (which itself is never a member).
+    """
+    def __init__(self, watchId: int, radius: float, kind: str, center: np.ndarray[np.float32]=None, anchorId=None, callback=None) -> None:
+        self.watchId = watchId
+        self.radius = float(radius)
+        self.kind = kind
+        self.center = None if center is None else np.asarray(center, dtype=np.float32)
+        self.anchorId = anchorId
+        self.callback = callback
+        self.members = set()
+        self.cells = []
+        self.level = 0
+
+# watches are registered on the finest grid level where their box spans at most this many cells per side
+WATCH_MAX_CELL_SPAN = 4
+
+class WatchManager():
+    """
+        Keeps the watches of a Surface and turns the set of agents touched during
+        a tick into enter/leave events. Every watch is registered in the grid cells
+        its circle covers, so a moved agent is only tested against the watches of
+        its cell and the watches it already belongs to. Large watches go to a
+        coarser level of the grid, cells of level l are cellSize * 2 ** l wide.
+        Anchored watches whose anchor moved are recomputed with a single radius
+        query through the surface grid, or without one through an agent grid of
+        the manager that exists while there are watches.
+    """
+    def __init__(self, cellSize: float) -> None:
+        if(cellSize is None or cellSize <= 0.):
+            raise Exception(f"Cell size must be positive, got: {cellSize}")
+        self.cellSize = float(cellSize)
+        self.watches = {}
+        self.cells = {}
+        # number of watches registered on each grid level
+        self.levels = {}
+        self.grid = None
+        self.anchored = {}
+        self.memberOf = {}
+        self.pending = []
+        self._retired = {}
+        self._nextId = 0
+
+    def __len__(self) -> int:
+        return len(self.watches)
+
+    def _cell(self, position, level: int) -> tuple[int, int, int]:
+        size = self.cellSize * 2 ** level
+        return (level, math.floor(float(position[0]) / size), math.floor(float(position[1]) / size))
+
+    def _index(self, watch: ProximityWatch) -> None:
+        self._unindex(watch)
+        x, y = float(watch.center[0]), float(watch.center[1])
+        r = watch.radius
+        watch.level = max(0, math.ceil(math.log2(2. * r / (self.cellSize * WATCH_MAX_CELL_SPAN)))) if r > 0. else 0
+        size = self.cellSize * 2 ** watch.level
+        minX, maxX = math.floor((x - r) / size), math.floor((x + r) / size)
+        minY, maxY = math.floor((y - r) / size), math.floor((y + r) / size)
+        watch.cells = [(watch.level, cx, cy) for cx in range(minX, maxX + 1) for cy in range(minY, maxY + 1)]
+        for cell in watch.cells:
+            self.cells.setdefault(cell, set()).add(watch.watchId)
+        self.levels[watch.level] = self.levels.get(watch.level, 0) + 1
+
+    def _unindex(self, watch: ProximityWatch) -> None:
+        if(not watch.cells):
+            return
+        for cell in watch.cells:
+            bucket = self.cells[cell]
+            bucket.discard(watch.watchId)
+            if(not bucket):
+                del self.cells[cell]
+        watch.cells = []
+        self.levels[watch.level] -= 1
+        if(not self.levels[watch.level]):
+            del self.levels[watch.level]
+
+    def _agentGrid(self, surface) -> SpatialHash:
+        """
+            The surface grid, or the manager's own grid of all agents built on first use.
+        """
+        if(surface.grid is not None):
+            return surface.grid
+        if(self.grid is None):
+            self.grid = SpatialHash(self.cellSize)
+            self.grid.buildLater(lambda: (surface.rowIds[:surface.count], surface.positions[:surface.count]))
+        return self.grid
+
+    def _sync(self, surface, touched) -> None:
+        """
+            Moves the touched agents in the manager's grid, the surface keeps its own grid up to date.
+        """
+        if(self.grid is None or surface.grid is not None):
+            return
+        for id in touched:
+            row = surface.idToRow.get(id)
+            if(row is None):
+                self.grid.remove(id)
+            else:
+                self.grid.update(id, surface.positions[row])
+
+    def _enter(self, watch: ProximityWatch, id, step: int, events: list) -> None:
+        watch.members.add(id)
+        self.memberOf.setdefault(id, set()).add(watch.watchId)
+        events.append(WatchEvent(watch.watchId, id, True, step))
+
+    def _leave(self, watch: ProximityWatch, id, step: int, events: list) -> None:
+        watch.members.discard(id)
+        watches = self.memberOf.get(id)
+        if(watches is not None):
+            watches.discard(watch.watchId)
+            if(not watches):
+                del self.memberOf[id]
+        events.append(WatchEvent(watch.watchId, id, False, step))
+
+    def _recompute(self, watch: ProximityWatch, surface, step: int, events: list) -> None:
+        rows = surface._rowsWithin(watch.center, watch.radius, watch.kind, grid=self._agentGrid(surface))
+        current = set(surface.rowIds[rows])
+        current.discard(watch.anchorId)
+        for id in watch.members - current:
+            self._leave(watch, id, step, events)
+        for id in current - watch.members:
+            self._enter(watch, id, step, events)
+
+    def add(self, surface, radius: float, kind: str, center=None, anchorId=None, callback=None) -> int:
+        """
+            Expects the surface lock to be held. Agents already inside get enter
+            events with the next update.
+        """
+        if((center is None) == (anchorId is None)):
+            raise Exception("A watch needs exactly one of center and anchorId")
+        watch = ProximityWatch(self._nextId, radius, kind, center=center, anchorId=anchorId, callback=callback)
+        self._nextId += 1
+        if(anchorId is not None):
+            watch.center = surface.positions[surface.idToRow[anchorId]].copy()
+            self.anchored.setdefault(anchorId, set()).add(watch.watchId)
+        # agents touched since the last update are already where the watch will see them
+        self._sync(surface, surface._touched)
+        self.watches[watch.watchId] = watch
+        self._index(watch)
+        self._recompute(watch, surface, None, self.pending)
+        return watch.watchId
+
+    def remove(self, watchId: int) -> None:
+        watch = self.watches.pop(watchId, None)
+        if(watch is None):
+            return
+        self._unindex(watch)
+        for id in watch.members:
+            watches = self.memberOf[id]
+            watches.discard(watchId)
+            if(not watches):
+                del self.memberOf[id]
+        if(watch.anchorId is not None):
+            anchored = self.anchored[watch.anchorId]
+            anchored.discard(watchId)
+            if(not anchored):
+                del self.anchored[watch.anchorId]
+        if(not self.watches):
+            # the surface stops reporting touched agents, so the grid would go stale
+            self.grid = None
+
+    def update(self, surface, touched: set, step: int=None) -> list[WatchEvent]:
+        """
+            Events caused by the agents touched since the last update.
+            Expects the surface lock to be held.
+        """
+        events = [event._replace(step=step) for event in self.pending]
+        self.pending = []
+        self._sync(surface, touched)
+        recomputed = set()
+        for id in touched:
+            for watchId in list(self.anchored.get(id, ())):
+                watch = self.watches[watchId]
+                row = surface.idToRow.get(id)
+                if(row is None):
+                    # the anchor left the surface, so does its watch
+                    for member in list(watch.members):
+                        self._leave(watch, member, step, events)
+                    self._retired[watchId] = watch.callback
+                    self.remove(watchId)
+                    continue
+                watch.center = surface.positions[row].copy()
+                self._index(watch)
+                self._recompute(watch, surface, step, events)
+                recomputed.add(watchId)
+
+        for id in touched:
+            row = surface.idToRow.get(id)
+            candidates = set(self.memberOf.get(id, ()))
+            if(row is not None):
+                position = surface.positions[row]
+                for level in self.levels:
+                    candidates |= self.cells.get(self._cell(position, level), set())
+            for watchId in candidates - recomputed:
+                watch = self.watches[watchId]
+                inside = row is not None and id != watch.anchorId \
+                    and (watch.kind == 'all' or surface.mobileMask[row] == (watch.kind == 'mobile')) \
+                    and np.linalg.norm(position - watch.center) < watch.radius
+                if(inside and id not in watch.members):
+                    self._enter(watch, id, step, events)
+                elif(not inside and id in watch.members):
+                    self._leave(watch, id, step, events)
+        return events
+
+    def dispatch(self, events: list[WatchEvent]) -> None:
+        for event in events:
+            watch = self.watches.get(event.watchId)
+            callback = watch.callback if watch is not None else self._retired.get(event.watchId)
+            if(callback is not None):
+                callback(event)
+        self._retired = {}